@@ -2,22 +2,43 @@
 """
 BladeBit wrapper.
 
-A simple wrapper for BladeBit to suspend plotting if there is insufficient free space 
-in the (single) destination.
+A simple wrapper for BladeBit to suspend plotting if there is insufficient free space
+in the destination.  Several BladeBit instances (one per GPU) can share one or more
+staging directories, each batch of plots starting in the directory with the most room.
 
 Author: Graeme Seaton <graemes@graemes.com>
 SPDX-License-Identifier: GPL-3.0-or-later
 
-Feel free to buy me a drink (only if you want to :)): 
+Feel free to buy me a drink (only if you want to :)):
 xch1vlnelz9ef43z3xa4x6a3zzfm7cezwvmq332p97xlflmxxcgzdrpsqamyee
 """
 import asyncio
+import json
 import os
 import shutil
+import time
 
 import psutil
 import yaml
 
+# Seconds between free space checks while paused.  With the mownplow socket
+# the check also happens as soon as a plot leaves a staging directory.
+POLL_INTERVAL = 5
+SOCKET_POLL_INTERVAL = 60
+
+# Plot size (GiB) by compression level
+PLOT_SIZES = {
+    0: 101.3,
+    1: 87.54,
+    2: 86.03,
+    3: 84.46,
+    4: 82.86,
+    5: 81.26,
+    6: 79.65,
+    7: 78.05,
+    9: 75.2,
+}
+
 
 class ExecutableBladeBitDoesNotExistError(Exception):
     pass
@@ -31,120 +52,321 @@ class MissingKeyError(Exception):
     pass
 
 
-class Config:
-    def __init__(self, config_file: str) -> None:
-        with open(config_file, "r") as file:
-            config = yaml.safe_load(file)
-
-        # BladeBit command
-        self.cmd = config["Cmd"]
-        if not os.path.isfile(self.cmd) and not os.access(self.cmd, os.X_OK):
-            raise ExecutableBladeBitDoesNotExistError(
-                f"An executable BladeBit does not exist at '{self.cmd}'."
-            )
+class InstanceConfig:
+    # Settings for a single BladeBit process
 
-        # Destination
-        self.dest = config["Dest"]
-        if not os.path.exists(self.dest):
-            raise DestDoesNotExistError(
-                f"The destination '{self.dest}' does not exist."
-            )
+    def __init__(self, name: str, plot: dict, cmd: str, dests: list) -> None:
+        self.name = name
+        self.cmd = cmd
 
-        # Plot parameters
         # Required
-        self.farmer_key = config["Plot"]["FarmerKey"]
+        self.farmer_key = plot["FarmerKey"]
         if not self.farmer_key:
             raise MissingKeyError("FarmerKey has not been specified.")
-        self.pool_contract = config["Plot"]["PoolContract"]
+        self.pool_contract = plot["PoolContract"]
         if not self.pool_contract:
             raise MissingKeyError("PoolContract has not been specified.")
 
         # Optional
-        self.compress_level = int(config["Plot"].get("CompressLevel", 1))
-        self.num_plots = config["Plot"].get("NumberPlots", 0)
-
-        self.threads = config["Plot"].get("Threads", None)
-        self.device = config["Plot"].get("Device", None)
+        self.compress_level = int(plot.get("CompressLevel", 1))
+        self.num_plots = plot.get("NumberPlots", 0)
+        # Plots per BladeBit run, each run starts in the staging directory
+        # with the most room (0 is a single run until NumberPlots are done)
+        self.batch_size = plot.get("BatchSize", 0)
+
+        self.threads = plot.get("Threads", None)
+        self.device = plot.get("Device", None)
+
+        # Staging directories this instance may write to
+        self.dests = plot.get("Dest", dests)
+        if isinstance(self.dests, str):
+            self.dests = [self.dests]
+        for dest in self.dests:
+            if not os.path.exists(dest):
+                raise DestDoesNotExistError(f"The destination '{dest}' does not exist.")
 
         # Free space required
-        plot_sizes = {
-            0: 101.3,
-            1: 87.54,
-            2: 86.03,
-            3: 84.46,
-            4: 82.86,
-            5: 81.26,
-            6: 79.65,
-            7: 78.05,
-            9: 75.2,
-        }
         # Default to uncompressed plot size
         self.min_free_space = int(
-            (plot_sizes.get(self.compress_level, 101.3) + 1) * (1024**3)
+            (PLOT_SIZES.get(self.compress_level, 101.3) + 1) * (1024**3)
         )
 
 
-async def run_and_monitor_bladebit(config: Config):
-    run_cmd = [
-        config.cmd,
-        "-f",
-        f"{config.farmer_key}",
-        "-c",
-        f"{config.pool_contract}",
-        "--compress",
-        f"{config.compress_level}",
-        "-n",
-        f"{config.num_plots}",
-    ]
-    if config.threads:
-        run_cmd.append("-t")
-        run_cmd.append(f"{config.threads}")
-    run_cmd.append("cudaplot")
-    if config.device:
-        run_cmd.append("-d")
-        run_cmd.append(f"{config.device}")
-    run_cmd.append(f"{config.dest}")
-
-    proc = await asyncio.create_subprocess_exec(
-        *run_cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT,
-    )
+class Config:
+    def __init__(self, config_file: str) -> None:
+        with open(config_file, "r") as file:
+            config = yaml.safe_load(file)
+
+        # BladeBit command
+        self.cmd = config["Cmd"]
+        if not os.path.isfile(self.cmd) and not os.access(self.cmd, os.X_OK):
+            raise ExecutableBladeBitDoesNotExistError(
+                f"An executable BladeBit does not exist at '{self.cmd}'."
+            )
+
+        # Staging destinations shared by every instance
+        self.dests = config["Dest"]
+        if isinstance(self.dests, str):
+            self.dests = [self.dests]
+        for dest in self.dests:
+            if not os.path.exists(dest):
+                raise DestDoesNotExistError(f"The destination '{dest}' does not exist.")
+
+        # mownplow's Backpressure.Socket (optional)
+        self.socket = config.get("Socket")
+
+        # Plot parameters, optionally overridden per instance (e.g. Device)
+        plot = config["Plot"]
+        instances = config.get("Instances") or [{}]
+        self.instances = [
+            InstanceConfig(
+                instance.get("Name", f"bb{index}"),
+                {**plot, **instance},
+                self.cmd,
+                self.dests,
+            )
+            for index, instance in enumerate(instances)
+        ]
+
+
+class StagingBudget:
+    # Free space in the staging directories, less the plots being written
+
+    def __init__(self, dests: list):
+        self.devices = {os.stat(dest).st_dev for dest in dests}
+        # Instance name -> (device, bytes) of the plot it is writing
+        self.reserved = {}
+        # Plot -> bytes mownplow is moving off the staging devices, which
+        # are freed once each transfer completes
+        self.incoming = {}
+        self.space_freed = asyncio.Event()
+
+    def room(self, dest: str, name: str) -> int:
+        # Free space in dest which isn't spoken for by other instances
+        device = os.stat(dest).st_dev
+        reserved = sum(
+            size
+            for other, (other_device, size) in self.reserved.items()
+            if other != name and other_device == device
+        )
+        return shutil.disk_usage(dest).free - reserved
+
+    def best_dest(self, dests: list, size: int, name: str) -> str:
+        rooms = {dest: self.room(dest, name) for dest in dests}
+        dest = max(rooms, key=rooms.get)
+        if rooms[dest] < size:
+            return None
+        return dest
+
+    def reserve(self, name: str, dest: str, size: int):
+        self.reserved[name] = (os.stat(dest).st_dev, size)
+
+    def release(self, name: str):
+        self.reserved.pop(name, None)
+
+    async def wait(self, timeout: int):
+        # Check often while plots are on their way off, in case an event is
+        # missed
+        if self.incoming:
+            timeout = min(timeout, POLL_INTERVAL)
+        await wait_for_space(self.space_freed, timeout)
+
+
+class BladeBitInstance:
+    def __init__(self, config: InstanceConfig, budget: StagingBudget):
+        self.config = config
+        self.budget = budget
+        self.completed = 0
+        self.started_at = time.monotonic()
+
+    def log(self, message: str):
+        print(f"[{self.config.name}] {message}")
+
+    def plots_per_hour(self) -> float:
+        hours = (time.monotonic() - self.started_at) / 3600
+        return self.completed / hours if hours else 0.0
+
+    def report(self):
+        self.log(f"{self.completed} plots, {self.plots_per_hour():.2f} plots/hour")
+
+    async def run(self, poll_interval: int):
+        config = self.config
+        while not config.num_plots or self.completed < config.num_plots:
+            dest = self.budget.best_dest(
+                config.dests, config.min_free_space, config.name
+            )
+            if dest is None:
+                self.log(f"Waiting for space in {', '.join(config.dests)}")
+                await self.budget.wait(poll_interval)
+                continue
+
+            count = config.batch_size
+            if config.num_plots:
+                remaining = config.num_plots - self.completed
+                count = min(count, remaining) if count else remaining
+            returncode = await self.run_and_monitor_bladebit(
+                dest, count, poll_interval
+            )
+            if returncode is None:
+                # Stopped to carry on in a staging directory with more room
+                continue
+            if returncode != 0:
+                self.log(f"BladeBit exited with {returncode}")
+                break
+            if not config.batch_size:
+                break
+        self.report()
+
+    async def run_and_monitor_bladebit(
+        self, dest: str, count: int, poll_interval: int
+    ) -> int:
+        config = self.config
+        run_cmd = [
+            config.cmd,
+            "-f",
+            f"{config.farmer_key}",
+            "-c",
+            f"{config.pool_contract}",
+            "--compress",
+            f"{config.compress_level}",
+            "-n",
+            f"{count}",
+        ]
+        if config.threads:
+            run_cmd.append("-t")
+            run_cmd.append(f"{config.threads}")
+        run_cmd.append("cudaplot")
+        if config.device is not None:
+            run_cmd.append("-d")
+            run_cmd.append(f"{config.device}")
+        run_cmd.append(f"{dest}")
+
+        self.log(f"Starting {count or 'unlimited'} plots in {dest}")
+        proc = await asyncio.create_subprocess_exec(
+            *run_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
 
-    is_paused = False
+        started = 0
+        is_paused = False
+        moving = False
+        # The plot being written, removed if the run is stopped part way
+        plot_file = None
+        while True:
+            output = await proc.stdout.readline()
+            if not output:
+                break
+
+            self.log(output.decode().strip())
+            if "Plot temporary file:" in output.decode():
+                plot_file = output.decode().split(":", 1)[1].strip()
+            if "Generating plot" in output.decode() and not moving:
+                # The previous plot (if any) is done
+                self.budget.release(config.name)
+                if started:
+                    self.completed += 1
+                    self.report()
+                started += 1
+                plot_file = None
+                while True:
+                    # Check for free disk space
+                    free_space = self.budget.room(dest, config.name)
+
+                    # Rather than wait for dest, stop this run and start
+                    # another in a staging directory with room
+                    others = [other for other in config.dests if other != dest]
+                    if free_space < config.min_free_space and others:
+                        other = self.budget.best_dest(
+                            others, config.min_free_space, config.name
+                        )
+                        if other is not None:
+                            self.log(f"Stopping BladeBit - low disk space in {dest}"
+                                + f", {other} has room"
+                            )
+                            proc.terminate()
+                            if is_paused:
+                                await resume_process(proc.pid)
+                            moving = True
+                            break
+
+                    if free_space < config.min_free_space and not is_paused:
+                        self.log("Pausing BladeBit - low disk space - free/min: "
+                            + f"{free_space}/{config.min_free_space}"
+                            + " bytes"
+                        )
+                        await suspend_process(proc.pid)
+                        is_paused = True
+                    elif free_space > config.min_free_space and is_paused:
+                        self.log("Resuming BladeBit - sufficient disk space - free/min: "
+                            + f"{free_space}/{config.min_free_space}"
+                            + " bytes"
+                        )
+                        await resume_process(proc.pid)
+                        is_paused = False
+                        break
+                    elif not is_paused:
+                        break
+
+                    await self.budget.wait(poll_interval)
+                if not moving:
+                    self.budget.reserve(config.name, dest, config.min_free_space)
+
+        await proc.wait()
+        self.budget.release(config.name)
+        if moving:
+            # Only the plot just started is lost
+            if plot_file and os.path.exists(plot_file):
+                os.remove(plot_file)
+            return None
+        if started and proc.returncode == 0:
+            self.completed += 1
+            self.report()
+        return proc.returncode
+
+
+async def watch_plow_events(config: Config, budget: StagingBudget):
+    # Wake the free space checks whenever mownplow moves a plot off a
+    # staging directory
     while True:
-        output = await proc.stdout.readline()
-        if not output:
-            break
-
-        print(output.decode().strip())
-        if "Generating plot" in output.decode():
-            while True:
-                # Check for free disk space
-                disk_usage = shutil.disk_usage(config.dest)
-                free_space = disk_usage.free
-
-                if free_space < config.min_free_space and not is_paused:
-                    print("Pausing BladeBit - low disk space - free/min: "
-                        + f"{free_space}/{config.min_free_space}"
-                        + " bytes"
-                    )
-                    await suspend_process(proc.pid)
-                    is_paused = True
-                elif free_space > config.min_free_space and is_paused:
-                    print("Resuming BladeBit - sufficient disk space - free/min: "
-                        + f"{free_space}/{config.min_free_space}"
-                        + " bytes"
-                    )
-                    await resume_process(proc.pid)
-                    is_paused = False
-                    break
-                elif not is_paused:
-                    break
-
-                await asyncio.sleep(5)
-
-    await proc.wait()
+        try:
+            reader, writer = await asyncio.open_unix_connection(config.socket)
+        except OSError:
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        print(f"Connected to mownplow on {config.socket}")
+        try:
+            while line := await reader.readline():
+                event = json.loads(line)
+                try:
+                    source_dev = os.stat(event["source"]).st_dev
+                except OSError:
+                    continue
+                if source_dev not in budget.devices:
+                    continue
+                if event["event"] == "started":
+                    budget.incoming[event["plot"]] = event["bytes"]
+                    incoming = sum(budget.incoming.values()) / (1024**3)
+                    print(f"{incoming:.1f}GiB being moved off staging")
+                else:
+                    budget.incoming.pop(event["plot"], None)
+                    if event["event"] == "removed":
+                        budget.space_freed.set()
+        except (OSError, ValueError) as e:
+            print(f"Lost connection to mownplow: {e}")
+        finally:
+            writer.close()
+            # Transfers in flight are sent again on reconnecting
+            budget.incoming.clear()
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def wait_for_space(space_freed: asyncio.Event, timeout: int):
+    try:
+        await asyncio.wait_for(space_freed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    space_freed.clear()
 
 
 async def suspend_process(pid):
@@ -159,7 +381,21 @@ async def resume_process(pid):
 
 async def main():
     config = Config("bb_config.yaml")
-    await run_and_monitor_bladebit(config)
+    # Every staging directory, including those of instances with their own Dest
+    budget = StagingBudget(
+        [dest for instance in config.instances for dest in instance.dests]
+    )
+
+    poll_interval = POLL_INTERVAL
+    if config.socket:
+        watcher = asyncio.create_task(watch_plow_events(config, budget))
+        poll_interval = SOCKET_POLL_INTERVAL
+
+    instances = [BladeBitInstance(instance, budget) for instance in config.instances]
+    await asyncio.gather(*(instance.run(poll_interval) for instance in instances))
+
+    if config.socket:
+        watcher.cancel()
 
 
 # Run the main function in the event loop
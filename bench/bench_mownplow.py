@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Mow'n'Plow scale benchmark.
+
+Runs mownplow's main() against local stand-ins for the harvester: an
+asyncssh server which runs commands locally (with a fake `mount`), a
+fake transfer (or the sendfile receiver) and a fake harvester HTTPS
+RPC.  With --transfer local the destinations are used directly, without
+SSH or a transfer engine. Hundreds of synthetic destinations and thousands of tiny synthetic
+plots are used so that mownplow's own overhead dominates.
+
+Reports plots/hour, dispatch latency, SSH commands per plot, harvester
+RPCs and event-loop CPU so that changes to plow(), DestMan and
+PlowScheduler can be compared against each other.
+
+Usage: python bench/bench_mownplow.py --dests 200 --plots 2000
+"""
+import argparse
+import asyncio
+import datetime
+import getpass
+import json
+import logging
+import multiprocessing
+import os
+import runpy
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import asyncssh
+import yaml
+from aiohttp import web
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from mownplow.config import Config  # noqa: E402
+from mownplow.metrics import metrics  # noqa: E402
+from mownplow.receiver import ReceiverServer  # noqa: E402
+
+# Stand-in for `rsync --remove-source-files <plot> rsync://host:port/<path>`
+FAKE_RSYNC = """#!/bin/sh
+eval "plot=\\${$(($# - 1))}"
+eval "dest=\\${$#}"
+exec mv "$plot" "/${dest#*://*/}/"
+"""
+
+# Shared by the plower and the sendfile receiver
+BENCH_TOKEN = "bench"
+
+#####
+# Synthetic harvester
+#####
+
+
+def make_tls_files(path: Path):
+    # Private CA plus a harvester certificate signed by it
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    import ipaddress
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expires = now + datetime.timedelta(days=1)
+
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Bench CA")])
+    ca_cert = (
+        x509.CertificateBuilder()
+        .subject_name(ca_name)
+        .issuer_name(ca_name)
+        .public_key(ca_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(expires)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+        .sign(ca_key, hashes.SHA256())
+    )
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+        )
+        .issuer_name(ca_name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(expires)
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            False,
+        )
+        .sign(ca_key, hashes.SHA256())
+    )
+
+    files = {
+        "ca": path / "private_ca.crt",
+        "cert": path / "private_harvester.crt",
+        "key": path / "private_harvester.key",
+    }
+    files["ca"].write_bytes(ca_cert.public_bytes(serialization.Encoding.PEM))
+    files["cert"].write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    files["key"].write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
+        )
+    )
+    return files
+
+
+def make_fake_bin(path: Path, dest_root: Path, dest_dirs: list):
+    # `mount` lists the synthetic drives, `rsync` just moves the file
+    path.mkdir()
+    mounts = "".join(
+        f"bench{i} on {dest_root}/{d} type ext4 (rw)\n" for i, d in enumerate(dest_dirs)
+    )
+    (path / "mounts").write_text(mounts)
+    (path / "mount").write_text(f"#!/bin/sh\nexec cat {path / 'mounts'}\n")
+    (path / "rsync").write_text(FAKE_RSYNC)
+    for tool in ("mount", "rsync"):
+        (path / tool).chmod(0o755)
+
+
+async def run_harvester(args, ports, counters, ready):
+    env = dict(os.environ, PATH=f"{args['bin']}:{os.environ['PATH']}")
+
+    async def handle_process(process):
+        with counters.get_lock():
+            counters[0] += 1
+        local = await asyncio.create_subprocess_exec(
+            "/bin/sh",
+            "-c",
+            process.command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+        )
+
+        async def forward_stdin():
+            try:
+                while data := await process.stdin.read(64 * 1024):
+                    local.stdin.write(data)
+                    await local.stdin.drain()
+            except (OSError, asyncssh.Error):
+                pass
+            finally:
+                local.stdin.close()
+
+        async def forward_output(reader, writer):
+            # Streamed so that a resident agent's replies arrive as it sends them
+            while data := await reader.read(64 * 1024):
+                writer.write(data)
+
+        # Commands without input never see EOF so stdin is left to be cancelled
+        stdin_task = asyncio.create_task(forward_stdin())
+        await asyncio.gather(
+            forward_output(local.stdout, process.stdout),
+            forward_output(local.stderr, process.stderr),
+        )
+        returncode = await local.wait()
+        stdin_task.cancel()
+        process.exit(returncode)
+
+    ssh_server = await asyncssh.create_server(
+        asyncssh.SSHServer,
+        "127.0.0.1",
+        0,
+        server_host_keys=[args["host_key"]],
+        authorized_client_keys=args["client_pub"],
+        process_factory=handle_process,
+        encoding=None,
+    )
+    ports["ssh"] = ssh_server.sockets[0].getsockname()[1]
+
+    async def rpc(request):
+        with counters.get_lock():
+            counters[1] += 1
+        return web.json_response({"success": True, "directories": []})
+
+    app = web.Application()
+    for route in ("get_plot_directories", "add_plot_directory", "remove_plot_directory"):
+        app.router.add_post(f"/{route}", rpc)
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(args["tls"]["cert"], args["tls"]["key"])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=ssl_context)
+    await site.start()
+    ports["rpc"] = runner.addresses[0][1]
+
+    if args["transfer"] == "sendfile":
+        receiver = ReceiverServer(("127.0.0.1", 0), args["dest_root"], BENCH_TOKEN)
+        threading.Thread(target=receiver.serve_forever, daemon=True).start()
+        ports["receiver"] = receiver.server_address[1]
+
+    ready.put(dict(ports))
+    await asyncio.Event().wait()
+
+
+def harvester_process(args, counters, ready):
+    asyncio.run(run_harvester(args, {}, counters, ready))
+
+
+#####
+# Benchmark
+#####
+
+
+def write_config(work: Path, opts, args: dict, ports: dict) -> Path:
+    config = {
+        "Sources": [str(work / "source")],
+        "Dest": {
+            "Host": "127.0.0.1",
+            "Username": getpass.getuser(),
+            "Protocol": "rsync",
+            "Port": 12000,
+            "Root": args["dest_root"],
+            # Local destinations aren't mounts so they can't be discovered
+            # (the agent reads the real mount table rather than the fake one)
+            "Dirs": (
+                args["dest_dirs"]
+                if opts.transfer == "local" or opts.agent
+                else []
+            ),
+            "Local": opts.transfer == "local",
+            "Agent": opts.agent,
+        },
+        "PlowOptions": {
+            "Replot": True,
+            "ReplotBefore": "2021-01-01 00:00",
+            "RemoveAllAtStart": True,
+            "FarmDuring": False,
+            "MaxTransfers": opts.max_transfers,
+            "MaxPerSource": opts.max_per_source,
+        },
+        "Rsync": {"Cmd": str(Path(args["bin"]) / "rsync"), "Flags": ""},
+        "Transfer": {
+            "Engine": "sendfile" if opts.transfer == "sendfile" else "rsync",
+            "Port": ports.get("receiver", 0),
+            "Token": BENCH_TOKEN,
+        },
+        "SSH": {
+            "Port": ports["ssh"],
+            "Private_Key_Path": str(work / "id_bench"),
+            "KnownHosts": str(work / "known_hosts"),
+        },
+        "Harvester": {
+            "Host": "127.0.0.1",
+            "Port": ports["rpc"],
+            "CACertPath": str(args["tls"]["ca"]),
+            "CertPath": str(args["tls"]["cert"]),
+            "KeyPath": str(args["tls"]["key"]),
+        },
+        "Journal": {"Path": str(work / "journal.db")},
+        "Trace": {"Path": str(Path(opts.trace).resolve()) if opts.trace else ""},
+        "Logging": {"Level": opts.log_level},
+    }
+    path = work / "config.yaml"
+    path.write_text(yaml.safe_dump(config))
+    return path
+
+
+def make_synthetic_farm(work: Path, opts) -> list:
+    dest_root = work / "plots"
+    dest_dirs = [f"d{i:04d}" for i in range(opts.dests)]
+    old = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+    for dest_dir in dest_dirs:
+        (dest_root / dest_dir).mkdir(parents=True)
+        for n in range(opts.replots):
+            replot = dest_root / dest_dir / f"plot-k32-2020-{n:04d}.plot"
+            replot.touch()
+            os.utime(replot, (old, old))
+
+    source = work / "source"
+    source.mkdir()
+    for n in range(opts.plots):
+        with open(source / f"plot-k32-bench-{n:06d}.plot", "wb") as plot:
+            plot.truncate(opts.plot_size)
+    return dest_dirs
+
+
+def remaining_plots(source: Path) -> int:
+    with os.scandir(source) as entries:
+        return sum(1 for entry in entries if entry.name.endswith(".plot"))
+
+
+async def run_benchmark(main, config: Config, source: Path, opts) -> float:
+    loop = asyncio.get_running_loop()
+    plow = asyncio.create_task(main(config, loop))
+    start = time.monotonic()
+    try:
+        while remaining_plots(source):
+            if plow.done():
+                plow.result()
+                break
+            if time.monotonic() - start > opts.timeout:
+                logging.error("Benchmark timed out")
+                break
+            await asyncio.sleep(0.2)
+    finally:
+        elapsed = time.monotonic() - start
+        plow.cancel()
+        await asyncio.gather(plow, return_exceptions=True)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mow'n'Plow scale benchmark")
+    parser.add_argument("--dests", type=int, default=200)
+    parser.add_argument("--plots", type=int, default=2000)
+    parser.add_argument("--replots", type=int, default=2, help="Replots per drive")
+    parser.add_argument("--plot-size", type=int, default=64 * 1024)
+    parser.add_argument(
+        "--transfer", choices=("rsync", "sendfile", "local"), default="rsync"
+    )
+    parser.add_argument(
+        "--agent",
+        action="store_true",
+        help="Answer filesystem calls with the resident agent rather than shells",
+    )
+    parser.add_argument("--max-transfers", type=int, default=0)
+    parser.add_argument("--max-per-source", type=int, default=0)
+    parser.add_argument("--timeout", type=int, default=1800)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="Also write the results as JSON")
+    parser.add_argument("--trace", help="Write the plower's stage trace here")
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="mownplow-bench-") as tmp:
+        work = Path(tmp)
+        dest_dirs = make_synthetic_farm(work, opts)
+
+        client_key = asyncssh.generate_private_key("ssh-ed25519")
+        client_key.write_private_key(str(work / "id_bench"))
+        client_key.write_public_key(str(work / "id_bench.pub"))
+        host_key = asyncssh.generate_private_key("ssh-ed25519")
+
+        args = {
+            "bin": str(work / "bin"),
+            "dest_root": str(work / "plots"),
+            "dest_dirs": dest_dirs,
+            "host_key": host_key,
+            "client_pub": str(work / "id_bench.pub"),
+            "tls": make_tls_files(work),
+            "transfer": opts.transfer,
+        }
+        make_fake_bin(work / "bin", work / "plots", dest_dirs)
+
+        # The stand-ins run in their own process so that only mownplow's
+        # CPU time is measured here
+        counters = multiprocessing.Array("l", 2)
+        ready = multiprocessing.Queue()
+        harvester = multiprocessing.Process(
+            target=harvester_process, args=(args, counters, ready), daemon=True
+        )
+        harvester.start()
+        ports = ready.get(timeout=30)
+
+        (work / "known_hosts").write_text(
+            f"[127.0.0.1]:{ports['ssh']} "
+            + host_key.export_public_key().decode()
+        )
+        config = Config(str(write_config(work, opts, args, ports)))
+        logging.basicConfig(
+            format="%(asctime)s %(levelname)-2s %(message)s",
+            level=config.logging,
+            datefmt="%Y-%m-%d %H:%M:%S",
+            force=True,
+        )
+        logging.getLogger("asyncssh").setLevel(logging.WARNING)
+
+        plow_main = runpy.run_path(str(REPO_ROOT / "mownplow.py"))["main"]
+        cpu_start = time.process_time()
+        elapsed = asyncio.run(
+            run_benchmark(plow_main, config, work / "source", opts)
+        )
+        cpu = time.process_time() - cpu_start
+
+        moved = opts.plots - remaining_plots(work / "source")
+        harvester.terminate()
+
+    dispatched = sum(metrics.values["mownplow_dispatched_plots_total"].values())
+    dispatch_seconds = sum(metrics.values["mownplow_dispatch_seconds_total"].values())
+    results = {
+        "dests": opts.dests,
+        "plots": opts.plots,
+        "transfer": opts.transfer,
+        "plots_moved": moved,
+        "elapsed_s": round(elapsed, 2),
+        "plots_per_hour": round(moved / elapsed * 3600) if elapsed else 0,
+        "dispatch_latency_ms": (
+            round(dispatch_seconds / dispatched * 1000, 2) if dispatched else None
+        ),
+        "ssh_commands": counters[0],
+        "ssh_commands_per_plot": round(counters[0] / moved, 3) if moved else None,
+        "harvester_rpcs": counters[1],
+        "event_loop_cpu_pct": round(cpu / elapsed * 100, 1) if elapsed else 0,
+        "cpu_ms_per_plot": round(cpu / moved * 1000, 2) if moved else None,
+    }
+    for name, value in results.items():
+        print(f"{name:24} {value}")
+    if opts.output:
+        with open(opts.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
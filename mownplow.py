@@ -14,301 +14,453 @@ xch1vlnelz9ef43z3xa4x6a3zzfm7cezwvmq332p97xlflmxxcgzdrpsqamyee
 """
 import asyncio
 import logging
-import queue
-from datetime import datetime
+import signal
 from pathlib import Path
 
 import aiohttp
-import aionotify
 import asyncssh
+import yaml
 
-from mownplow.config import Config
+from mownplow.backpressure import backpressure
+from mownplow.config import Config, ConfigError, DestHost
 from mownplow.harvester import HarvesterCert, HarvesterRequest
-from mownplow.destman import DestMan
+from mownplow.journal import Journal
+from mownplow.destfs import AgentFS, DestFS, LocalFS, ShellFS, agent_command
+from mownplow.governor import Governor
+from mownplow.metrics import metrics
+from mownplow.plow import plow
 from mownplow.scheduler import PlowScheduler
-from mownplow.ssh import SSHClient
-
-#####
-# System variables - don't change unless you know what you are doing.
-#####
-# Short & long sleep durations upon various error conditions
-SLEEP_FOR = 60 * 3
-SLEEP_FOR_LONG = 60 * 20
+from mownplow.sources import SourceIndex
+from mownplow.trace import tracer
+from mownplow.ssh import SSHPool
+from mownplow.transport import create_transport
 
 #####
 # Utility functions / classes
 #####
 
 
-async def get_dest_dirs(config: Config) -> list:
-    dest_dirs = config.dest_dirs
-
-    if config.dest_dirs is None or not config.dest_dirs:
-        dest_dirs = []
-        ssh_conn = SSHClient(
-            config.dest_host, config.dest_username, config.ssh_private_key_path
-        )
-        await ssh_conn.connect()
+async def get_dest_dirs(
+    host: DestHost, fs: DestFS, journal: Journal = None, journalled: bool = False
+) -> list:
+    dest_dirs = host.dest_dirs
 
-        logging.debug(f"Destination root: {config.dest_root}")
-        dest_mounts_scr = (
-            "mount | grep " + config.dest_root + " | awk '{ print $3 }' | sort"
-        )
+    if host.discover_dirs:
+        # Take the list from the last discovery unless it is being redone
+        if journalled and journal is not None:
+            dest_dirs = journal.dest_dirs(host.dest_host, host.dest_root)
+            if dest_dirs:
+                logging.debug(f"Journalled destinations on {host.dest_host}")
+                host.update_dest_dirs(dest_dirs)
+                return dest_dirs
 
-        remote_result = await ssh_conn.run_command(dest_mounts_scr)
-        if remote_result.returncode != 0:
-            logging.error(
-                f"⁉️  {dest_mounts_scr!r} exited with {remote_result.returncode}"
-            )
+        dest_dirs = []
+        logging.debug(f"Destination root: {host.dest_host}:{host.dest_root}")
+        dest_candidates = await fs.discover(host.dest_root)
+        if not dest_candidates:
             return dest_dirs
-
-        dest_candidates = remote_result.stdout.splitlines()
-        logging.info(f"Found destination mounts:\n {dest_candidates}")
+        logging.debug(f"Found destination mounts:\n {dest_candidates}")
 
         for dest_dir in dest_candidates:
             logging.debug(f"Evaluating {dest_dir}")
             dest_dirs.append(Path(dest_dir).name)
 
         dest_dirs.sort()
-        config.update_dest_dirs(dest_dirs)
-        await ssh_conn.close()
+        if journal is not None:
+            journal.save_dest_dirs(host.dest_host, host.dest_root, dest_dirs)
+        host.update_dest_dirs(dest_dirs)
 
     return dest_dirs
 
 
-#####
-# This is where the magic happens
-#####
-async def plotfinder(paths: list, plot_queue: queue, loop):
-    for path in paths:
-        for plot in Path(path).glob("**/*.plot"):
-            await plot_queue.put(plot)
-    await plotwatcher(paths, plot_queue, loop)
-
-
-async def plotwatcher(paths: list, plot_queue: queue, loop):
-    watcher = aionotify.Watcher()
-    for path in paths:
-        if not Path(path).exists():
-            logging.info(f"! Path does not exist: {path}")
-            continue
-        watcher.watch(
-            alias=path,
-            path=path,
-            flags=aionotify.Flags.MOVED_TO,
-        )
-        logging.info(f"Watching {path}")
-    await watcher.setup(loop)
-    while True:
-        event = await watcher.get_event()
-        logging.info(event)
-        if event.name.endswith(".plot"):
-            plot_path = Path(event.alias) / event.name
-            await plot_queue.put(plot_path)
-            await asyncio.sleep(0)
-
-
-async def plow(
-    config: Config, dest_dir, plot_queue, dest_schedule, harvester_cert, loop
-):
-    # Plow initialisation
-    ssh_conn = SSHClient(
-        config.dest_host, config.dest_username, config.ssh_private_key_path
-    )
-    await ssh_conn.connect()
-
-    destman = DestMan(config, dest_dir, ssh_conn)
-    if not await destman.init_scripts():
-        logging.info(f"Unable to initialise scripts for {dest_dir}")
-        return
-
-    harvester_req = None
-    if not config.farm_during_plow:
-        harvester_req = HarvesterRequest(
-            config.harvester_host, config.harvester_port, harvester_cert
+async def connect_host(config: Config, host: DestHost, journal: Journal = None):
+    if host.dest_local:
+        fs = LocalFS()
+    else:
+        # One pool of SSH connections per host shared by discovery and its workers
+        ssh_conn = SSHPool(
+            host.dest_host,
+            host.dest_username,
+            config.ssh_private_key_path,
+            config.ssh_port,
+            config.ssh_max_connections,
+            config.ssh_max_sessions,
+            config.ssh_known_hosts,
         )
-
-    currently_farming_dest = not config.farm_during_plow
-    incremental_remove = config.replot
-
-    # Work loop
-    logging.info(f"🧑‍🌾 plowing to {destman.dest}")
-    while True:
-        try:
-            logging.debug(f"{destman.dest} waiting for plot")
-            plot = await plot_queue.get()
-
-            current_priority = dest_schedule.get_current_priority()
-            logging.debug(f"Current dest priority: {current_priority}")
-            if current_priority == dest_dir:
-                dest_schedule.remove_current_priority()
-
-                plot_size = plot.stat().st_size
-                plot_size_KB = int((plot_size) / (1024))
-
-                # Remove from farm only when actually starting
-                # to plow to this destination
-                if currently_farming_dest:
-                    logging.info(f"Removing {destman.virtual_dest} from farming")
-                    await harvester_req.remove_plot_directory(destman.virtual_dest)
-                    currently_farming_dest = False
-
-                if incremental_remove and config.remove_all_replots:
-                    # await asyncio.sleep(0)
-                    logging.info(f"Removing all matching replots on {destman.dest}")
-                    remove_success = await destman.remove_all_replots()
-                    if not remove_success:
-                        await plot_queue.put(plot)
-                        break
-                    incremental_remove = False
-                    await asyncio.sleep(5)
-
-                if incremental_remove:
-                    remove_success = await destman.remove_next_replot(plot_size_KB)
-                    if not remove_success:
-                        await plot_queue.put(plot)
-                        break
-
-                await asyncio.sleep(0)
-
-                # Treat all destinations as remote (even if local)
-                dest_free = await destman.get_dest_free_space()
-                if not dest_free:
-                    await plot_queue.put(plot)
-                    break
-
-                if dest_free > plot_size_KB:
-                    logging.info(
-                        f"✅ Destination {destman.dest} has {int(dest_free/(1024*1024))}GiB free"
-                    )
-                else:
-                    logging.info(f"❎ Destination {destman.dest} is full")
-                    await plot_queue.put(plot)
-                    # Just quit the worker entirely for this destination.
-                    break
-
-                logging.info(
-                    f"🚜 {plot} ➡️  {destman.dest} - {int(plot_size_KB/(1024*1024))}GiB"
-                )
-                rsync_cmd = (
-                    f"{config.rsync_cmd} {config.rsync_flags} {plot} {destman.dest}"
-                )
-
-                # Now rsync the real plot
-                proc = await asyncio.create_subprocess_shell(
-                    rsync_cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
+        await ssh_conn.connect()
+        fs = ShellFS(ssh_conn)
+        if host.dest_agent:
+            agent_fs = AgentFS(ssh_conn, agent_command(host.dest_agent))
+            try:
+                await agent_fs.start()
+                fs = agent_fs
+            except (OSError, asyncssh.Error) as e:
+                logging.warning(
+                    f"⁉️  Unable to start the agent on {host.dest_host}, "
+                    + f"falling back to shell commands: {e}"
                 )
-                start = datetime.now()
-                stdout, stderr = await proc.communicate()
-                finish = datetime.now()
-
-                if proc.returncode == 0:
-                    logging.info(f"🏁 {rsync_cmd} ({finish - start})")
-                    logging.debug(f"Adding {dest_dir} back to schedule")
-                    dest_schedule.add_dest_to_q(dest_dir)
-                    await asyncio.sleep(1)
-                elif proc.returncode == 10:  # Error in socket I/O
-                    # Retry later.
-                    logging.warning(
-                        f"⁉️ {rsync_cmd!r} exited with {proc.returncode} (error in socket I/O)"
-                    )
-                    await plot_queue.put(plot)
-                    await asyncio.sleep(SLEEP_FOR_LONG)
-                elif proc.returncode in (11, 23):  # Error in file I/O
-                    # Most likely a full drive.
-                    logging.error(
-                        f"⁉️ {rsync_cmd!r} exited with {proc.returncode} (error in file I/O)"
-                    )
-                    dest_schedule.rem_dest_from_priorities(dest_dir)
-                    await plot_queue.put(plot)
-                    logging.error(f"{destman.dest} plow exiting")
-                    break
-                else:
-                    logging.info(f"⁉️ {rsync_cmd!r} exited with {proc.returncode}")
-                    await asyncio.sleep(SLEEP_FOR)
-                    dest_schedule.rem_dest_from_priorities(dest_dir)
-                    await plot_queue.put(plot)
-                    logging.error(f"{destman.dest} plow exiting")
-                    break
-                if stdout:
-                    output = stdout.decode().strip()
-                    if output:
-                        logging.info(f"{stdout.decode()}")
-                if stderr:
-                    logging.warning(f"⁉️ {stderr.decode()}")
-            else:
-                # logging.info(f"Skipping {dest} for now")
-                await plot_queue.put(plot)
-                await asyncio.sleep(5)
-
-        except Exception as e:
-            logging.error(f"! {e}")
 
-    # Sync destination path before completion
-    await destman.sync_dest_mount_path()
-    await asyncio.sleep(5)
-    
-    if not currently_farming_dest:
-        logging.info(f"Adding {destman.virtual_dest} back to farm")
-        await harvester_req.add_plot_directory(destman.virtual_dest)
-        currently_farming_dest = True
-
-    await ssh_conn.close()
-    await asyncio.sleep(5)
-
-
-async def main(config, loop):
-    plot_queue = asyncio.Queue()
-    dest_schedule = PlowScheduler()
-    plow_tasks = []
-
-    harvester_cert = None
-    if not config.farm_during_plow:
+    harvester_req = None
+    # The governor times harvester RPCs even when drives are farmed throughout
+    if not config.farm_during_plow or config.governor:
         harvester_cert = HarvesterCert(
-            config.dest_host,
-            config.dest_username,
-            config.ssh_private_key_path,
-            config.harvester_cacert_path,
-            config.harvester_cert_path,
-            config.harvester_key_path,
+            fs,
+            host.harvester_cacert_path,
+            host.harvester_cert_path,
+            host.harvester_key_path,
+            host.dest_host,
+            journal,
         )
         try:
             await harvester_cert.retrieve_cert_and_key()
         except (OSError, asyncssh.Error) as e:
             raise Exception(f"Failed to retrieve cert and key files: {e}") from e
+        # A single keep-alive HTTPS session shared by the host's workers
+        harvester_req = HarvesterRequest(
+            host.harvester_host,
+            host.harvester_port,
+            harvester_cert,
+            host.harvester_timeout,
+            journal=journal,
+        )
 
-    logging.info("🌱 Mow'n'Plow running...")
-
-    create_dests = asyncio.create_task(get_dest_dirs(config))
-    dest_dirs = await create_dests
-    logging.debug(f"Destinations: {dest_dirs}")
+    return fs, harvester_req
+
+
+class Plower:
+    # The hosts and their destination workers, started and stopped as drives
+    # come and go and the config file is reloaded
+
+    def __init__(self, config, plot_queue, dest_schedule, journal, loop):
+        self.config = config
+        self.plot_queue = plot_queue
+        self.dest_schedule = dest_schedule
+        self.journal = journal
+        self.loop = loop
+
+        # host name -> (host, fs, harvester_req, transport)
+        self.hosts = {}
+        # dest_id -> worker task, and the destinations being retired
+        self.workers = {}
+        self.retiring = set()
+        # Destinations whose workers have finished (full or failed to start),
+        # only restarted after a reload or once their mount has come and gone
+        self.finished = set()
+        # Every host connection, closed on exit
+        self.connections = []
+        # host name -> (governor, its task)
+        self.governors = {}
+        self.running = False
+
+        self.wake = asyncio.Event()
+        self.reload_requested = False
+        # Hosts started from a journalled list of destinations which turned
+        # out to be out of date, to be discovered again
+        self.stale_hosts = set()
+
+    async def add_host(self, host: DestHost):
+        fs, harvester_req = await connect_host(self.config, host, self.journal)
+        self.connections.append((fs, harvester_req))
+        transport = create_transport(self.config, host)
+        self.hosts[host.dest_host] = (host, fs, harvester_req, transport)
+        self.dest_schedule.add_host(
+            host.dest_host, host.priority, host.max_transfers, host.bwlimit
+        )
+        await self.refresh_host(host.dest_host, journalled=True)
+        if self.config.governor:
+            governor = Governor(
+                host,
+                harvester_req,
+                self.dest_schedule,
+                self.config.governor_target_latency,
+                self.config.governor_interval,
+                self.config.governor_min_bwlimit,
+                self.config.governor_max_bwlimit,
+            )
+            self.governors[host.dest_host] = (
+                governor,
+                asyncio.create_task(governor.run()),
+            )
 
-    # Watch for new plots
-    plow_tasks.append(asyncio.create_task(plotfinder(config.sources, plot_queue, loop)))
+    async def refresh_host(self, host_name: str, journalled: bool = False):
+        # Start workers for new destinations and retire those which have gone
+        host, fs, harvester_req, transport = self.hosts[host_name]
+        dest_dirs = await get_dest_dirs(host, fs, self.journal, journalled)
+        if not dest_dirs and host.discover_dirs:
+            # Most likely a failed lookup rather than every drive removed
+            logging.warning(f"⁉️  No destinations found on {host_name}")
+            return
+        logging.debug(f"Destinations on {host_name}: {dest_dirs}")
+
+        current = {f"{host_name}/{dest_dir}" for dest_dir in dest_dirs}
+        for dest_id in list(self.workers):
+            if (
+                self.dest_schedule.dest_hosts.get(dest_id) == host_name
+                and dest_id not in current
+                and dest_id not in self.retiring
+            ):
+                logging.info(f"➖ Retiring {dest_id}")
+                self.retiring.add(dest_id)
+                self.dest_schedule.retire(dest_id)
+        # A mount which has gone may come back with a different drive
+        self.finished = {
+            dest_id
+            for dest_id in self.finished
+            if dest_id in current or not dest_id.startswith(f"{host_name}/")
+        }
+
+        # New destinations go after the existing ones
+        priority = 1 + max(
+            (
+                priority
+                for dest_id, priority in self.dest_schedule.dest_priorities.items()
+                if self.dest_schedule.dest_hosts.get(dest_id) == host_name
+            ),
+            default=0,
+        )
+        for dest_dir in dest_dirs:
+            dest_id = f"{host_name}/{dest_dir}"
+            if dest_id in self.workers or dest_id in self.finished:
+                continue
+            if self.running:
+                logging.info(f"➕ New destination {dest_id}")
+            self.dest_schedule.add_dest_priority(dest_id, priority, host_name)
+            priority += 1
+            worker = asyncio.create_task(
+                plow(
+                    self.config,
+                    host,
+                    dest_dir,
+                    self.plot_queue,
+                    self.dest_schedule,
+                    fs,
+                    harvester_req,
+                    transport,
+                    self.journal,
+                    self.loop,
+                )
+            )
+            worker.add_done_callback(
+                lambda _, dest_id=dest_id: self._worker_done(dest_id)
+            )
+            self.workers[dest_id] = worker
+            await asyncio.sleep(0)
 
-    # Fire up a worker for each destination
-    priority = 1
-    for dest_dir in dest_dirs:
-        dest_schedule.add_dest_priority(dest_dir, priority)
-        plow_tasks.append(
-            asyncio.create_task(
-                plow(config, dest_dir, plot_queue, dest_schedule, harvester_cert, loop)
+    def _worker_done(self, dest_id: str):
+        self.workers.pop(dest_id, None)
+        if dest_id in self.retiring:
+            self.retiring.discard(dest_id)
+        else:
+            self.finished.add(dest_id)
+        # A drive which failed forgets its host's journalled destinations
+        host_name = dest_id.partition("/")[0]
+        if (
+            self.journal is not None
+            and host_name in self.hosts
+            and self.hosts[host_name][0].discover_dirs
+            and self.journal.dest_dirs(host_name, self.hosts[host_name][0].dest_root)
+            is None
+        ):
+            self.stale_hosts.add(host_name)
+        self.wake.set()
+
+    async def rediscover(self):
+        for host_name in list(self.hosts):
+            try:
+                await self.refresh_host(host_name)
+            except Exception as e:
+                logging.error(f"! Rediscovery on {host_name} failed: {e}")
+
+    async def has_room(self, dest_id: str) -> bool:
+        # Whether a finished destination could take the smallest plot seen
+        host_name, _, dest_dir = dest_id.partition("/")
+        if host_name not in self.hosts:
+            return False
+        min_plot_size_KB = self.dest_schedule.min_plot_size_KB
+        if min_plot_size_KB is None:
+            return True
+        host, fs = self.hosts[host_name][:2]
+        mount_path = await fs.mount_path(host.dest_root, dest_dir)
+        if not mount_path:
+            return False
+        free_KB = await fs.free_space(mount_path)
+        return free_KB is not None and free_KB >= min_plot_size_KB
+
+    async def reload(self):
+        logging.info(f"🔄 Reloading {self.config.path}")
+        replot_before = self.config.replot_before
+        try:
+            fresh = self.config.reload()
+        except (OSError, KeyError, TypeError, ConfigError, yaml.YAMLError) as e:
+            logging.error(f"! Unable to reload {self.config.path}: {e}")
+            return
+        logging.getLogger().setLevel(self.config.logging)
+        self.dest_schedule.max_transfers = self.config.max_transfers
+        self.dest_schedule.max_per_source = self.config.max_per_source
+        self.dest_schedule.placement = self.config.placement
+        # Restart finished drives which have been given more room (or, with
+        # a new ReplotBefore, may have more replots to make room with).  The
+        # rest stay finished rather than each being taken off the harvester
+        # only to be found full again.
+        if self.config.replot and self.config.replot_before != replot_before:
+            self.finished.clear()
+        else:
+            self.finished = {
+                dest_id
+                for dest_id in self.finished
+                if not await self.has_room(dest_id)
+            }
+
+        fresh_hosts = {host.dest_host: host for host in fresh.hosts}
+        for host_name in list(self.hosts):
+            if host_name not in fresh_hosts:
+                # Retire the host's destinations, its connection is kept
+                # until exit for any transfers still in flight
+                logging.info(f"➖ Retiring host {host_name}")
+                host = self.hosts.pop(host_name)[0]
+                for dest_id, dest_host in self.dest_schedule.dest_hosts.items():
+                    if (
+                        dest_host == host_name
+                        and dest_id in self.workers
+                        and dest_id not in self.retiring
+                    ):
+                        self.retiring.add(dest_id)
+                        self.dest_schedule.retire(dest_id)
+                self.config.hosts.remove(host)
+                continue
+            host = self.hosts[host_name][0]
+            fresh_host = fresh_hosts[host_name]
+            limits_changed = (fresh_host.max_transfers, fresh_host.bwlimit) != (
+                host.max_transfers,
+                host.bwlimit,
             )
-        )
+            host.reload(fresh_host)
+            self.dest_schedule.set_host_priority(host_name, host.priority)
+            if not limits_changed:
+                # Leave the limits as they are (possibly set by its governor)
+                continue
+            if host_name in self.governors:
+                # The governor carries on within the new ceilings
+                self.governors[host_name][0].set_ceilings(host)
+                self.governors[host_name][0].apply()
+            else:
+                self.dest_schedule.set_host_limits(
+                    host_name, host.max_transfers, host.bwlimit
+                )
+        for host_name, host in fresh_hosts.items():
+            if host_name in self.hosts:
+                continue
+            logging.info(f"➕ New host {host_name}")
+            try:
+                await self.add_host(host)
+                self.config.hosts.append(host)
+            except Exception as e:
+                logging.error(f"! Unable to add {host_name}: {e}")
+        await self.rediscover()
+        self.dest_schedule.changed.set()
+
+    def request_reload(self):
+        self.reload_requested = True
+        self.wake.set()
+
+    async def run(self):
+        # Until every destination is finished, rediscovering every
+        # RediscoverInterval seconds (when set, waiting for new drives) and
+        # reloading on request
+        self.running = True
+        while self.workers or self.stale_hosts or self.config.rediscover_interval:
+            if self.stale_hosts:
+                stale_hosts, self.stale_hosts = self.stale_hosts, set()
+                # Drives whose mounts were forgotten are looked up again
+                self.finished = {
+                    dest_id
+                    for dest_id in self.finished
+                    if dest_id.partition("/")[0] not in stale_hosts
+                    or self.journal.mount_path(dest_id)
+                }
+                for host_name in stale_hosts:
+                    try:
+                        await self.refresh_host(host_name)
+                    except Exception as e:
+                        logging.error(f"! Rediscovery on {host_name} failed: {e}")
+                continue
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(
+                    self.wake.wait(), self.config.rediscover_interval or None
+                )
+            except asyncio.TimeoutError:
+                await self.rediscover()
+                continue
+            if self.reload_requested:
+                self.reload_requested = False
+                await self.reload()
+
+    async def close(self):
+        for task in list(self.workers.values()) + [
+            task for _, task in self.governors.values()
+        ]:
+            task.cancel()
         await asyncio.sleep(0.5)
-        priority = priority + 1
+        for fs, harvester_req in self.connections:
+            await fs.close()
+            if harvester_req is not None:
+                await harvester_req.close()
 
-    # Once all of the destinations are complete (probably full) then
-    # plotfinder is the last task running
-    while len(plow_tasks) > 1:
-        done, plow_tasks = await asyncio.wait(
-            plow_tasks, return_when=asyncio.FIRST_COMPLETED
-        )
 
-    plow_tasks.pop().cancel()
-    await asyncio.sleep(0.5)
+async def main(config, loop):
+    plot_queue = asyncio.Queue()
+    dest_schedule = PlowScheduler(
+        config.max_transfers, config.max_per_source, config.placement
+    )
+
+    journal = None
+    if config.journal_path:
+        journal = Journal(config.journal_path)
+        # Send interrupted transfers back to where they left off
+        for plot, dest_id in journal.transfers().items():
+            if Path(plot).exists():
+                dest_schedule.prefer(Path(plot), dest_id)
+            else:
+                journal.end_transfer(plot)
+
+    if config.metrics_port:
+        metrics_runner = await metrics.serve(config.metrics_host, config.metrics_port)
+    if config.backpressure_socket:
+        await backpressure.serve(config.backpressure_socket)
+    if config.trace_path:
+        tracer.open(config.trace_path)
+
+    # Watch for new plots and hand them out to the destination workers
+    source_index = SourceIndex(config.sources, plot_queue, dest_schedule.discard)
+    background = [
+        asyncio.create_task(source_index.run(loop)),
+        asyncio.create_task(dest_schedule.dispatch(plot_queue)),
+    ]
+
+    plower = Plower(config, plot_queue, dest_schedule, journal, loop)
+    try:
+        # Fire up a worker for each destination on each host
+        await asyncio.gather(*(plower.add_host(host) for host in config.hosts))
+        logging.info("🌱 Mow'n'Plow running...")
+
+        # Reload the config file (and look for new drives) on SIGHUP
+        loop.add_signal_handler(signal.SIGHUP, plower.request_reload)
+
+        # Once all of the destinations are complete (probably full) only the
+        # source index and the dispatcher are left running
+        await plower.run()
+    finally:
+        loop.remove_signal_handler(signal.SIGHUP)
+        for task in background:
+            task.cancel()
+        await plower.close()
+        if config.metrics_port:
+            await metrics_runner.cleanup()
+        await backpressure.close()
+        tracer.close()
+        if journal is not None:
+            journal.close()
 
     logging.info("🌱 Plow destinations complete...")
 
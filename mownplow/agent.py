@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Mow'n'Plow harvester agent.
+
+A small resident agent for the harvester which answers the plower's
+filesystem calls (mounts, free space, listings, removals and flushes)
+with system calls rather than shell pipelines.  The plower starts it
+over SSH (Dest: Agent: True) or, when installed on the harvester, runs
+the command given as Dest: Agent.  Requests and replies are one JSON
+object per line on stdin/stdout:
+
+    {"id": 1, "method": "free_space", "params": {"path": "/plots/d0"}}
+    {"id": 1, "result": 1234}  or  {"id": 1, "error": "..."}
+
+Calls are handled concurrently so replies may arrive out of order.  The
+same functions serve destinations on the plotter itself (LocalFS).
+
+Only uses the standard library so it can be copied to the harvester and
+run as: python3 agent.py
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+import base64
+import ctypes
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Calls handled at once, so that a long listing doesn't hold up free
+# space checks on other drives
+WORKERS = 8
+
+MOUNT_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+try:
+    _syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (OSError, AttributeError):
+    _syncfs = None
+
+
+def mounts() -> list:
+    # (device, mount point, type, options) for each mount
+    with open("/proc/self/mounts") as mount_table:
+        # Undo the kernel's octal escapes (\040 for a space)
+        return [
+            tuple(
+                MOUNT_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+                for field in line.split()[:4]
+            )
+            for line in mount_table
+        ]
+
+
+def _matching(pattern: str) -> list:
+    # Mount points whose mount table entry matches, as ShellFS picks them
+    # with mount | grep
+    return [mount[1] for mount in mounts() if re.search(pattern, " ".join(mount))]
+
+
+def discover(dest_root: str) -> list:
+    # Mount points whose entry mentions dest_root (mount | grep dest_root)
+    return sorted(_matching(re.escape(dest_root)))
+
+
+def mount_path(dest_root: str, dest_dir: str) -> str:
+    # The mount for dest_dir below dest_root (mount | grep dest_root | grep
+    # -w dest_dir), or the directory itself when it isn't a mount point of
+    # its own (None if neither exists)
+    word = r"(?<![A-Za-z0-9_])" + re.escape(dest_dir) + r"(?![A-Za-z0-9_])"
+    for mount in _matching(re.escape(dest_root)):
+        if re.search(word, mount):
+            return mount
+    path = os.path.join(dest_root, dest_dir)
+    return path if os.path.isdir(path) else None
+
+
+def free_space(path: str) -> int:
+    # Available KB
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize // 1024
+
+
+def scan(path: str) -> dict:
+    # path -> (mtime, size) for every file below path
+    files = {}
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files[entry.path] = (stat.st_mtime, stat.st_size)
+    return files
+
+
+def replot_cutoff(replot_before: str) -> float:
+    # Seconds since the epoch in this machine's local time, parsed by date -d
+    # as ShellFS does so that every date it accepts works here too (ISO 8601
+    # only where there is no date command)
+    try:
+        result = subprocess.run(
+            ["date", "-d", replot_before, "+%s"], capture_output=True, text=True
+        )
+    except FileNotFoundError:
+        return datetime.fromisoformat(replot_before).timestamp()
+    if result.returncode != 0:
+        raise ValueError(result.stderr.strip() or f"Invalid date {replot_before!r}")
+    return float(result.stdout)
+
+
+def listing(path: str) -> dict:
+    # The plower parses ReplotBefore once (replot_cutoff) rather than with
+    # every listing
+    return scan(path)
+
+
+def sync(path: str) -> bool:
+    # Flush just the filesystem holding path (sync -f) where possible
+    if _syncfs is None:
+        os.sync()
+        return True
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        return _syncfs(fd) == 0
+    finally:
+        os.close(fd)
+
+
+def remove(mount_path: str, paths: list) -> dict:
+    # Remove the files then flush the filesystem once, reporting success
+    # per file (a file which has already gone counts as removed)
+    report = {}
+    for path in paths:
+        try:
+            os.unlink(path)
+            report[path] = True
+        except FileNotFoundError:
+            report[path] = True
+        except OSError:
+            report[path] = False
+    sync(mount_path)
+    return report
+
+
+def read_file(path: str) -> str:
+    with open(path, "rb") as file:
+        return base64.b64encode(file.read()).decode()
+
+
+METHODS = {
+    "discover": discover,
+    "mount_path": mount_path,
+    "free_space": free_space,
+    "listing": listing,
+    "replot_cutoff": replot_cutoff,
+    "remove": remove,
+    "sync": sync,
+    "read_file": read_file,
+}
+
+
+def handle(line: str, reply):
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return
+    try:
+        result = METHODS[request["method"]](**request.get("params", {}))
+        reply({"id": request.get("id"), "result": result})
+    except Exception as e:
+        reply({"id": request.get("id"), "error": f"{type(e).__name__}: {e}"})
+
+
+def main():
+    lock = threading.Lock()
+
+    def reply(message: dict):
+        data = json.dumps(message) + "\n"
+        with lock:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+
+    with ThreadPoolExecutor(WORKERS) as pool:
+        for line in sys.stdin:
+            pool.submit(handle, line, reply)
+
+
+if __name__ == "__main__":
+    main()
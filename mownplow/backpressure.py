@@ -0,0 +1,81 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+
+class Backpressure:
+    """
+    Unix socket which tells plotters (bb_wrapper) about their plots.
+
+    Every connected client receives one JSON object per line:
+
+        {"event": "started", "plot": ..., "source": ..., "bytes": ...}
+        {"event": "removed", "plot": ..., "source": ..., "bytes": ...}
+        {"event": "failed", "plot": ..., "source": ..., "bytes": ...}
+
+    "started" means the bytes are expected to be freed from the source
+    once the transfer completes, "removed" that they have been.  A new
+    client is first sent a "started" event for every transfer in flight.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        # plot -> event for transfers in flight
+        self.in_flight = {}
+        self.server = None
+
+    async def serve(self, path: str) -> asyncio.AbstractServer:
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self._handle, path)
+        logging.info(f"🔌 Backpressure events on {path}")
+        return self.server
+
+    async def close(self):
+        for writer in list(self.clients):
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        for event in self.in_flight.values():
+            writer.write(self._encode(event))
+        self.clients.add(writer)
+        try:
+            # Clients don't send anything, this just notices them leaving
+            await reader.read()
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def _encode(self, event: dict) -> bytes:
+        return json.dumps(event).encode() + b"\n"
+
+    def publish(self, event: str, plot: Path, size: int):
+        message = {
+            "event": event,
+            "plot": str(plot),
+            "source": str(plot.parent),
+            "bytes": size,
+            "time": time.time(),
+        }
+        if event == "started":
+            self.in_flight[str(plot)] = message
+        else:
+            self.in_flight.pop(str(plot), None)
+        if not self.clients:
+            return
+        data = self._encode(message)
+        for writer in list(self.clients):
+            if writer.is_closing():
+                self.clients.discard(writer)
+                continue
+            writer.write(data)
+
+
+backpressure = Backpressure()
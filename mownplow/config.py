@@ -3,28 +3,99 @@ import random
 import yaml
 
 
+class ConfigError(Exception):
+    pass
+
+
+class DestHost:
+    # A harvester host together with its drives and link limits
+
+    def __init__(self, dest: dict, harvester: dict, index: int, shuffle: bool):
+        # Destination
+        self.dest_host = dest["Host"]
+        self.dest_username = dest["Username"]
+        self.dest_protocol = dest["Protocol"]
+        self.dest_port = dest["Port"]
+        self.dest_root = dest["Root"]
+        self.dest_dirs = dest.get("Dirs")
+        # Mounts below the root are discovered (and rediscovered) unless listed
+        self.discover_dirs = not self.dest_dirs
+        # Destinations on this machine are handled without SSH or rsync, only
+        # when asked for as Root is then a path rather than an rsync module
+        self.dest_local = dest.get("Local", False)
+        # Resident agent answering filesystem calls on the harvester: True to
+        # start this copy over SSH or the command of an installed one
+        self.dest_agent = dest.get("Agent", False)
+        self.priority = dest.get("Priority", index + 1)
+        self.max_transfers = dest.get("MaxTransfers", 0)
+        self.bwlimit = dest.get("BwLimit", 0)
+
+        # Harvester
+        self.harvester_host = harvester["Host"]
+        self.harvester_port = harvester["Port"]
+        self.harvester_cacert_path = harvester["CACertPath"]
+        self.harvester_cert_path = harvester["CertPath"]
+        self.harvester_key_path = harvester["KeyPath"]
+        self.harvester_timeout = harvester.get("Timeout", 30)
+
+        # Shuffle destinations if requested
+        self.plow_shuffle = shuffle
+        if self.plow_shuffle and self.dest_dirs:
+            random.shuffle(self.dest_dirs)
+
+    def update_dest_dirs(self, dest_dirs=None):
+        if dest_dirs is not None:
+            if self.plow_shuffle:
+                random.shuffle(dest_dirs)
+            self.dest_dirs = dest_dirs
+
+    def reload(self, fresh: "DestHost"):
+        # Take the settings which can change while running from a re-read
+        # of the config file
+        self.priority = fresh.priority
+        self.max_transfers = fresh.max_transfers
+        self.bwlimit = fresh.bwlimit
+        self.discover_dirs = fresh.discover_dirs
+        if not fresh.discover_dirs:
+            self.dest_dirs = fresh.dest_dirs
+
+
+# Settings which take effect when the config file is reloaded (SIGHUP),
+# everything else needs a restart
+RELOADABLE = (
+    "replot_before",
+    "readd_after",
+    "max_transfers",
+    "max_per_source",
+    "placement",
+    "rediscover_interval",
+    "logging",
+)
+
+
 class Config:
     def __init__(self, config_file: str) -> None:
+        self.path = config_file
         with open(config_file, "r") as file:
             config = yaml.safe_load(file)
 
         # Sources
         self.sources = config["Sources"]
 
-        # Destination
-        self.dest_host = config["Dest"]["Host"]
-        self.dest_username = config["Dest"]["Username"]
-        self.dest_protocol = config["Dest"]["Protocol"]
-        self.dest_port = config["Dest"]["Port"]
-        self.dest_root = config["Dest"]["Root"]
-        self.dest_dirs = config["Dest"].get("Dirs")
-
         # Options:
         self.replot = config["PlowOptions"].get("Replot", False)
         self.replot_before = config["PlowOptions"].get("ReplotBefore")
         self.remove_all_replots = config["PlowOptions"].get("RemoveAllAtStart", False)
         self.farm_during_plow = config["PlowOptions"].get("FarmDuring", False)
         self.plow_shuffle = config["PlowOptions"].get("Shuffle", False)
+        self.max_transfers = config["PlowOptions"].get("MaxTransfers", 0)
+        self.max_per_source = config["PlowOptions"].get("MaxPerSource", 0)
+        self.space_check_interval = config["PlowOptions"].get(
+            "SpaceCheckInterval", 600
+        )
+        self.placement = config["PlowOptions"].get("Placement", "priority")
+        self.readd_after = config["PlowOptions"].get("ReaddAfter", 0)
+        self.rediscover_interval = config["PlowOptions"].get("RediscoverInterval", 0)
 
         # Rsync
         self.rsync_cmd = config["Rsync"].get("Cmd", "rsync")
@@ -33,28 +104,74 @@ class Config:
             "--remove-source-files --preallocate --whole-file --skip-compress=plot --sync"
         )
 
+        # Transfer engine
+        transfer = config.get("Transfer") or {}
+        self.transfer_engine = transfer.get("Engine", "rsync")
+        self.transfer_port = transfer.get("Port", 12001)
+        # Shared with the harvesters' receivers
+        self.transfer_token = transfer.get("Token", "")
+        if self.transfer_engine == "sendfile" and not self.transfer_token:
+            raise ConfigError("Transfer: Token is required by the sendfile engine")
+
         # SSH
         self.ssh_private_key_path = config["SSH"].get(
             "Private_Key_Path", "/home/chia/.ssh/id_ed25519"
         )
         self.ssh_port = config["SSH"].get("Port", 22)
+        self.ssh_max_connections = config["SSH"].get("MaxConnections", 4)
+        self.ssh_max_sessions = config["SSH"].get("MaxSessions", 8)
+        self.ssh_known_hosts = config["SSH"].get("KnownHosts")
 
-        # Harvester
-        self.harvester_host = config["Harvester"]["Host"]
-        self.harvester_port = config["Harvester"]["Port"]
-        self.harvester_cacert_path = config["Harvester"]["CACertPath"]
-        self.harvester_cert_path = config["Harvester"]["CertPath"]
-        self.harvester_key_path = config["Harvester"]["KeyPath"]
+        # Destination hosts and their harvesters.  Either may be a single entry
+        # or a list, harvesters are matched to destinations by position.
+        dests = config["Dest"]
+        if isinstance(dests, dict):
+            dests = [dests]
+        harvesters = config["Harvester"]
+        if isinstance(harvesters, dict):
+            harvesters = [harvesters] * len(dests)
+        elif len(harvesters) != len(dests):
+            raise ConfigError(
+                f"{len(dests)} Dest hosts but {len(harvesters)} Harvesters, "
+                + "give one Harvester per Dest (or a single one for all)"
+            )
+        self.hosts = [
+            DestHost(dest, harvester, index, self.plow_shuffle)
+            for index, (dest, harvester) in enumerate(zip(dests, harvesters))
+        ]
+
+        # Journal (empty to disable)
+        journal = config.get("Journal") or {}
+        self.journal_path = journal.get("Path", "mownplow.db")
+
+        # Events for plotters sharing the source drives (empty to disable)
+        backpressure = config.get("Backpressure") or {}
+        self.backpressure_socket = backpressure.get("Socket", "")
+
+        # Bandwidth and concurrency adapted to harvester latency (off by default)
+        governor = config.get("Governor") or {}
+        self.governor = governor.get("Enabled", False)
+        self.governor_target_latency = governor.get("TargetLatency", 0.5)
+        self.governor_interval = governor.get("Interval", 10)
+        self.governor_min_bwlimit = governor.get("MinBwLimit", 10000)
+        self.governor_max_bwlimit = governor.get("MaxBwLimit", 1250000)
+
+        # Per plot stage timings as JSON lines (empty to disable)
+        trace = config.get("Trace") or {}
+        self.trace_path = trace.get("Path", "")
+
+        # Metrics
+        metrics = config.get("Metrics") or {}
+        self.metrics_host = metrics.get("Host", "0.0.0.0")
+        self.metrics_port = metrics.get("Port", 0)
 
         # Logging
         self.logging = config["Logging"].get("Level","INFO")
 
-        # Shuffle destinations if requested
-        if self.plow_shuffle:
-            random.shuffle(self.dest_dirs)
-
-    def update_dest_dirs(self, dest_dirs=None):
-        if dest_dirs is not None:
-            if self.plow_shuffle:
-                random.shuffle(dest_dirs)
-            self.dest_dirs = dest_dirs
+    def reload(self) -> "Config":
+        # Re-read the config file, updating the reloadable settings in place,
+        # and return the new copy for the hosts to be compared against
+        fresh = Config(self.path)
+        for name in RELOADABLE:
+            setattr(self, name, getattr(fresh, name))
+        return fresh
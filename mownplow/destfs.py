@@ -0,0 +1,361 @@
+import asyncio
+import base64
+import json
+import logging
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import asyncssh
+
+from mownplow import agent
+from mownplow.inventory import parse_listing
+from mownplow.ssh import SSHPool
+
+
+class DestFS(ABC):
+    # Filesystem operations on the host holding a set of destinations
+
+    def __init__(self):
+        # ReplotBefore -> its cutoff, so that each value is parsed once
+        self.replot_cutoffs = {}
+
+    @abstractmethod
+    async def discover(self, dest_root: str) -> list:
+        # Mount points below dest_root
+        pass
+
+    @abstractmethod
+    async def mount_path(self, dest_root: str, dest_dir: str) -> str:
+        # Physical mount point of a destination (None on error)
+        pass
+
+    @abstractmethod
+    async def free_space(self, mount_path: str) -> int:
+        # Available KB (None on error)
+        pass
+
+    @abstractmethod
+    async def listing(self, mount_path: str, replot_before: str = None):
+        # (path -> (mtime, size), replot cutoff) for every file (None on error)
+        pass
+
+    @abstractmethod
+    async def remove(self, mount_path: str, paths: list) -> dict:
+        # Remove the files then flush the filesystem, reporting success per file
+        pass
+
+    @abstractmethod
+    async def sync(self, mount_path: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def read_file(self, path: str) -> bytes:
+        pass
+
+    async def parse_date(self, date: str) -> float:
+        # Seconds since the epoch in the host's local time, as date -d gives
+        raise NotImplementedError
+
+    async def replot_cutoff(self, replot_before: str) -> float:
+        # ReplotBefore as parsed on the host, only asking it once (None if it
+        # isn't a date)
+        if replot_before not in self.replot_cutoffs:
+            try:
+                cutoff = await self.parse_date(replot_before)
+            except (OSError, ValueError) as e:
+                logging.error(f"⁉️  Unable to parse ReplotBefore: {e}")
+                return None
+            self.replot_cutoffs[replot_before] = cutoff
+        return self.replot_cutoffs[replot_before]
+
+    async def close(self):
+        pass
+
+
+class ShellFS(DestFS):
+    # Shell commands run over a pool of SSH connections
+
+    def __init__(self, ssh_conn: SSHPool):
+        super().__init__()
+        self.ssh_conn = ssh_conn
+
+    async def discover(self, dest_root: str) -> list:
+        dest_mounts_scr = "mount | grep " + dest_root + " | awk '{ print $3 }' | sort"
+        result = await self.ssh_conn.run_command(dest_mounts_scr)
+        if result.returncode != 0:
+            logging.error(f"⁉️  {dest_mounts_scr!r} exited with {result.returncode}")
+            return []
+        return result.stdout.splitlines()
+
+    async def mount_path(self, dest_root: str, dest_dir: str) -> str:
+        dest_mount_scr = (
+            "mount | grep "
+            + dest_root
+            + " | grep -w "
+            + dest_dir
+            + " | awk '{print $3}'"
+        )
+        result = await self.ssh_conn.run_command(dest_mount_scr)
+        if result.returncode != 0:
+            logging.info(f"⁉️  {dest_mount_scr!r} exited with {result.returncode}")
+            return None
+        return result.stdout.strip()
+
+    async def free_space(self, mount_path: str) -> int:
+        free_space_scr = "df " + mount_path + " | awk 'NR==2{print $4}'"
+        result = await self.ssh_conn.run_command(free_space_scr)
+        if result.returncode != 0:
+            logging.info(f"⁉️  {free_space_scr!r} exited with {result.returncode}")
+            return None
+        return int(result.stdout)
+
+    async def parse_date(self, date: str) -> float:
+        date_scr = "date -d '" + date + "' +%s"
+        result = await self.ssh_conn.run_command(date_scr)
+        if result.returncode != 0:
+            raise ValueError(f"{date_scr!r} exited with {result.returncode}")
+        return float(result.stdout)
+
+    async def listing(self, mount_path: str, replot_before: str = None):
+        # Replot cutoff (as evaluated by the harvester) and a listing of
+        # every file on the drive
+        replot_cutoff = None
+        if replot_before:
+            replot_cutoff = await self.replot_cutoff(replot_before)
+            if replot_cutoff is None:
+                return None
+        inventory_scr = "find " + mount_path + " -type f -printf '%T@ %s %p\\n'"
+        result = await self.ssh_conn.run_command(inventory_scr)
+        if result.returncode != 0:
+            logging.error(f"⁉️  {inventory_scr!r} exited with {result.returncode}")
+            return None
+        return parse_listing(result.stdout), replot_cutoff
+
+    async def remove(self, mount_path: str, paths: list) -> dict:
+        # A single remote invocation followed by one flush
+        remove_files_scr = (
+            'while IFS= read -r f; do rm -- "$f" && echo "0 $f" || echo "1 $f"; done; '
+            + "sync -f "
+            + mount_path
+        )
+        result = await self.ssh_conn.run_command(
+            remove_files_scr, input="\n".join(paths) + "\n"
+        )
+        report = dict.fromkeys(paths, False)
+        for line in result.stdout.splitlines():
+            status, _, path = line.partition(" ")
+            if path in report:
+                report[path] = status == "0"
+        return report
+
+    async def sync(self, mount_path: str) -> bool:
+        result = await self.ssh_conn.run_command("sync -f " + mount_path)
+        return result.returncode == 0
+
+    async def read_file(self, path: str) -> bytes:
+        result = await self.ssh_conn.run_command(f"cat {path}", encoding=None)
+        if result.returncode != 0:
+            raise OSError(f"cat {path} exited with {result.returncode}")
+        return result.stdout
+
+    async def close(self):
+        await self.ssh_conn.close()
+
+
+class LocalFS(DestFS):
+    # Destinations on this machine, using the agent's system calls in a
+    # worker thread
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def discover(self, dest_root: str) -> list:
+        try:
+            return await self._run(agent.discover, dest_root)
+        except OSError as e:
+            logging.error(f"⁉️  Unable to list mounts: {e}")
+            return []
+
+    async def mount_path(self, dest_root: str, dest_dir: str) -> str:
+        try:
+            path = await self._run(agent.mount_path, dest_root, dest_dir)
+        except OSError as e:
+            logging.info(f"⁉️  Unable to find {dest_root}/{dest_dir}: {e}")
+            return None
+        if path is None:
+            logging.info(f"⁉️  {dest_root}/{dest_dir} is not a directory")
+        return path
+
+    async def free_space(self, mount_path: str) -> int:
+        try:
+            return await self._run(agent.free_space, mount_path)
+        except OSError as e:
+            logging.info(f"⁉️  statvfs {mount_path} failed: {e}")
+            return None
+
+    async def parse_date(self, date: str) -> float:
+        return await self._run(agent.replot_cutoff, date)
+
+    async def listing(self, mount_path: str, replot_before: str = None):
+        replot_cutoff = None
+        if replot_before:
+            replot_cutoff = await self.replot_cutoff(replot_before)
+            if replot_cutoff is None:
+                return None
+        try:
+            return await self._run(agent.listing, mount_path), replot_cutoff
+        except OSError as e:
+            logging.error(f"⁉️  Unable to list {mount_path}: {e}")
+            return None
+
+    async def remove(self, mount_path: str, paths: list) -> dict:
+        return await self._run(agent.remove, mount_path, paths)
+
+    async def sync(self, mount_path: str) -> bool:
+        return await self._run(agent.sync, mount_path)
+
+    async def read_file(self, path: str) -> bytes:
+        with open(path, "rb") as file:
+            return file.read()
+
+
+class AgentFS(DestFS):
+    # Calls answered by a resident agent (mownplow/agent.py) on the harvester
+    # over a single SSH channel, without spawning a shell per call
+
+    def __init__(self, ssh_conn: SSHPool, command: str):
+        super().__init__()
+        self.ssh_conn = ssh_conn
+        self.command = command
+        self.process = None
+        self.reader = None
+        self.start_lock = asyncio.Lock()
+        # Request id -> future for its reply
+        self.calls = {}
+        self.next_id = 0
+
+    async def start(self):
+        async with self.start_lock:
+            if self.process is not None:
+                return
+            process = await self.ssh_conn.start_process(self.command)
+            self.process = process
+            self.reader = asyncio.create_task(self._read(process))
+            logging.info(f"🤖 Agent running on {self.ssh_conn.hostname}")
+
+    async def _read(self, process):
+        try:
+            while line := await process.stdout.readline():
+                reply = json.loads(line)
+                future = self.calls.pop(reply.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (OSError, asyncssh.Error, ValueError) as e:
+            logging.warning(f"⁉️  Agent on {self.ssh_conn.hostname} failed: {e}")
+        finally:
+            # Calls still waiting are retried on a new agent
+            if self.process is process:
+                self.process = None
+            calls, self.calls = self.calls, {}
+            for future in calls.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("agent exited"))
+
+    async def _call(self, method: str, **params):
+        for attempt in range(2):
+            await self.start()
+            self.next_id += 1
+            request_id = self.next_id
+            future = asyncio.get_running_loop().create_future()
+            self.calls[request_id] = future
+            try:
+                self.process.stdin.write(
+                    json.dumps({"id": request_id, "method": method, "params": params})
+                    + "\n"
+                )
+                reply = await future
+            except (ConnectionError, asyncssh.Error) as e:
+                self.calls.pop(request_id, None)
+                if attempt:
+                    raise OSError(f"{method} failed: {e}") from e
+                logging.warning(f"⁉️  Agent {method} failed: {e}")
+                continue
+            if "error" in reply:
+                raise OSError(reply["error"])
+            return reply["result"]
+
+    async def discover(self, dest_root: str) -> list:
+        try:
+            return await self._call("discover", dest_root=dest_root)
+        except OSError as e:
+            logging.error(f"⁉️  Unable to list mounts: {e}")
+            return []
+
+    async def mount_path(self, dest_root: str, dest_dir: str) -> str:
+        try:
+            path = await self._call(
+                "mount_path", dest_root=dest_root, dest_dir=dest_dir
+            )
+        except OSError as e:
+            logging.info(f"⁉️  Unable to find {dest_root}/{dest_dir}: {e}")
+            return None
+        if path is None:
+            logging.info(f"⁉️  {dest_root}/{dest_dir} is not a directory")
+        return path
+
+    async def free_space(self, mount_path: str) -> int:
+        try:
+            return await self._call("free_space", path=mount_path)
+        except OSError as e:
+            logging.info(f"⁉️  statvfs {mount_path} failed: {e}")
+            return None
+
+    async def parse_date(self, date: str) -> float:
+        return await self._call("replot_cutoff", replot_before=date)
+
+    async def listing(self, mount_path: str, replot_before: str = None):
+        replot_cutoff = None
+        if replot_before:
+            replot_cutoff = await self.replot_cutoff(replot_before)
+            if replot_cutoff is None:
+                return None
+        try:
+            files = await self._call("listing", path=mount_path)
+        except OSError as e:
+            logging.error(f"⁉️  Unable to list {mount_path}: {e}")
+            return None
+        return {path: tuple(stat) for path, stat in files.items()}, replot_cutoff
+
+    async def remove(self, mount_path: str, paths: list) -> dict:
+        try:
+            return await self._call("remove", mount_path=mount_path, paths=paths)
+        except OSError as e:
+            logging.error(f"⁉️  Unable to remove from {mount_path}: {e}")
+            return dict.fromkeys(paths, False)
+
+    async def sync(self, mount_path: str) -> bool:
+        try:
+            return await self._call("sync", path=mount_path)
+        except OSError as e:
+            logging.info(f"⁉️  Unable to sync {mount_path}: {e}")
+            return False
+
+    async def read_file(self, path: str) -> bytes:
+        return base64.b64decode(await self._call("read_file", path=path))
+
+    async def close(self):
+        if self.process is not None:
+            self.process.stdin.write_eof()
+            self.process.close()
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.ssh_conn.close()
+
+
+def agent_command(setting) -> str:
+    # Command starting the agent: True sends this copy of agent.py along
+    # with the command, otherwise it is the command of an installed agent
+    if setting is True:
+        source = base64.b64encode(Path(agent.__file__).read_bytes()).decode()
+        return f"python3 -c 'import base64; exec(base64.b64decode(\"{source}\"))'"
+    return setting
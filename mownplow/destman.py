@@ -1,122 +1,214 @@
-import asyncio
 import logging
+import time
 from pathlib import Path
 
-from mownplow.config import Config
-from mownplow.ssh import SSHClient
+from mownplow.config import Config, DestHost
+from mownplow.destfs import DestFS
+from mownplow.inventory import PlotInventory
+from mownplow.journal import Journal
+from mownplow.ledger import SpaceLedger
+from mownplow.trace import tracer
 
 
 class DestMan:
     # Manage plow destination properties
 
-    def __init__(self, config: Config, dest_dir: str, ssh_conn: SSHClient):
+    def __init__(
+        self,
+        config: Config,
+        host: DestHost,
+        dest_dir: str,
+        fs: DestFS,
+        journal: Journal = None,
+        clock=time.monotonic,
+    ):
         self.dest_dir = dest_dir
-        self.ssh_conn = ssh_conn
+        self.fs = fs
+        self.journal = journal
 
         self.dest = (
-            config.dest_protocol
+            host.dest_protocol
             + "://"
-            + config.dest_host
+            + host.dest_host
             + ":"
-            + str(config.dest_port)
-            + config.dest_root
+            + str(host.dest_port)
+            + host.dest_root
             + "/"
             + self.dest_dir
         )
-        self.dest_root = config.dest_root
-        self.replot_before = config.replot_before
+        self.dest_id = f"{host.dest_host}/{self.dest_dir}"
+        self.dest_host = host.dest_host
+        self.dest_root = host.dest_root
+        self.config = config
         self.virtual_dest = f"{self.dest_root}/{self.dest_dir}"
 
         self.dest_mount_path = None
-        self.delete_candidate_scr = None
-        self.free_space_scr = None
-        self.sync_dest_mount_scr = None
+        self.inventory = PlotInventory()
+        # ReplotBefore the inventory's replot cutoff was worked out for
+        self.inventory_replot_before = None
+        self.ledger = SpaceLedger(config.space_check_interval, clock)
 
     async def init_scripts(self) -> str:
         # Get the physical mount point for this destination
-        dest_mount_scr = (
-            "mount | grep "
-            + self.dest_root
-            + " | grep -w "
-            + self.dest_dir
-            + " | awk '{print $3}'"
-        )
-        result = await self.ssh_conn.run_command(dest_mount_scr)
-        if result.returncode == 0:
-            self.dest_mount_path = result.stdout.strip()
-            logging.debug(f"Destination path: {self.dest_mount_path}")
-            self.delete_candidate_scr = (
-                "find "
-                + self.dest_mount_path
-                + " -type f ! -newermt '"
-                + self.replot_before
-                + "' | sort | head -n1"
+        if self.journal is not None:
+            self.dest_mount_path = self.journal.mount_path(self.dest_id)
+        if not self.dest_mount_path:
+            self.dest_mount_path = await self.fs.mount_path(
+                self.dest_root, self.dest_dir
             )
-            self.free_space_scr = (
-                "df " + self.dest_mount_path + " | awk 'NR==2{print $4}'"
-            )
-            self.sync_dest_mount_scr = "sync -f " + self.dest_mount_path
-        else:
-            logging.info(f"⁉️  {dest_mount_scr!r} exited with {result.returncode}")
-            return False
+            if self.dest_mount_path is None:
+                return False
+            if self.journal is not None and self.dest_mount_path:
+                self.journal.save_mount_path(self.dest_id, self.dest_mount_path)
+        logging.debug(f"Destination path: {self.dest_mount_path}")
+
+        # Pick up the inventory from the last run rather than rescanning
+        if self.journal is not None:
+            saved = self.journal.load_inventory(self.dest_id, self.replot_before)
+            if saved is not None:
+                self.inventory.restore(*saved)
+                self.inventory_replot_before = self.replot_before
         return True
 
+    @property
+    def replot_before(self) -> str:
+        # Read from the config each time so that a reload takes effect
+        return self.config.replot_before
+
+    def inventory_stale(self) -> bool:
+        # Rescan after an error or once ReplotBefore has been changed
+        return (
+            self.inventory.stale or self.inventory_replot_before != self.replot_before
+        )
+
     async def get_dest_free_space(self) -> int:
-        dest_free = 0
-        result = await self.ssh_conn.run_command(self.free_space_scr)
-        if result.returncode == 0:
-            dest_free = int(result.stdout)
-        else:
-            logging.info(f"⁉️  {self.free_space_scr!r} exited with {result.returncode}")
-        return dest_free
+        # Free space less any reservations, only asking the drive when due
+        if self.ledger.due() and not await self.refresh_free_space():
+            return 0
+        return self.ledger.available()
+
+    async def refresh_free_space(self) -> bool:
+        free_KB = await self.fs.free_space(self.dest_mount_path)
+        if free_KB is None:
+            self.ledger.invalidate()
+            if self.journal is not None:
+                # The mount may have moved since it was journalled
+                self.journal.forget_dest(self.dest_id)
+            return False
+        self.ledger.update(free_KB)
+        return True
 
-    async def sync_dest_mount_path(self) -> int:
+    async def sync_dest_mount_path(self) -> bool:
         logging.debug(f"⁉️  Syncing {self.dest_mount_path}")
-        return await self.ssh_conn.run_command(self.sync_dest_mount_scr)
+        with tracer.span("sync", None, self.dest_id):
+            return await self.fs.sync(self.dest_mount_path)
 
     async def remove_next_replot(
         self,
         plot_size_KB: int,
+        refresh: bool = True,
     ) -> bool:
-        rem_file = await self._get_delete_candidate()
-        if rem_file:
-            if await self._remove_remote_plot(rem_file):
-                # Sync to flush deletion
-                await self.sync_dest_mount_path()
-            else:
-                return False
-        return True
+        # Remove just enough of the oldest replots to fit the incoming plot
+        if self.inventory_stale() and not await self.refresh_inventory():
+            return False
+        replots = self.inventory.replots()
+        if not replots:
+            return True
+
+        if refresh:
+            dest_free = await self.get_dest_free_space()
+        else:
+            dest_free = self.ledger.available()
+        rem_files = []
+        for rem_file in replots:
+            if dest_free > plot_size_KB:
+                break
+            rem_files.append(rem_file)
+            dest_free += self.inventory.size_of(rem_file) // 1024
+        if not rem_files:
+            return True
+
+        report = await self.remove_plots(rem_files)
+        return all(report.values())
+
+    async def prepare_next(self, plot_size_KB: int) -> bool:
+        # Make room for another plot of this size while the current one is
+        # still transferring, so that it can start without deleting or
+        # flushing first.  The drive's free space isn't asked for as it
+        # would count the partly written plot on top of its reservation.
+        if not self.ledger.known():
+            return False
+        try:
+            with tracer.span("prepare", None, self.dest_id):
+                return await self.remove_next_replot(plot_size_KB, refresh=False)
+        except Exception as e:
+            logging.error(f"! Unable to make room on {self.dest}: {e}")
+            return False
 
     async def remove_all_replots(self) -> bool:
-        rem_file = await self._get_delete_candidate()
-        while rem_file:
-            logging.debug(f"⁉️  Removing {rem_file}")
-            if not await self._remove_remote_plot(rem_file):
-                return False
-            rem_file = await self._get_delete_candidate()
-            # Give other processes room to breathe
-            await asyncio.sleep(0)
-        # Sync to flush all deletions
-        await self.sync_dest_mount_path()
-        return True
+        if self.inventory_stale() and not await self.refresh_inventory():
+            return False
+        report = await self.remove_plots(self.inventory.replots())
+        return all(report.values())
 
-    async def _get_delete_candidate(self) -> str:
-        remote_result = await self.ssh_conn.run_command(self.delete_candidate_scr)
-        if remote_result.returncode != 0:
-            logging.error(
-                f"⁉️  {self.delete_candidate_scr!r} exited with {remote_result.returncode}"  # noqa: E501
-            )
-            return None
-        rem_file = remote_result.stdout.strip()
-        return rem_file
-
-    async def _remove_remote_plot(self, rem_file: str) -> bool:
-        logging.info(f"␡ Removing {rem_file}")
-        remove_file_scr = f"rm {rem_file}"
-        remote_result = await self.ssh_conn.run_command(remove_file_scr)
-        if remote_result.returncode != 0:
-            logging.error(
-                f"⁉️  {remove_file_scr!r} exited with {remote_result.returncode}"
+    async def remove_plots(self, rem_files: list) -> dict:
+        # Remove a batch of files followed by one flush, reporting success
+        # for each file
+        if not rem_files:
+            return {}
+        logging.info(f"␡ Removing {len(rem_files)} plots from {self.dest_mount_path}")
+        report = await self.fs.remove(self.dest_mount_path, rem_files)
+
+        for rem_file, removed in report.items():
+            if removed:
+                logging.debug(f"␡ Removed {rem_file}")
+                self.ledger.credit(self.inventory.discard(rem_file) // 1024)
+            else:
+                logging.error(f"⁉️  Failed to remove {rem_file}")
+                # The drive no longer matches the index so rescan next time
+                self.invalidate_inventory()
+        if self.journal is not None:
+            self.journal.remove_files(
+                self.dest_id, [rem_file for rem_file, removed in report.items() if removed]
             )
+        return report
+
+    async def refresh_inventory(self) -> bool:
+        replot_before = self.replot_before
+        result = await self.fs.listing(self.dest_mount_path, replot_before)
+        if result is None:
+            self.inventory.stale = True
             return False
+        files, replot_cutoff = result
+        self.inventory.restore(files, replot_cutoff)
+        self.inventory_replot_before = replot_before
+        if self.journal is not None:
+            self.journal.save_inventory(
+                self.dest_id, replot_before, replot_cutoff, self.inventory.files
+            )
+        logging.debug(
+            f"Inventory for {self.dest_mount_path}: {len(self.inventory)} files, "
+            + f"{len(self.inventory.replots())} replots"
+        )
         return True
+
+    def invalidate_inventory(self):
+        self.inventory.stale = True
+        if self.journal is not None:
+            self.journal.invalidate_inventory(self.dest_id)
+
+    def reclaimable_KB(self) -> int:
+        # Space held by replots which are still to be removed
+        return (
+            sum(self.inventory.size_of(path) for path in self.inventory.replots())
+            // 1024
+        )
+
+    def record_plot(self, plot_name: str, plot_size: int):
+        # Keep the inventory and ledger current after a successful transfer
+        path = f"{self.dest_mount_path}/{plot_name}"
+        mtime = time.time()
+        self.inventory.add(path, plot_size, mtime)
+        self.ledger.commit(plot_name)
+        if self.journal is not None:
+            self.journal.add_file(self.dest_id, path, mtime, plot_size)
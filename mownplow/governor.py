@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from mownplow.config import DestHost
+from mownplow.harvester import HarvesterRequest
+from mownplow.metrics import metrics
+from mownplow.scheduler import PlowScheduler
+
+
+class Governor:
+    """
+    Adapts a host's transfer bandwidth and concurrency to its harvester.
+
+    The harvester's responsiveness is sampled by timing get_plot_directories
+    every interval.  While it answers within the target latency the
+    bandwidth cap grows by a fixed step and, once the cap reaches its
+    ceiling, another concurrent transfer is allowed.  As soon as it is
+    slower (or fails) the cap is halved and a transfer slot is taken away
+    (AIMD), so that plot lookups stay fast while plots move as quickly as
+    the harvester allows.  The sendfile and local engines pick up a new
+    bandwidth cap on their next chunk, rsync transfers only as they start
+    (rsync can't change its --bwlimit part way through a plot).  Fewer slots
+    only hold back transfers which are yet to start.
+    """
+
+    def __init__(
+        self,
+        host: DestHost,
+        harvester_req: HarvesterRequest,
+        scheduler: PlowScheduler,
+        target_latency: float = 0.5,
+        interval: int = 10,
+        min_bwlimit: int = 10000,
+        max_bwlimit: int = 1250000,
+    ):
+        self.host = host.dest_host
+        self.harvester_req = harvester_req
+        self.scheduler = scheduler
+        self.target_latency = target_latency
+        self.interval = interval
+        self.default_min_bwlimit = min_bwlimit
+        self.default_max_bwlimit = max_bwlimit
+
+        self.bwlimit = None
+        self.slots = None
+        self.set_ceilings(host)
+
+    def set_ceilings(self, host: DestHost):
+        # Ceilings from the host's settings (again after a reload), keeping
+        # the current limits within them.
+
+        # Bandwidth cap (KB/s) for all of the host's transfers together,
+        # bounded by the host's own BwLimit if it has one
+        self.max_bwlimit = host.bwlimit or self.default_max_bwlimit
+        self.min_bwlimit = min(self.default_min_bwlimit, self.max_bwlimit)
+        self.step = max(self.max_bwlimit // 10, 1)
+        if self.bwlimit is None:
+            self.bwlimit = self.max_bwlimit
+        self.bwlimit = min(max(self.bwlimit, self.min_bwlimit), self.max_bwlimit)
+        # Concurrent transfers, up to the host's MaxTransfers or one per drive
+        self.max_slots = host.max_transfers or max(len(host.dest_dirs or []), 1)
+        if self.slots is None:
+            self.slots = self.max_slots
+        self.slots = min(self.slots, self.max_slots)
+        # Only capped below the ceiling unless the host has a BwLimit of its own
+        self.capped = bool(host.bwlimit)
+
+    async def probe(self) -> float:
+        # Seconds taken by a harvester RPC (infinite if it fails)
+        start = time.monotonic()
+        try:
+            await self.harvester_req.get_plot_directories()
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            logging.warning(f"⁉️  Harvester {self.host} probe failed: {e!r}")
+            return float("inf")
+        return time.monotonic() - start
+
+    def adjust(self, latency: float):
+        if latency > self.target_latency:
+            self.bwlimit = max(self.bwlimit // 2, self.min_bwlimit)
+            self.slots = max(self.slots - 1, 1)
+        elif self.bwlimit < self.max_bwlimit:
+            self.bwlimit = min(self.bwlimit + self.step, self.max_bwlimit)
+        else:
+            self.slots = min(self.slots + 1, self.max_slots)
+        self.apply()
+
+    def apply(self):
+        bwlimit = self.bwlimit
+        if bwlimit >= self.max_bwlimit and not self.capped:
+            bwlimit = 0
+        self.scheduler.set_host_limits(
+            self.host, max_transfers=self.slots, bwlimit=bwlimit
+        )
+        metrics.set("mownplow_governor_bwlimit_kbps", bwlimit, host=self.host)
+        metrics.set("mownplow_governor_max_transfers", self.slots, host=self.host)
+
+    async def run(self):
+        logging.info(
+            f"🎛️  Governing {self.host} for {self.target_latency}s harvester latency"
+        )
+        self.apply()
+        while True:
+            latency = await self.probe()
+            if latency != float("inf"):
+                metrics.set(
+                    "mownplow_harvester_latency_seconds",
+                    round(latency, 3),
+                    host=self.host,
+                )
+            self.adjust(latency)
+            if latency > self.target_latency:
+                logging.info(
+                    f"🎛️  {self.host} harvester took {latency:.3f}s, backing off to "
+                    + f"{self.bwlimit}KB/s over {self.slots} transfers"
+                )
+            await asyncio.sleep(self.interval)
@@ -1,53 +1,111 @@
 import asyncio
 import json
+import hashlib
 import logging
+import os
 import ssl
 import tempfile
+import time
 
 import aiohttp
 import asyncssh
 
+from mownplow.destfs import DestFS
+from mownplow.journal import Journal
+from mownplow.metrics import metrics
+
 
 class HarvesterCert:
+    # The harvester's CA, certificate and key, copied from its host into
+    # local files for the SSL context.  With a journal the copies are kept
+    # across restarts while they still match their checksums.
+
     def __init__(
         self,
-        ssh_hostname: str,
-        ssh_username: str,
-        ssh_key_path: str,
+        fs: DestFS,
         cacert_path: str,
         cert_path: str,
         key_path: str,
+        host: str = None,
+        journal: Journal = None,
     ):
-        self.ssh_hostname = ssh_hostname
-        self.ssh_username = ssh_username
-        self.ssh_key_path = ssh_key_path
+        self.fs = fs
         self.cacert_path = cacert_path
         self.cert_path = cert_path
         self.key_path = key_path
+        self.host = host
+        self.journal = journal
 
         self.cacert_file = None
         self.cert_file = None
         self.key_file = None
+        # Bumped on each fetch, so that concurrent refreshes fetch only once
+        self.generation = 0
+        self.lock = asyncio.Lock()
 
     async def retrieve_cert_and_key(self):
+        async with self.lock:
+            if self._load_journalled():
+                logging.debug(f"Using the journalled certificates for {self.host}")
+                return
+            await self._fetch()
+
+    async def refresh(self, generation: int):
+        # Fetch the files again, unless that has been done since generation
+        async with self.lock:
+            if generation == self.generation:
+                await self._fetch()
+
+    async def _fetch(self):
         try:
-            async with asyncssh.connect(
-                self.ssh_hostname,
-                username=self.ssh_username,
-                client_keys=[self.ssh_key_path],
-            ) as conn:
-                result = await asyncio.gather(
-                    conn.run(f"cat {self.cacert_path}", encoding=None),
-                    conn.run(f"cat {self.cert_path}", encoding=None),
-                    conn.run(f"cat {self.key_path}", encoding=None),
-                )
-                self.cacert = result[0].stdout
-                self.cert = result[1].stdout
-                self.key = result[2].stdout
+            self.cacert, self.cert, self.key = await asyncio.gather(
+                self.fs.read_file(self.cacert_path),
+                self.fs.read_file(self.cert_path),
+                self.fs.read_file(self.key_path),
+            )
 
-                self._create_temp_ssl_files()
+            stale = [self.cacert_file, self.cert_file, self.key_file]
+            self._create_temp_ssl_files()
         except (OSError, asyncssh.Error) as e:
             raise Exception(f"Failed to retrieve cert and key files: {e}") from e
+        self.generation += 1
+
+        if self.journal is not None:
+            for path, data, local_path in zip(
+                (self.cacert_path, self.cert_path, self.key_path),
+                (self.cacert, self.cert, self.key),
+                (self.cacert_file, self.cert_file, self.key_file),
+            ):
+                # Copies made by an earlier run are replaced
+                saved = self.journal.cert_file(self.host, path)
+                if saved is not None and saved[0] != local_path:
+                    stale.append(saved[0])
+                self.journal.save_cert_file(
+                    self.host, path, local_path, hashlib.sha256(data).hexdigest()
+                )
+        for file in stale:
+            if file is not None and os.path.exists(file):
+                os.remove(file)
+
+    def _load_journalled(self) -> bool:
+        # Use the copies made by an earlier run if they are unchanged
+        if self.journal is None:
+            return False
+        files = []
+        for path in (self.cacert_path, self.cert_path, self.key_path):
+            saved = self.journal.cert_file(self.host, path)
+            if saved is None:
+                return False
+            local_path, sha256 = saved
+            try:
+                with open(local_path, "rb") as file:
+                    if hashlib.sha256(file.read()).hexdigest() != sha256:
+                        return False
+            except OSError:
+                return False
+            files.append(local_path)
+        self.cacert_file, self.cert_file, self.key_file = files
+        return True
 
     def _create_temp_ssl_files(self):
         # Create temporary files for use SSL/TLS context creation
@@ -75,36 +133,124 @@ class HarvesterCert:
 
 
 class HarvesterRequest:
-    def __init__(self, host: str, port, harvester_cert: HarvesterCert):
+    def __init__(
+        self,
+        host: str,
+        port,
+        harvester_cert: HarvesterCert,
+        timeout: int = 30,
+        max_connections: int = 8,
+        journal: Journal = None,
+    ):
         self.host = host
         self.port = port
 
-        self.cacert_file = harvester_cert.cacert_file
-        self.cert_file = harvester_cert.cert_file
-        self.key_file = harvester_cert.key_file
+        self.harvester_cert = harvester_cert
+        # The certificates' generation the SSL context was built from
+        self.cert_generation = None
+
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_connections = max_connections
 
         self.ssl_context = None
+        self.session = None
+
+        # Directories removed from the harvester -> when they were removed,
+        # and the time each has spent offline in earlier removals
+        self.offline = {}
+        self.offline_seconds = {}
+        metrics.add_collector(self._collect_metrics)
+
+        # Directories an earlier run left off the harvester
+        self.journal = journal
+        if journal is not None:
+            now = time.time()
+            for directory, since in journal.offline_dirs(host).items():
+                self.offline[directory] = time.monotonic() - max(now - since, 0)
+
+    def offline_time(self, directory: str) -> float:
+        # Seconds the directory has spent removed from the harvester
+        seconds = self.offline_seconds.get(directory, 0.0)
+        if directory in self.offline:
+            seconds += time.monotonic() - self.offline[directory]
+        return seconds
+
+    def _collect_metrics(self):
+        directories = set(self.offline) | set(self.offline_seconds)
+        for directory in directories:
+            metrics.set(
+                "mownplow_drive_offline_seconds_total",
+                round(self.offline_time(directory), 1),
+                harvester=self.host,
+                dir=directory,
+            )
+        metrics.set("mownplow_drives_offline", len(self.offline), harvester=self.host)
 
     def _set_context(self):
+        harvester_cert = self.harvester_cert
         ssl_context = ssl._create_unverified_context(
-            purpose=ssl.Purpose.CLIENT_AUTH, cafile=self.cacert_file
+            purpose=ssl.Purpose.SERVER_AUTH, cafile=harvester_cert.cacert_file
         )
         ssl_context.check_hostname = False
-        ssl_context.load_cert_chain(certfile=self.cert_file, keyfile=self.key_file)
+        ssl_context.load_cert_chain(
+            certfile=harvester_cert.cert_file, keyfile=harvester_cert.key_file
+        )
         ssl_context.verify_mode = ssl.CERT_REQUIRED
 
         self.ssl_context = ssl_context
+        self.cert_generation = harvester_cert.generation
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Long-lived keep-alive session so that TLS is only negotiated once.
+        # The SSL context is given with each request, so that it can be
+        # replaced without closing the session.
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={
+                    "Accept": "application/json",
+                    "Content-Type": "application/json",
+                },
+            )
+        return self.session
 
     async def _post_json(self, url: str, data: dict) -> dict:
-        # Set context for each request (avoid timeouts)
-        self._set_context()
-        headers = {"Accept": "application/json", "Content-Type": "application/json"}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url, data=json.dumps(data), headers=headers, ssl=self.ssl_context
-            ) as response:
-                response_data = await response.json()
-        return response_data
+        for attempt in range(2):
+            session = self._get_session()
+            if self.ssl_context is None:
+                self._set_context()
+            try:
+                async with session.post(
+                    url, data=json.dumps(data), ssl=self.ssl_context
+                ) as response:
+                    return await response.json()
+            except (aiohttp.ClientSSLError, ssl.SSLError) as e:
+                if attempt:
+                    raise
+                # The certificates may have changed, so they are fetched again
+                # and the context is rebuilt from them.  The session's
+                # connector opens new connections for the new context while
+                # other requests carry on.
+                logging.warning(f"⁉️  {url} failed ({e!r}), refreshing SSL context")
+                try:
+                    await self.harvester_cert.refresh(self.cert_generation)
+                except Exception as e:
+                    logging.warning(f"⁉️  {e}")
+                self.ssl_context = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt:
+                    raise
+                # The session is shared with the other workers' requests, so
+                # it is left open: aiohttp replaces a dead keep-alive
+                # connection by itself (and a closed session is rebuilt)
+                logging.warning(f"⁉️  {url} failed ({e!r}), retrying")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
     async def get_plot_directories(self) -> str:
         url = f"https://{self.host}:{self.port}/get_plot_directories"
@@ -119,6 +265,15 @@ class HarvesterRequest:
         response = await self._post_json(url, data=request_data)
         formatted_response = json.dumps(response, indent=2)
         logging.debug(f"Add plot directory response: {formatted_response}")
+        removed_at = self.offline.pop(directory, None)
+        if removed_at is not None:
+            offline_for = time.monotonic() - removed_at
+            self.offline_seconds[directory] = (
+                self.offline_seconds.get(directory, 0.0) + offline_for
+            )
+            logging.info(f"{directory} was offline for {int(offline_for)}s")
+        if self.journal is not None:
+            self.journal.set_online(self.host, directory)
         return response
 
     async def remove_plot_directory(self, directory: str) -> str:
@@ -127,8 +282,21 @@ class HarvesterRequest:
         response = await self._post_json(url, data=request_data)
         formatted_response = json.dumps(response, indent=2)
         logging.debug(f"Remove plot directory response: {formatted_response}")
+        self.offline.setdefault(directory, time.monotonic())
+        if self.journal is not None:
+            self.journal.set_offline(self.host, directory, time.time())
         return response
 
+    async def add_plot_directories(self, directories: list) -> list:
+        return await asyncio.gather(
+            *(self.add_plot_directory(directory) for directory in directories)
+        )
+
+    async def remove_plot_directories(self, directories: list) -> list:
+        return await asyncio.gather(
+            *(self.remove_plot_directory(directory) for directory in directories)
+        )
+
     async def get_routes(self) -> str:
         url = f"https://{self.host}:{self.port}/get_routes"
         response = await self._post_json(url, data={})
@@ -0,0 +1,62 @@
+import bisect
+import logging
+
+
+def parse_listing(listing: str) -> dict:
+    # path -> (mtime, size) from "<mtime> <size> <path>" lines
+    files = {}
+    for line in listing.splitlines():
+        try:
+            mtime, size, path = line.split(" ", 2)
+            files[path] = (float(mtime), int(size))
+        except ValueError:
+            logging.debug(f"Ignoring inventory line: {line!r}")
+    return files
+
+
+class PlotInventory:
+    # In-memory index of the files on a destination drive, oldest first
+
+    def __init__(self):
+        # Sorted list of (mtime, path) and path -> (mtime, size)
+        self.entries = []
+        self.files = {}
+        # Files with an mtime at or before the cutoff are replots
+        self.replot_cutoff = None
+        self.stale = True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def restore(self, files: dict, replot_cutoff: float = None):
+        # Rebuild the index from path -> (mtime, size)
+        self.files = files
+        self.replot_cutoff = replot_cutoff
+        self.entries = sorted((mtime, path) for path, (mtime, _) in files.items())
+        self.stale = False
+
+    def add(self, path: str, size: int, mtime: float):
+        self.discard(path)
+        self.files[path] = (mtime, size)
+        bisect.insort(self.entries, (mtime, path))
+
+    def discard(self, path: str) -> int:
+        # Drop a file from the index and return its size in bytes
+        entry = self.files.pop(path, None)
+        if entry is None:
+            return 0
+        mtime, size = entry
+        pos = bisect.bisect_left(self.entries, (mtime, path))
+        if pos < len(self.entries) and self.entries[pos] == (mtime, path):
+            del self.entries[pos]
+        return size
+
+    def replots(self) -> list:
+        # Replot candidates, oldest first
+        if self.replot_cutoff is None:
+            return []
+        end = bisect.bisect_right(self.entries, (self.replot_cutoff, chr(0x10FFFF)))
+        return [path for _, path in self.entries[:end]]
+
+    def size_of(self, path: str) -> int:
+        return self.files.get(path, (0, 0))[1]
@@ -0,0 +1,231 @@
+import logging
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dests (
+    dest_id TEXT PRIMARY KEY,
+    mount_path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS discovered (
+    host TEXT NOT NULL,
+    dest_root TEXT NOT NULL,
+    dest_dir TEXT NOT NULL,
+    PRIMARY KEY (host, dest_root, dest_dir)
+);
+CREATE TABLE IF NOT EXISTS certs (
+    host TEXT NOT NULL,
+    path TEXT NOT NULL,
+    local_path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (host, path)
+);
+CREATE TABLE IF NOT EXISTS inventories (
+    dest_id TEXT PRIMARY KEY,
+    replot_before TEXT,
+    replot_cutoff REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    dest_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (dest_id, path)
+);
+CREATE TABLE IF NOT EXISTS offline (
+    harvester TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    since REAL NOT NULL,
+    PRIMARY KEY (harvester, directory)
+);
+CREATE TABLE IF NOT EXISTS transfers (
+    plot TEXT PRIMARY KEY,
+    dest_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    started REAL NOT NULL
+);
+"""
+
+
+class Journal:
+    """
+    Local SQLite record of what mownplow knows about its destinations.
+
+    Lets a restart skip the mount discovery, harvester certificate fetches,
+    per-drive mount lookups and inventory scans, remember which directories
+    it left off the harvester and send interrupted transfers back to the
+    drive holding their partial file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        logging.info(f"📒 Journal {path}")
+
+    def close(self):
+        self.db.close()
+
+    # Destinations
+
+    def mount_path(self, dest_id: str) -> str:
+        row = self.db.execute(
+            "SELECT mount_path FROM dests WHERE dest_id = ?", (dest_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_mount_path(self, dest_id: str, mount_path: str):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO dests VALUES (?, ?)", (dest_id, mount_path)
+            )
+
+    def forget_dest(self, dest_id: str):
+        # A drive which has gone means its host's discovered list is out of
+        # date too
+        host = dest_id.partition("/")[0]
+        with self.db:
+            self.db.execute("DELETE FROM dests WHERE dest_id = ?", (dest_id,))
+            self.db.execute("DELETE FROM inventories WHERE dest_id = ?", (dest_id,))
+            self.db.execute("DELETE FROM discovered WHERE host = ?", (host,))
+
+    def dest_dirs(self, host: str, dest_root: str) -> list:
+        # The directories last discovered below dest_root, or None if unknown
+        rows = self.db.execute(
+            "SELECT dest_dir FROM discovered WHERE host = ? AND dest_root = ?"
+            + " ORDER BY dest_dir",
+            (host, dest_root),
+        ).fetchall()
+        return [row[0] for row in rows] or None
+
+    def save_dest_dirs(self, host: str, dest_root: str, dest_dirs: list):
+        with self.db:
+            self.db.execute(
+                "DELETE FROM discovered WHERE host = ? AND dest_root = ?",
+                (host, dest_root),
+            )
+            self.db.executemany(
+                "INSERT INTO discovered VALUES (?, ?, ?)",
+                ((host, dest_root, dest_dir) for dest_dir in dest_dirs),
+            )
+
+    # Harvester certificates
+
+    def cert_file(self, host: str, path: str):
+        # (local copy, its sha256) of a file fetched from the host, or None
+        return self.db.execute(
+            "SELECT local_path, sha256 FROM certs WHERE host = ? AND path = ?",
+            (host, path),
+        ).fetchone()
+
+    def save_cert_file(self, host: str, path: str, local_path: str, sha256: str):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO certs VALUES (?, ?, ?, ?)",
+                (host, path, local_path, sha256),
+            )
+
+    # Inventory
+
+    def load_inventory(self, dest_id: str, replot_before: str):
+        # (files, replot_cutoff) as last saved, or None if unknown or taken
+        # with a different ReplotBefore
+        row = self.db.execute(
+            "SELECT replot_before, replot_cutoff FROM inventories WHERE dest_id = ?",
+            (dest_id,),
+        ).fetchone()
+        if row is None or row[0] != replot_before:
+            return None
+        files = {
+            path: (mtime, size)
+            for path, mtime, size in self.db.execute(
+                "SELECT path, mtime, size FROM files WHERE dest_id = ?", (dest_id,)
+            )
+        }
+        return files, row[1]
+
+    def save_inventory(
+        self, dest_id: str, replot_before: str, replot_cutoff: float, files: dict
+    ):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO inventories VALUES (?, ?, ?)",
+                (dest_id, replot_before, replot_cutoff),
+            )
+            self.db.execute("DELETE FROM files WHERE dest_id = ?", (dest_id,))
+            self.db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?)",
+                (
+                    (dest_id, path, mtime, size)
+                    for path, (mtime, size) in files.items()
+                ),
+            )
+
+    def add_file(self, dest_id: str, path: str, mtime: float, size: int):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (dest_id, path, mtime, size),
+            )
+
+    def remove_files(self, dest_id: str, paths: list):
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM files WHERE dest_id = ? AND path = ?",
+                ((dest_id, path) for path in paths),
+            )
+
+    def invalidate_inventory(self, dest_id: str):
+        with self.db:
+            self.db.execute("DELETE FROM inventories WHERE dest_id = ?", (dest_id,))
+
+    # Directories removed from the harvester
+
+    def offline_dirs(self, harvester: str) -> dict:
+        # directory -> wall clock time it was removed
+        return dict(
+            self.db.execute(
+                "SELECT directory, since FROM offline WHERE harvester = ?",
+                (harvester,),
+            )
+        )
+
+    def set_offline(self, harvester: str, directory: str, since: float):
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO offline VALUES (?, ?, ?)",
+                (harvester, directory, since),
+            )
+
+    def set_online(self, harvester: str, directory: str):
+        with self.db:
+            self.db.execute(
+                "DELETE FROM offline WHERE harvester = ? AND directory = ?",
+                (harvester, directory),
+            )
+
+    # Transfers
+
+    def transfers(self) -> dict:
+        # Interrupted transfers as plot -> dest_id
+        return dict(self.db.execute("SELECT plot, dest_id FROM transfers"))
+
+    def begin_transfer(self, plot: str, dest_id: str, size: int) -> bool:
+        # Record the transfer and report whether it resumes an earlier attempt
+        # to the same destination
+        row = self.db.execute(
+            "SELECT dest_id, size FROM transfers WHERE plot = ?", (plot,)
+        ).fetchone()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?)",
+                (plot, dest_id, size, time.time()),
+            )
+        return row is not None and row == (dest_id, size)
+
+    def end_transfer(self, plot: str):
+        with self.db:
+            self.db.execute("DELETE FROM transfers WHERE plot = ?", (plot,))
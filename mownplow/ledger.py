@@ -0,0 +1,63 @@
+import time
+
+
+class SpaceLedger:
+    # Track a destination's free space locally between filesystem checks
+
+    def __init__(self, check_interval: int = 600, clock=time.monotonic):
+        self.check_interval = check_interval
+        # Time source (the event loop's, which the simulator runs virtually)
+        self.clock = clock
+        # Free space (KB) as last reported by the filesystem, adjusted for
+        # completed transfers and deletions since then
+        self.free_KB = None
+        # KB reserved by transfers which are still in flight
+        self.reserved = {}
+        self.checked_at = 0.0
+        self.needs_check = True
+
+    def due(self) -> bool:
+        # Check against the real filesystem periodically or after an error
+        return (
+            self.needs_check
+            or self.free_KB is None
+            or self.clock() - self.checked_at > self.check_interval
+        )
+
+    def update(self, free_KB: int):
+        self.free_KB = free_KB
+        self.checked_at = self.clock()
+        self.needs_check = False
+
+    def invalidate(self):
+        self.needs_check = True
+
+    def known(self) -> bool:
+        # Whether the free space can be relied on without asking the drive
+        return self.free_KB is not None and not self.needs_check
+
+    def available(self) -> int:
+        if self.free_KB is None:
+            return 0
+        return self.free_KB - sum(self.reserved.values())
+
+    def reserve(self, key: str, size_KB: int) -> bool:
+        if self.available() <= size_KB:
+            return False
+        self.reserved[key] = size_KB
+        return True
+
+    def commit(self, key: str):
+        # The reserved bytes have landed on the drive
+        size_KB = self.reserved.pop(key, 0)
+        if self.free_KB is not None:
+            self.free_KB -= size_KB
+
+    def release(self, key: str):
+        # The transfer failed part way so the real free space is unknown
+        if self.reserved.pop(key, None) is not None:
+            self.invalidate()
+
+    def credit(self, size_KB: int):
+        if self.free_KB is not None:
+            self.free_KB += size_KB
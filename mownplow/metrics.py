@@ -0,0 +1,126 @@
+import logging
+import time
+
+from aiohttp import web
+
+METRICS = {
+    "mownplow_plots_in_flight": ("gauge", "Plots currently being transferred"),
+    "mownplow_queue_depth": ("gauge", "Plots waiting for a destination"),
+    "mownplow_plots_transferred_total": ("counter", "Plots transferred"),
+    "mownplow_dispatched_plots_total": ("counter", "Plots handed to a destination"),
+    "mownplow_dispatch_seconds_total": (
+        "counter",
+        "Total time plots waited between arriving and being dispatched",
+    ),
+    "mownplow_transfer_bytes_total": ("counter", "Bytes transferred"),
+    "mownplow_transfer_bytes_per_second": (
+        "gauge",
+        "Throughput of the current (or last) transfer",
+    ),
+    "mownplow_time_to_first_byte_seconds": (
+        "gauge",
+        "Time from starting the last transfer until its first byte moved",
+    ),
+    "mownplow_harvester_remove_seconds": (
+        "gauge",
+        "Time taken by the last remove_plot_directory call",
+    ),
+    "mownplow_harvester_latency_seconds": (
+        "gauge",
+        "Time taken by the governor's last harvester probe",
+    ),
+    "mownplow_governor_bwlimit_kbps": (
+        "gauge",
+        "Bandwidth cap set by the governor for each host (0 is unlimited)",
+    ),
+    "mownplow_governor_max_transfers": (
+        "gauge",
+        "Concurrent transfers allowed by the governor for each host",
+    ),
+    "mownplow_source_free_bytes": ("gauge", "Free space on each source device"),
+    "mownplow_drives_offline": ("gauge", "Drives currently removed from the harvester"),
+    "mownplow_drive_offline_seconds_total": (
+        "counter",
+        "Time each drive has spent removed from the harvester",
+    ),
+}
+
+
+class Metrics:
+    # Gauges and counters exposed in the Prometheus text format
+
+    def __init__(self):
+        # name -> {labels: value}
+        self.values = {name: {} for name in METRICS}
+        # Called before rendering to refresh values which change continuously
+        self.collectors = []
+        self.set("mownplow_plots_in_flight", 0)
+        self.set("mownplow_queue_depth", 0)
+
+    def set(self, name: str, value: float, **labels):
+        self.values[name][tuple(sorted(labels.items()))] = value
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in self.values[name].items():
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+                if label_str:
+                    lines.append(f"{name}{{{label_str}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, request):
+        return web.Response(text=self.render(), content_type="text/plain")
+
+    async def serve(self, host: str, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"📈 Metrics available on http://{host}:{port}/metrics")
+        return runner
+
+
+class TransferProgress:
+    # Progress callback for a single transfer
+
+    def __init__(self, dest: str):
+        self.dest = dest
+        self.start = time.monotonic()
+        self.bytes_done = 0
+
+    def __call__(self, bytes_done: int):
+        elapsed = time.monotonic() - self.start
+        if not self.bytes_done and bytes_done:
+            metrics.set(
+                "mownplow_time_to_first_byte_seconds", round(elapsed, 3), dest=self.dest
+            )
+        metrics.inc(
+            "mownplow_transfer_bytes_total",
+            max(bytes_done - self.bytes_done, 0),
+            dest=self.dest,
+        )
+        self.bytes_done = bytes_done
+        if elapsed > 0:
+            metrics.set(
+                "mownplow_transfer_bytes_per_second",
+                int(bytes_done / elapsed),
+                dest=self.dest,
+            )
+
+
+metrics = Metrics()
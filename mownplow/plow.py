@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from functools import partial
+
+from mownplow.backpressure import backpressure
+from mownplow.config import Config, DestHost
+from mownplow.destman import DestMan
+from mownplow.metrics import TransferProgress, metrics
+from mownplow.trace import tracer
+
+#####
+# System variables - don't change unless you know what you are doing.
+#####
+# Short & long sleep durations upon various error conditions
+SLEEP_FOR = 60 * 3
+SLEEP_FOR_LONG = 60 * 20
+
+
+#####
+# This is where the magic happens
+#####
+async def plow(
+    config: Config,
+    host: DestHost,
+    dest_dir,
+    plot_queue,
+    dest_schedule,
+    fs,
+    harvester_req,
+    transport,
+    journal,
+    loop,
+):
+    # Plow initialisation
+    destman = DestMan(config, host, dest_dir, fs, journal, loop.time)
+    dest_id = destman.dest_id
+    if not await destman.init_scripts():
+        logging.info(f"Unable to initialise scripts for {dest_id}")
+        dest_schedule.rem_dest_from_priorities(dest_id)
+        return
+
+    # The drive is only taken off the harvester while plots are arriving
+    manage_farming = not config.farm_during_plow
+    currently_farming_dest = not (
+        manage_farming and destman.virtual_dest in harvester_req.offline
+    )
+    incremental_remove = config.replot
+
+    # Work loop
+    logging.info(f"🧑‍🌾 plowing to {destman.dest}")
+    while True:
+        plot = None
+        try:
+            logging.debug(f"{destman.dest} waiting for plot")
+            if currently_farming_dest or not config.readd_after:
+                plot = await dest_schedule.get_plot(dest_id)
+            else:
+                try:
+                    plot = await asyncio.wait_for(
+                        dest_schedule.get_plot(dest_id), config.readd_after
+                    )
+                except asyncio.TimeoutError:
+                    # Farm the drive again until the next plot arrives
+                    logging.info(f"Adding idle {destman.virtual_dest} back to farm")
+                    await destman.sync_dest_mount_path()
+                    await harvester_req.add_plot_directory(destman.virtual_dest)
+                    currently_farming_dest = True
+                    continue
+            if plot is None:
+                # The destination has been retired
+                logging.info(f"{destman.dest} is no longer a destination")
+                break
+
+            plot_size = plot.stat().st_size
+            plot_size_KB = int((plot_size) / (1024))
+
+            # Remove from farm only when actually starting
+            # to plow to this destination
+            if manage_farming and currently_farming_dest:
+                logging.info(f"Removing {destman.virtual_dest} from farming")
+                remove_start = time.monotonic()
+                with tracer.span("harvester_remove", plot, dest_id):
+                    await harvester_req.remove_plot_directory(destman.virtual_dest)
+                metrics.set(
+                    "mownplow_harvester_remove_seconds",
+                    round(time.monotonic() - remove_start, 3),
+                    dest=dest_id,
+                )
+                currently_farming_dest = False
+
+            if incremental_remove and config.remove_all_replots:
+                # await asyncio.sleep(0)
+                logging.info(f"Removing all matching replots on {destman.dest}")
+                with tracer.span("replot_delete", plot, dest_id):
+                    remove_success = await destman.remove_all_replots()
+                if not remove_success:
+                    await plot_queue.put(plot)
+                    break
+                incremental_remove = False
+                await asyncio.sleep(5)
+
+            if incremental_remove:
+                with tracer.span("replot_delete", plot, dest_id):
+                    remove_success = await destman.remove_next_replot(plot_size_KB)
+                if not remove_success:
+                    await plot_queue.put(plot)
+                    break
+
+            await asyncio.sleep(0)
+
+            # Free space from the ledger, checked against the drive when due
+            with tracer.span("free_space", plot, dest_id):
+                dest_free = await destman.get_dest_free_space()
+            if not dest_free:
+                await plot_queue.put(plot)
+                break
+
+            # Reserve the space up front so that it can't be double-booked
+            reserved = destman.ledger.reserve(plot.name, plot_size_KB)
+            capacity_KB = destman.ledger.available()
+            if incremental_remove:
+                capacity_KB += destman.reclaimable_KB()
+            dest_schedule.update_dest_space(dest_id, capacity_KB)
+            if reserved:
+                logging.info(
+                    f"✅ Destination {destman.dest} has {int(dest_free/(1024*1024))}GiB free"
+                )
+            elif dest_schedule.dest_is_full(dest_id):
+                logging.info(f"❎ Destination {destman.dest} is full")
+                # Back in line where it was, for another destination
+                dest_schedule.requeue(dest_id)
+                # Just quit the worker entirely for this destination.
+                break
+            else:
+                # Keep the drive for a smaller (more compressed) plot
+                logging.info(f"❎ {plot.name} does not fit on {destman.dest}")
+                dest_schedule.requeue(dest_id)
+                dest_schedule.add_dest_to_q(dest_id)
+                continue
+
+            logging.info(
+                f"🚜 {plot} ➡️  {destman.dest} - {int(plot_size_KB/(1024*1024))}GiB"
+            )
+
+            # Share the host's bandwidth cap between its transfers.  Paced
+            # engines follow the cap (and the transfers sharing it) chunk by
+            # chunk, rsync keeps the share it starts with.
+            if transport.paced:
+                bwlimit = partial(dest_schedule.bwlimit_share, host.dest_host)
+            else:
+                bwlimit = dest_schedule.transfer_bwlimit(host.dest_host, dest_id)
+            # Carry on from the partial file if this destination was part way
+            # through the plot when interrupted
+            resume = False
+            if journal is not None:
+                resume = journal.begin_transfer(str(plot), dest_id, plot_size)
+            transfer_desc = transport.describe(plot, destman, bwlimit, resume)
+
+            # Now transfer the real plot
+            metrics.inc("mownplow_plots_in_flight")
+            backpressure.publish("started", plot, plot_size)
+            start = datetime.now()
+            result = None
+            # Clear replots for the next plot (assumed to be the same size)
+            # while this one is on the wire
+            prepare = None
+            if incremental_remove:
+                prepare = asyncio.create_task(destman.prepare_next(plot_size_KB))
+            try:
+                with tracer.span("transfer", plot, dest_id) as span:
+                    result = await transport.transfer(
+                        plot, destman, TransferProgress(dest_id), bwlimit, resume
+                    )
+                    span["returncode"] = result.returncode
+                    span["bytes"] = plot_size
+            finally:
+                metrics.inc("mownplow_plots_in_flight", -1)
+                if prepare is not None:
+                    await prepare
+                # Let the plotter know whether the space was freed
+                if result is not None and result.returncode == 0:
+                    backpressure.publish("removed", plot, plot_size)
+                else:
+                    backpressure.publish("failed", plot, plot_size)
+            finish = datetime.now()
+            dest_schedule.release(dest_id)
+            if result.returncode != 0:
+                destman.ledger.release(plot.name)
+
+            if result.returncode == 0:
+                logging.info(f"🏁 {transfer_desc} ({finish - start})")
+                destman.record_plot(plot.name, plot_size)
+                if journal is not None:
+                    journal.end_transfer(str(plot))
+                metrics.inc("mownplow_plots_transferred_total", dest=dest_id)
+                logging.debug(f"Adding {dest_id} back to schedule")
+                dest_schedule.add_dest_to_q(dest_id)
+            elif result.returncode == 10:  # Error in socket I/O
+                # Retry later.
+                logging.warning(
+                    f"⁉️ {transfer_desc!r} exited with {result.returncode} (error in socket I/O)"
+                )
+                await plot_queue.put(plot)
+                await asyncio.sleep(SLEEP_FOR_LONG)
+                dest_schedule.add_dest_to_q(dest_id)
+            elif result.returncode in (11, 23):  # Error in file I/O
+                # Most likely a full drive.
+                logging.error(
+                    f"⁉️ {transfer_desc!r} exited with {result.returncode} (error in file I/O)"
+                )
+                destman.invalidate_inventory()
+                await plot_queue.put(plot)
+                logging.error(f"{destman.dest} plow exiting")
+                break
+            else:
+                logging.info(f"⁉️ {transfer_desc!r} exited with {result.returncode}")
+                await plot_queue.put(plot)
+                await asyncio.sleep(SLEEP_FOR)
+                logging.error(f"{destman.dest} plow exiting")
+                break
+            if result.stdout.strip():
+                logging.info(f"{result.stdout}")
+            if result.stderr:
+                logging.warning(f"⁉️ {result.stderr}")
+
+        except Exception:
+            logging.exception(f"! {destman.dest} failed")
+            # Hand the plot back so that another destination can take it
+            if plot is not None:
+                destman.ledger.release(plot.name)
+                await plot_queue.put(plot)
+            # Back off (giving up the slot meanwhile) then take plots again
+            dest_schedule.release(dest_id)
+            await asyncio.sleep(SLEEP_FOR)
+            dest_schedule.add_dest_to_q(dest_id)
+        finally:
+            dest_schedule.release(dest_id)
+
+    # No more plots for this destination
+    dest_schedule.rem_dest_from_priorities(dest_id)
+
+    # Sync destination path before completion
+    await destman.sync_dest_mount_path()
+    await asyncio.sleep(5)
+    
+    if manage_farming and not currently_farming_dest:
+        logging.info(f"Adding {destman.virtual_dest} back to farm")
+        await harvester_req.add_plot_directory(destman.virtual_dest)
+        currently_farming_dest = True
+
+    await asyncio.sleep(5)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Mow'n'Plow plot receiver.
+
+A small stand-alone agent for the harvester (or a local stand-in for
+testing) which accepts plots streamed by the sendfile transport and
+writes them into preallocated files under the plot root.  A transfer
+which is interrupted leaves its partial file behind, truncated to the
+bytes received, so that it can be resumed.
+
+Only plowers presenting the shared token (Transfer: Token in mownplow's
+config) are accepted, and the receiver only listens on the address it is
+given, which should be the harvester's address on the plotting network.
+The token is sent in the clear so the network should be a trusted one.
+
+Only uses the standard library so it can be copied to the harvester and
+run as:
+
+    python3 receiver.py --root /data/chia/plots --host 10.0.0.2 --port 12001 \\
+        --token-file /home/chia/.mownplow-token
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+import argparse
+import hmac
+import json
+import logging
+import os
+import socketserver
+from pathlib import Path
+
+CHUNK_SIZE = 8 * 1024 * 1024
+# Longest header line read before the client is authenticated
+HEADER_LIMIT = 64 * 1024
+
+
+class PlotReceiver(socketserver.StreamRequestHandler):
+    def handle(self):
+        header = json.loads(self.rfile.readline(HEADER_LIMIT))
+        if not hmac.compare_digest(
+            str(header.get("token", "")).encode(), self.server.token.encode()
+        ):
+            logging.warning(f"Refused a transfer from {self.client_address[0]}")
+            self._reply(ok=False, error="Unauthorised")
+            return
+        dest_dir = Path(self.server.root) / header["dir"]
+        name = header["name"]
+        size = int(header["size"])
+        if (
+            "/" in header["dir"]
+            or header["dir"] in ("", ".", "..")
+            or "/" in name
+            or name.startswith(".")
+        ):
+            self._reply(ok=False, error=f"Invalid destination {header}")
+            return
+
+        plot_path = dest_dir / name
+        part_path = dest_dir / f".{name}.part"
+        try:
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        except OSError as e:
+            self._reply(ok=False, error=str(e), errno=e.errno)
+            return
+
+        offset = 0
+        # Bytes of the plot written to the partial file so far
+        self.position = 0
+        try:
+            # A partial file shorter than the plot holds the bytes received by
+            # an interrupted transfer, anything else is started afresh
+            part_size = os.fstat(fd).st_size
+            if header.get("resume") and part_size < size:
+                offset = part_size
+            else:
+                os.ftruncate(fd, 0)
+            os.posix_fallocate(fd, offset, size - offset)
+            self.position = offset
+            # The client only starts streaming once the space is secured
+            self._reply(ok=True, offset=offset)
+            if self._receive(fd, size) != size:
+                raise ConnectionError(f"Received {self.position} of {size} bytes")
+            os.fsync(fd)
+            os.close(fd)
+            fd = None
+            os.rename(part_path, plot_path)
+            logging.info(f"Received {plot_path} ({size} bytes)")
+            self._reply(ok=True)
+        except OSError as e:
+            logging.error(f"Failed to receive {plot_path}: {e}")
+            if fd is not None and self.position:
+                # Keep what arrived for the next attempt
+                os.fsync(fd)
+                os.ftruncate(fd, self.position)
+            else:
+                part_path.unlink(missing_ok=True)
+            self._reply(ok=False, error=str(e), errno=e.errno)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _receive(self, fd: int, size: int) -> int:
+        # Write from self.position up to size, returning the position reached
+        if hasattr(os, "splice"):
+            return self._receive_splice(fd, size)
+        return self._receive_copy(fd, size)
+
+    def _receive_splice(self, fd: int, size: int) -> int:
+        # Zero-copy: socket -> pipe -> file without passing through userspace
+        sock_fd = self.connection.fileno()
+        pipe_r, pipe_w = os.pipe()
+        try:
+            while self.position < size:
+                count = os.splice(
+                    sock_fd, pipe_w, min(CHUNK_SIZE, size - self.position)
+                )
+                if count == 0:
+                    break
+                while count:
+                    written = os.splice(pipe_r, fd, count, offset_dst=self.position)
+                    self.position += written
+                    count -= written
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+        return self.position
+
+    def _receive_copy(self, fd: int, size: int) -> int:
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        while self.position < size:
+            count = self.connection.recv_into(
+                view, min(CHUNK_SIZE, size - self.position)
+            )
+            if count == 0:
+                break
+            self.position += os.pwrite(fd, view[:count], self.position)
+        return self.position
+
+    def _reply(self, **reply):
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+        self.wfile.flush()
+
+
+class ReceiverServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, root: str, token: str):
+        if not token:
+            raise ValueError("A token is required")
+        self.root = root
+        self.token = token
+        super().__init__(address, PlotReceiver)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mow'n'Plow plot receiver")
+    parser.add_argument("--root", required=True, help="Plot root directory")
+    parser.add_argument(
+        "--host", required=True, help="Address to listen on (the harvester's)"
+    )
+    parser.add_argument("--port", type=int, default=12001)
+    parser.add_argument(
+        "--token-file", required=True, help="File holding the shared token"
+    )
+    args = parser.parse_args()
+    token = Path(args.token_file).read_text().strip()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-2s %(message)s",
+        level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    with ReceiverServer((args.host, args.port), args.root, token) as server:
+        logging.info(
+            f"Receiving plots into {args.root} on {args.host}:{args.port}"
+        )
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,467 @@
+import asyncio
 import logging
-import queue
+import os
+import time
+from collections import deque
+from pathlib import Path
+
+from mownplow.metrics import metrics
+from mownplow.trace import tracer
+
+
+class DestHeap:
+    """
+    Indexed binary min-heap of (priority, dest) entries.
+
+    A position index is kept for every destination so that it can be
+    reprioritised or removed in O(log n) instead of by a linear search.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, dest):
+        return dest in self.index
+
+    def push(self, dest: str, priority: int):
+        if dest in self.index:
+            self.update(dest, priority)
+            return
+        self.heap.append((priority, dest))
+        self.index[dest] = len(self.heap) - 1
+        self._sift_up(len(self.heap) - 1)
 
-class PQueue(queue.PriorityQueue):
     def peek(self):
-        """
-        Return the highest-priority item in the queue without removing it.
+        if not self.heap:
+            return None
+        return self.heap[0][1]
 
-        :return: The highest-priority item in the queue.
-        :raises queue.Empty: If the priority queue is empty.
-        """
-        try:
-            with self.mutex:
-                return self.queue[0]
-        except IndexError:
-            raise queue.Empty
+    def pop(self):
+        if not self.heap:
+            return None
+        dest = self.heap[0][1]
+        self.remove(dest)
+        return dest
+
+    def update(self, dest: str, priority: int):
+        pos = self.index.get(dest)
+        if pos is None:
+            return
+        self.heap[pos] = (priority, dest)
+        self._sift_up(pos)
+        self._sift_down(self.index[dest])
+
+    def remove(self, dest: str) -> bool:
+        pos = self.index.pop(dest, None)
+        if pos is None:
+            return False
+        last = self.heap.pop()
+        if pos < len(self.heap):
+            self.heap[pos] = last
+            self.index[last[1]] = pos
+            self._sift_up(pos)
+            self._sift_down(self.index[last[1]])
+        return True
+
+    def _swap(self, i: int, j: int):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.index[self.heap[i][1]] = i
+        self.index[self.heap[j][1]] = j
+
+    def _sift_up(self, pos: int):
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if self.heap[pos] >= self.heap[parent]:
+                break
+            self._swap(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos: int):
+        size = len(self.heap)
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and self.heap[child] < self.heap[smallest]:
+                    smallest = child
+            if smallest == pos:
+                break
+            self._swap(pos, smallest)
+            pos = smallest
 
 
 class PlowScheduler:
-    # Manage plow priorities
+    # Manage plow priorities and hand plots straight to destination workers
 
-    def __init__(self):
-        self.dest_queue = PQueue()
+    def __init__(
+        self, max_transfers: int = 0, max_per_source: int = 0, placement: str = "priority"
+    ):
+        # Idle destinations which are ready to take a plot, per host
+        self.host_queues = {}
+        self.host_priorities = {}
+        self.host_max_transfers = {}
+        # Bandwidth cap (KB/s) shared by each host's transfers (0 = unlimited)
+        self.host_bwlimits = {}
+        self.host_in_flight = {}
+        # Share of its host's cap (KB/s) held by each transfer in flight
+        self.bwlimit_shares = {}
+        self.dest_hosts = {}
         self.dest_priorities = {}
+        self.dest_inboxes = {}
+        # Space (KB) each destination can still take, as reported by its worker
+        self.dest_capacity = {}
+
+        # "priority" fills drives in priority order, "bestfit" sends each plot
+        # to the drive it leaves with the least space to spare
+        self.placement = placement
+        # Smallest plot seen so far, drives with less space than this are full
+        self.min_plot_size_KB = None
+        # Interrupted plots go back to the destination holding their partial
+        # file for as long as it is in the schedule
+        self.affinity = {}
+
+        # Parallelism budget (0 = unlimited)
+        self.max_transfers = max_transfers
+        self.max_per_source = max_per_source
+
+        # Plots waiting for a destination as (plot, source device, KB, arrival),
+        # queued per source device
+        self.pending = {}
+        # A directory on each source device to check its free space against
+        self.source_dirs = {}
+        # Source device being read by each busy destination, and the pending
+        # entry of the plot it was handed
+        self.in_flight = {}
+        self.assigned = {}
+        self.source_in_flight = {}
+
+        self.changed = asyncio.Event()
+        # Time source for queue waits (replaced by the simulator)
+        self.clock = time.monotonic
 
-    def add_dest_priority(self, dest: str, priority: int):
+    def add_host(
+        self, host: str, priority: int = 0, max_transfers: int = 0, bwlimit: int = 0
+    ):
+        logging.debug(f"Adding Host: {host} - Priority: {priority} to schedule")
+        self.host_queues.setdefault(host, DestHeap())
+        self.host_priorities[host] = priority
+        self.host_max_transfers[host] = max_transfers
+        self.host_bwlimits[host] = bwlimit
+        self.host_in_flight.setdefault(host, 0)
+
+    def set_host_limits(
+        self, host: str, max_transfers: int = None, bwlimit: int = None
+    ):
+        # Change a host's caps while running, transfers already in flight
+        # carry on as they are
+        if max_transfers is not None:
+            self.host_max_transfers[host] = max_transfers
+        if bwlimit is not None:
+            self.host_bwlimits[host] = bwlimit
+        self.changed.set()
+
+    def set_host_priority(self, host: str, priority: int):
+        self.host_priorities[host] = priority
+        self.changed.set()
+
+    def add_dest_priority(self, dest: str, priority: int, host: str = None):
         logging.debug(f"Adding Dest: {dest} - Priority: {priority} to schedule")
+        if host not in self.host_queues:
+            self.add_host(host)
+        self.dest_hosts[dest] = host
         self.dest_priorities[dest] = priority
-        self.dest_queue.put((priority, dest))
+        self.dest_inboxes.setdefault(dest, asyncio.Queue(maxsize=1))
+        self.add_dest_to_q(dest)
 
-    def get_current_priority(self):
-        try:
-            priority, dest = self.dest_queue.peek()
-            return dest
-        except IndexError:
-            logging.error("The priority queue is empty")
-            return None
+    def prefer(self, plot: Path, dest: str):
+        self.affinity[plot] = dest
 
-    def remove_current_priority(self):
-        priority, dest = self.dest_queue.get()
-        return dest
+    def update_dest_space(self, dest: str, capacity_KB: int):
+        self.dest_capacity[dest] = capacity_KB
+
+    def dest_is_full(self, dest: str) -> bool:
+        # Full once the drive can't take even the smallest plot seen so far
+        capacity_KB = self.dest_capacity.get(dest)
+        if capacity_KB is None or self.min_plot_size_KB is None:
+            return False
+        return capacity_KB < self.min_plot_size_KB
 
     def add_dest_to_q(self, dest: str):
-        self.dest_queue.put((self.dest_priorities[dest], dest))
+        if dest not in self.dest_priorities:
+            return
+        self.host_queues[self.dest_hosts[dest]].push(dest, self.dest_priorities[dest])
+        self.changed.set()
 
     def rem_dest_from_priorities(self, dest: str):
         self.dest_priorities.pop(dest, None)
+        self.dest_capacity.pop(dest, None)
+        if dest in self.dest_hosts:
+            self.host_queues[self.dest_hosts[dest]].remove(dest)
+        self.release(dest)
+
+    def retire(self, dest: str):
+        # Stop handing plots to a destination which has gone.  Its worker
+        # finishes any transfer in flight (keeping its slot until then) and
+        # exits when it is handed None.
+        self.dest_priorities.pop(dest, None)
+        self.dest_capacity.pop(dest, None)
+        if dest in self.dest_hosts:
+            self.host_queues[self.dest_hosts[dest]].remove(dest)
+        if dest in self.dest_inboxes:
+            asyncio.ensure_future(self.dest_inboxes[dest].put(None))
+
+    def transfers_to_host(self, host: str) -> int:
+        return self.host_in_flight.get(host, 0)
+
+    def transfer_bwlimit(self, host: str, dest: str) -> int:
+        # Share of the host's bandwidth cap for a transfer to dest starting
+        # now: an even split, but never more than the transfers already in
+        # flight have left, so that the shares add up to no more than the cap
+        bwlimit = self.host_bwlimits.get(host, 0)
+        if not bwlimit:
+            return 0
+        self.bwlimit_shares.pop(dest, None)
+        share = min(
+            bwlimit // max(self.transfers_to_host(host), 1),
+            self._bandwidth_left(host),
+        )
+        self.bwlimit_shares[dest] = max(share, 1)
+        return self.bwlimit_shares[dest]
+
+    def bwlimit_share(self, host: str) -> int:
+        # Even split of the host's cap between its transfers in flight right
+        # now, for engines which re-read it as they go
+        bwlimit = self.host_bwlimits.get(host, 0)
+        if not bwlimit:
+            return 0
+        return max(bwlimit // max(self.transfers_to_host(host), 1), 1)
+
+    def _bandwidth_left(self, host: str) -> float:
+        # KB/s of the host's cap not held by its transfers in flight
+        bwlimit = self.host_bwlimits.get(host, 0)
+        if not bwlimit:
+            return float("inf")
+        return bwlimit - sum(
+            share
+            for dest, share in self.bwlimit_shares.items()
+            if self.dest_hosts.get(dest) == host
+        )
+
+    def submit(self, plot: Path):
+        try:
+            plot_stat = plot.stat()
+        except OSError as e:
+            logging.info(f"! Skipping {plot}: {e}")
+            return
+        self.source_dirs.setdefault(plot_stat.st_dev, plot.parent)
+        self.enqueue(plot, plot_stat.st_dev, plot_stat.st_size // 1024)
+
+    def enqueue(self, plot: Path, device, size_KB: int, arrival: float = None):
+        if self.min_plot_size_KB is None or size_KB < self.min_plot_size_KB:
+            self.min_plot_size_KB = size_KB
+        if arrival is None:
+            arrival = self.clock()
+        self.pending.setdefault(device, deque()).append(
+            (plot, device, size_KB, arrival)
+        )
+        metrics.set("mownplow_queue_depth", self.pending_count())
+        self.changed.set()
+
+    def pending_count(self) -> int:
+        return sum(len(source_queue) for source_queue in self.pending.values())
+
+    def discard(self, plot: Path):
+        # Forget a pending plot which has disappeared from its source
+        for device, source_queue in self.pending.items():
+            for entry in source_queue:
+                if entry[0] == plot:
+                    source_queue.remove(entry)
+                    if not source_queue:
+                        del self.pending[device]
+                    metrics.set("mownplow_queue_depth", self.pending_count())
+                    return
+
+    def requeue(self, dest: str):
+        # Give back the plot handed to a destination which couldn't take it,
+        # in its original place in line
+        entry = self.assigned.pop(dest, None)
+        if entry is None:
+            return
+        source_queue = self.pending.setdefault(entry[1], deque())
+        position = 0
+        while position < len(source_queue) and source_queue[position][3] <= entry[3]:
+            position += 1
+        source_queue.insert(position, entry)
+        metrics.set("mownplow_queue_depth", self.pending_count())
+        self.changed.set()
+
+    def release(self, dest: str):
+        # Free the transfer slot held by a destination
+        self.assigned.pop(dest, None)
+        self.bwlimit_shares.pop(dest, None)
+        device = self.in_flight.pop(dest, None)
+        if device is None:
+            return
+        self.source_in_flight[device] -= 1
+        self.host_in_flight[self.dest_hosts[dest]] -= 1
+        self.changed.set()
+
+    def assign(self) -> list:
+        # Pair pending plots with idle destinations within the budget
+        assignments = []
+        # Plots which don't fit any idle destination keep their place in line
+        unplaced = []
+        source_free = {device: self._source_free(device) for device in self.pending}
+        while self.pending:
+            if self.max_transfers and len(self.in_flight) >= self.max_transfers:
+                break
+            hosts = self._ready_hosts()
+            if not hosts:
+                break
+            entry = self._next_pending(source_free)
+            if entry is None:
+                break
+            plot, device, size_KB, arrival = entry
+            dest = self._place(hosts, plot, size_KB)
+            if dest is None:
+                unplaced.append(entry)
+                continue
+            host = self.dest_hosts[dest]
+            self.host_queues[host].remove(dest)
+            self.host_in_flight[host] += 1
+            metrics.inc("mownplow_dispatched_plots_total")
+            metrics.inc("mownplow_dispatch_seconds_total", self.clock() - arrival)
+            tracer.record("queue", plot, dest, self.clock() - arrival)
+            self.in_flight[dest] = device
+            self.assigned[dest] = entry
+            self.source_in_flight[device] = self.source_in_flight.get(device, 0) + 1
+            assignments.append((plot, dest))
+            self.affinity.pop(plot, None)
+        for entry in reversed(unplaced):
+            self.pending.setdefault(entry[1], deque()).appendleft(entry)
+        metrics.set("mownplow_queue_depth", self.pending_count())
+        return assignments
+
+    def _source_free(self, device) -> float:
+        # Free bytes on a source device (unknown sources go last)
+        try:
+            stat = os.statvfs(self.source_dirs[device])
+        except OSError:
+            return float("inf")
+        free = stat.f_bavail * stat.f_frsize
+        metrics.set("mownplow_source_free_bytes", free, device=device)
+        return free
+
+    def _ready_hosts(self) -> list:
+        # Spread transfers across hosts: hosts with an idle destination, those
+        # with the fewest transfers in flight (then the best priority) first.
+        # A host whose bandwidth cap is all taken waits for a transfer to end.
+        candidates = [
+            host
+            for host, dest_queue in self.host_queues.items()
+            if dest_queue
+            and (
+                not self.host_max_transfers[host]
+                or self.host_in_flight[host] < self.host_max_transfers[host]
+            )
+            and self._bandwidth_left(host) > 0
+        ]
+        return sorted(
+            candidates,
+            key=lambda host: (self.host_in_flight[host], self.host_priorities[host]),
+        )
+
+    def _fits(self, dest: str, size_KB: int) -> bool:
+        # Destinations which haven't reported their space yet are assumed to fit
+        capacity_KB = self.dest_capacity.get(dest)
+        return capacity_KB is None or capacity_KB > size_KB
+
+    def _place(self, hosts: list, plot: Path, size_KB: int):
+        preferred = self.affinity.get(plot)
+        if preferred is not None:
+            if preferred in self.dest_priorities:
+                # Wait for the destination unless it is idle now
+                host = self.dest_hosts[preferred]
+                if host in hosts and preferred in self.host_queues[host]:
+                    return preferred
+                return None
+            del self.affinity[plot]
+        for host in hosts:
+            dest_queue = self.host_queues[host]
+            if self.placement == "bestfit":
+                dest = self._best_fit(dest_queue, size_KB)
+            else:
+                dest = self._first_fit(dest_queue, size_KB)
+            if dest is not None:
+                return dest
+        return None
+
+    def _first_fit(self, dest_queue: DestHeap, size_KB: int):
+        # Highest priority destination with room for the plot
+        dest = dest_queue.peek()
+        if self._fits(dest, size_KB):
+            return dest
+        for _, dest in sorted(dest_queue.heap):
+            if self._fits(dest, size_KB):
+                return dest
+        return None
+
+    def _best_fit(self, dest_queue: DestHeap, size_KB: int):
+        # Destination left with the least space after taking the plot, so that
+        # part filled drives are finished before new ones are started
+        best = None
+        best_key = None
+        for priority, dest in dest_queue.heap:
+            if not self._fits(dest, size_KB):
+                continue
+            capacity_KB = self.dest_capacity.get(dest)
+            leftover = float("inf") if capacity_KB is None else capacity_KB - size_KB
+            if best_key is None or (leftover, priority) < best_key:
+                best, best_key = dest, (leftover, priority)
+        return best
+
+    def _next_pending(self, source_free: dict):
+        # Oldest plot from the source device with a free read slot and the
+        # least free space, so that no plotter's staging disk fills up
+        devices = [
+            device
+            for device in self.pending
+            if not self.max_per_source
+            or self.source_in_flight.get(device, 0) < self.max_per_source
+        ]
+        if not devices:
+            return None
+        device = min(
+            devices,
+            key=lambda device: (
+                source_free.get(device, float("inf")),
+                self.pending[device][0][3],
+            ),
+        )
+        source_queue = self.pending[device]
+        entry = source_queue.popleft()
+        if not source_queue:
+            del self.pending[device]
+        return entry
+
+    async def get_plot(self, dest: str):
+        return await self.dest_inboxes[dest].get()
+
+    async def dispatch(self, plot_queue: asyncio.Queue):
+        feeder = asyncio.create_task(self._feed(plot_queue))
+        try:
+            while True:
+                for plot, dest in self.assign():
+                    logging.debug(f"Dispatching {plot} to {dest}")
+                    self.dest_inboxes[dest].put_nowait(plot)
+                self.changed.clear()
+                await self.changed.wait()
+        finally:
+            feeder.cancel()
+
+    async def _feed(self, plot_queue: asyncio.Queue):
+        while True:
+            self.submit(await plot_queue.get())
@@ -0,0 +1,649 @@
+#!/usr/bin/env python3
+"""
+Mow'n'Plow trace replay simulator.
+
+Replays plot arrivals against simulated harvesters by running the real
+plow() workers, with their DestMan and SpaceLedger, and PlowScheduler on
+an event loop whose clock jumps straight to the next timer whenever every
+task is waiting.  Only the drives, the harvester's RPCs and the network
+links are simulated, so harvester removal and re-adding (ReaddAfter),
+replot deletion, space checks and drives filling up all follow plow()
+itself.  Each policy is scored on throughput, drive-hours spent off the
+harvester, how far the source disks fill up and how long plotters are
+held up by a full source disk (a plotter whose plot doesn't fit is
+paused, delaying the rest of its plots, until one leaves).  Concurrency,
+placement, shuffling and FarmDuring/ReaddAfter can then be tuned offline.
+
+A scenario is a JSON file (sizes in GiB, speeds in MiB/s, times in s):
+
+    {
+      "link": 1100, "rpc_seconds": 0.2, "delete_seconds": 2.0,
+      "replot_size": 101.4,
+      "hosts": [{"host": "chia01", "priority": 1, "max_transfers": 0,
+                 "link": 1100,
+                 "drives": [{"dir": "c0b0", "free": 10, "replots": 16000,
+                             "write": 250}]}],
+      "sources": {"nvme0": 3600},
+      "plots": [{"time": 0, "size": 81.3, "source": "nvme0"}]
+    }
+
+Replots are whole files of replot_size (by default the first plot's
+size).  A scenario is otherwise generated from the command line options.
+Arrivals (and sizes) can instead be taken from a stage trace written by
+the plower (Trace: Path).
+
+    python -m mownplow.simulate --plots 500 --interval 120 \\
+        --policy max_transfers=2 --policy placement=bestfit,max_transfers=4
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import selectors
+from types import SimpleNamespace
+
+from mownplow.config import DestHost
+from mownplow.destfs import DestFS
+from mownplow.plow import plow
+from mownplow.scheduler import PlowScheduler
+from mownplow.trace import load, percentile
+from mownplow.transport import (
+    TRANSFER_FILE_ERROR,
+    TRANSFER_OK,
+    TransferResult,
+    Transport,
+)
+
+GiB_KB = 1024 * 1024
+# Destinations are mounted below this root on every simulated host
+SIM_ROOT = "/sim"
+# Replots are dated before the cutoff, plots moved in by the simulation after
+REPLOT_MTIME = 0.0
+REPLOT_CUTOFF = 1.0
+
+# plow() settings a policy may change, with their defaults
+POLICY = {
+    "placement": "priority",
+    "max_transfers": 0,
+    "max_per_source": 0,
+    "host_max_transfers": None,
+    "shuffle": False,
+    "farm_during": False,
+    "readd_after": 0,
+    "replot": True,
+    "seed": 0,
+}
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    # Rather than waiting for the next timer, move the loop's clock to it
+
+    def __init__(self, loop: "SimLoop"):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Nothing will ever happen again
+            self.loop.stop()
+        else:
+            self.loop.now += timeout
+        return events
+
+
+class SimLoop(asyncio.SelectorEventLoop):
+    # Event loop running in simulated time, which stops once idle for good
+
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.now
+
+
+class SimPlot:
+    # A plot waiting on a source disk, standing in for its Path
+
+    def __init__(self, number: int, source: str, size_KB: int, time: float):
+        self.source = source
+        self.size_KB = size_KB
+        self.time = time
+        self.arrival = None
+        self.name = f"plot-k32-sim-{number:06d}.plot"
+        self.parent = f"/{source}"
+
+    def __str__(self):
+        return f"{self.parent}/{self.name}"
+
+    def stat(self):
+        return SimpleNamespace(st_size=self.size_KB * 1024, st_dev=self.source)
+
+
+class SimScheduler(PlowScheduler):
+    # Source free space comes from the simulation rather than statvfs
+
+    def __init__(self, source_free, *args):
+        super().__init__(*args)
+        self.source_free = source_free
+
+    def _source_free(self, device) -> float:
+        return self.source_free(device)
+
+
+class Drive:
+    def __init__(self, mount_path: str, drive: dict, replot_KB: int):
+        self.free_KB = drive.get("free", 0) * GiB_KB
+        self.write_KBps = drive.get("write", 250) * 1024
+        # Replot path -> bytes
+        count = int(drive.get("replots", 0) * GiB_KB // replot_KB) if replot_KB else 0
+        self.replots = {
+            f"{mount_path}/plot-k32-replot-{number:05d}.plot": replot_KB * 1024
+            for number in range(count)
+        }
+
+
+class SimFS(DestFS):
+    # A host's drives, each mounted at <Root>/<dir>
+
+    def __init__(self, drives: dict, delete_seconds: float):
+        # Mount path -> Drive
+        self.drives = drives
+        self.delete_seconds = delete_seconds
+
+    async def discover(self, dest_root: str) -> list:
+        return sorted(self.drives)
+
+    async def mount_path(self, dest_root: str, dest_dir: str) -> str:
+        path = f"{dest_root}/{dest_dir}"
+        return path if path in self.drives else None
+
+    async def free_space(self, mount_path: str) -> int:
+        return int(self.drives[mount_path].free_KB)
+
+    async def listing(self, mount_path: str, replot_before: str = None):
+        files = {
+            path: (REPLOT_MTIME, size)
+            for path, size in self.drives[mount_path].replots.items()
+        }
+        return files, REPLOT_CUTOFF if replot_before else None
+
+    async def remove(self, mount_path: str, paths: list) -> dict:
+        await asyncio.sleep(self.delete_seconds)
+        drive = self.drives[mount_path]
+        report = {}
+        for path in paths:
+            size = drive.replots.pop(path, None)
+            if size is not None:
+                drive.free_KB += size // 1024
+            report[path] = size is not None
+        return report
+
+    async def sync(self, mount_path: str) -> bool:
+        return True
+
+    async def read_file(self, path: str) -> bytes:
+        raise OSError(f"{path} is not part of the simulation")
+
+
+class SimHarvester:
+    # A harvester's plot directory RPCs, each taking rpc_seconds
+
+    def __init__(self, rpc_seconds: float):
+        self.rpc_seconds = rpc_seconds
+        # Directories removed from the harvester -> when they were removed
+        self.offline = {}
+        self.offline_seconds = 0.0
+
+    async def remove_plot_directory(self, directory: str):
+        await asyncio.sleep(self.rpc_seconds)
+        self.offline.setdefault(directory, asyncio.get_running_loop().time())
+
+    async def add_plot_directory(self, directory: str):
+        await asyncio.sleep(self.rpc_seconds)
+        removed_at = self.offline.pop(directory, None)
+        if removed_at is not None:
+            self.offline_seconds += asyncio.get_running_loop().time() - removed_at
+
+    def offline_time(self, now: float) -> float:
+        # Drives which were never added back stay offline to the end
+        return self.offline_seconds + sum(
+            now - removed_at for removed_at in self.offline.values()
+        )
+
+
+class Flow:
+    def __init__(self, size_KB: int, limit_KBps: float, done: asyncio.Future):
+        self.remaining_KB = float(size_KB)
+        self.limit_KBps = limit_KBps
+        self.rate = 0.0
+        self.done = done
+        self.handle = None
+
+
+class Link:
+    # A host's link, shared equally by its transfers, each of which is also
+    # held to its drive's write speed and bandwidth cap
+
+    def __init__(self, speed_KBps: float):
+        self.speed_KBps = speed_KBps
+        self.flows = []
+        self.updated = 0.0
+
+    async def send(self, size_KB: int, limit_KBps: float):
+        loop = asyncio.get_running_loop()
+        flow = Flow(size_KB, limit_KBps, loop.create_future())
+        self._advance(loop)
+        self.flows.append(flow)
+        self._reschedule(loop)
+        try:
+            await flow.done
+        finally:
+            self._advance(loop)
+            self.flows.remove(flow)
+            if flow.handle is not None:
+                flow.handle.cancel()
+            self._reschedule(loop)
+
+    def _advance(self, loop):
+        elapsed = loop.time() - self.updated
+        for flow in self.flows:
+            flow.remaining_KB -= flow.rate * elapsed
+        self.updated = loop.time()
+
+    def _reschedule(self, loop):
+        # Finish times move whenever a transfer joins or leaves the link
+        for flow in self.flows:
+            flow.rate = min(self.speed_KBps / len(self.flows), flow.limit_KBps)
+            if flow.handle is not None:
+                flow.handle.cancel()
+            if not flow.done.done():
+                flow.handle = loop.call_at(
+                    loop.time() + max(flow.remaining_KB, 0) / flow.rate,
+                    flow.done.set_result,
+                    None,
+                )
+
+
+class SimTransport(Transport):
+    # Plots sent over the host's link, failing like rsync on a full drive
+
+    def __init__(self, simulation: "Simulation", link: Link, drives: dict):
+        self.simulation = simulation
+        self.link = link
+        self.drives = drives
+
+    def describe(self, plot, destman, bwlimit: int = 0, resume: bool = False) -> str:
+        return f"{plot} -> {destman.dest}"
+
+    async def transfer(
+        self, plot, destman, progress=None, bwlimit: int = 0, resume: bool = False
+    ) -> TransferResult:
+        drive = self.drives[destman.dest_mount_path]
+        if drive.free_KB <= plot.size_KB:
+            return TransferResult(TRANSFER_FILE_ERROR, stderr="No space left on device")
+        self.simulation.started(plot)
+        limit_KBps = min(drive.write_KBps, bwlimit or float("inf"))
+        await self.link.send(plot.size_KB, limit_KBps)
+        drive.free_KB -= plot.size_KB
+        self.simulation.finished(plot)
+        return TransferResult(TRANSFER_OK)
+
+
+class Simulation:
+    def __init__(self, scenario: dict, policy: dict):
+        self.scenario = scenario
+        self.policy = dict(POLICY, **policy)
+        self.rpc_seconds = scenario.get("rpc_seconds", 0.2)
+        self.delete_seconds = scenario.get("delete_seconds", 2.0)
+        # The settings plow() and DestMan read
+        self.config = SimpleNamespace(
+            replot=self.policy["replot"],
+            replot_before="simulated" if self.policy["replot"] else None,
+            remove_all_replots=False,
+            farm_during_plow=self.policy["farm_during"],
+            readd_after=self.policy["readd_after"],
+            space_check_interval=600,
+        )
+
+        # Source device -> capacity and KB waiting on it
+        self.source_capacity = {
+            source: capacity * GiB_KB
+            for source, capacity in scenario.get("sources", {}).items()
+        }
+        self.source_used = dict.fromkeys(self.source_capacity, 0)
+        self.source_high_water = dict.fromkeys(self.source_capacity, 0)
+        # Plots to come from each source's plotter, how far behind it has
+        # fallen while paused on a full source disk
+        self.plots = {}
+        for number, plot in enumerate(scenario["plots"]):
+            source = plot["source"]
+            self.plots.setdefault(source, []).append(
+                SimPlot(number, source, int(plot["size"] * GiB_KB), plot["time"])
+            )
+            self.source_capacity.setdefault(source, float("inf"))
+            self.source_used.setdefault(source, 0)
+            self.source_high_water.setdefault(source, 0)
+        for plots in self.plots.values():
+            plots.sort(key=lambda plot: plot.time)
+        self.lag = dict.fromkeys(self.plots, 0.0)
+        self.stall_seconds = 0.0
+        self.freed = {}
+
+        self.harvesters = []
+        self.moved = 0
+        self.moved_KB = 0
+        self.plot_count = len(scenario["plots"])
+        self.first_arrival = min(
+            (plot["time"] for plot in scenario["plots"]), default=0
+        )
+        self.last_finish = 0.0
+        self.waits = []
+
+    def _source_free(self, source) -> float:
+        return self.source_capacity[source] - self.source_used[source]
+
+    async def _start(self, loop: SimLoop):
+        scheduler = SimScheduler(
+            self._source_free,
+            self.policy["max_transfers"],
+            self.policy["max_per_source"],
+            self.policy["placement"],
+        )
+        scheduler.clock = loop.time
+        plot_queue = asyncio.Queue()
+
+        replot_size = self.scenario.get("replot_size")
+        if replot_size is None and self.scenario["plots"]:
+            replot_size = self.scenario["plots"][0]["size"]
+        replot_KB = int((replot_size or 0) * GiB_KB)
+
+        # Shuffled as the plower would, reproducibly
+        state = random.getstate()
+        random.seed(self.policy["seed"])
+        for index, spec in enumerate(self.scenario["hosts"]):
+            max_transfers = self.policy["host_max_transfers"]
+            if max_transfers is None:
+                max_transfers = spec.get("max_transfers", 0)
+            dest = {
+                "Host": spec["host"],
+                "Username": "sim",
+                "Protocol": "sim",
+                "Port": 0,
+                "Root": SIM_ROOT,
+                "Dirs": [drive["dir"] for drive in spec["drives"]],
+                "Priority": spec.get("priority", index + 1),
+                "MaxTransfers": max_transfers,
+            }
+            harvester = {
+                "Host": spec["host"],
+                "Port": 0,
+                "CACertPath": "",
+                "CertPath": "",
+                "KeyPath": "",
+            }
+            host = DestHost(dest, harvester, index, self.policy["shuffle"])
+            scheduler.add_host(
+                host.dest_host, host.priority, host.max_transfers, host.bwlimit
+            )
+
+            drives = {}
+            for drive in spec["drives"]:
+                mount_path = f"{SIM_ROOT}/{drive['dir']}"
+                drives[mount_path] = Drive(mount_path, drive, replot_KB)
+            fs = SimFS(drives, self.delete_seconds)
+            harvester_req = SimHarvester(self.rpc_seconds)
+            self.harvesters.append(harvester_req)
+            link = Link(spec.get("link", self.scenario.get("link", 1100)) * 1024)
+            transport = SimTransport(self, link, drives)
+            for priority, dest_dir in enumerate(host.dest_dirs, 1):
+                scheduler.add_dest_priority(
+                    f"{host.dest_host}/{dest_dir}", priority, host.dest_host
+                )
+                loop.create_task(
+                    plow(
+                        self.config,
+                        host,
+                        dest_dir,
+                        plot_queue,
+                        scheduler,
+                        fs,
+                        harvester_req,
+                        transport,
+                        None,
+                        loop,
+                    )
+                )
+        random.setstate(state)
+
+        loop.create_task(scheduler.dispatch(plot_queue))
+        for source, plots in self.plots.items():
+            self.freed[source] = asyncio.Event()
+            loop.create_task(self._plotter(loop, source, plots, plot_queue))
+
+    async def _plotter(self, loop: SimLoop, source: str, plots: list, plot_queue):
+        for plot in plots:
+            await asyncio.sleep(max(plot.time + self.lag[source] - loop.time(), 0))
+            if self._source_free(source) < plot.size_KB:
+                # The plotter is paused until a plot leaves its disk
+                since = loop.time()
+                while self._source_free(source) < plot.size_KB:
+                    self.freed[source].clear()
+                    await self.freed[source].wait()
+                self.lag[source] += loop.time() - since
+                self.stall_seconds += loop.time() - since
+            plot.arrival = loop.time()
+            self.source_used[source] += plot.size_KB
+            self.source_high_water[source] = max(
+                self.source_high_water[source], self.source_used[source]
+            )
+            await plot_queue.put(plot)
+
+    def started(self, plot: SimPlot):
+        self.waits.append(asyncio.get_running_loop().time() - plot.arrival)
+
+    def finished(self, plot: SimPlot):
+        self.source_used[plot.source] -= plot.size_KB
+        self.freed[plot.source].set()
+        self.moved += 1
+        self.moved_KB += plot.size_KB
+        self.last_finish = asyncio.get_running_loop().time()
+
+    def run(self) -> dict:
+        loop = SimLoop()
+        try:
+            start = loop.create_task(self._start(loop))
+            # Runs until every worker is waiting on plots that won't come
+            loop.run_forever()
+            start.result()
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            end = loop.time()
+        finally:
+            loop.close()
+        return self.results(end)
+
+    def results(self, end: float) -> dict:
+        elapsed = self.last_finish - self.first_arrival
+        waits = sorted(self.waits)
+        return {
+            "plots_moved": self.moved,
+            "plots_left": self.plot_count - self.moved,
+            "hours": round(elapsed / 3600, 2),
+            "plots_per_hour": round(self.moved / elapsed * 3600, 1) if elapsed else 0,
+            "throughput_MiBps": (
+                round(self.moved_KB / 1024 / elapsed, 1) if elapsed else 0
+            ),
+            "wait_p50_s": round(percentile(waits, 50), 1) if waits else 0,
+            "wait_p95_s": round(percentile(waits, 95), 1) if waits else 0,
+            "offline_drive_hours": round(
+                sum(harvester.offline_time(end) for harvester in self.harvesters)
+                / 3600,
+                1,
+            ),
+            "source_high_water_GiB": round(
+                max(self.source_high_water.values(), default=0) / GiB_KB, 1
+            ),
+            "plotter_stall_hours": round(self.stall_seconds / 3600, 1),
+        }
+
+
+def synthetic(opts) -> dict:
+    # A scenario from the command line options
+    rng = random.Random(opts.seed)
+    sources = {f"source{n}": opts.source_size for n in range(opts.sources)}
+    hosts = [
+        {
+            "host": f"harvester{h}",
+            "drives": [
+                {
+                    "dir": f"d{d:03d}",
+                    "free": opts.drive_free,
+                    "replots": opts.drive_replots,
+                    "write": opts.write,
+                }
+                for d in range(opts.drives)
+            ],
+        }
+        for h in range(opts.hosts)
+    ]
+    plots = []
+    when = 0.0
+    for number in range(opts.plots):
+        # Each source has its own plotter producing at the same rate
+        if number % opts.sources == 0 and number:
+            when += rng.expovariate(1 / opts.interval) if opts.jitter else opts.interval
+        plots.append(
+            {
+                "time": when,
+                "size": opts.plot_size,
+                "source": f"source{number % opts.sources}",
+            }
+        )
+    return {
+        "link": opts.link,
+        "rpc_seconds": opts.rpc_seconds,
+        "delete_seconds": opts.delete_seconds,
+        "hosts": hosts,
+        "sources": sources,
+        "plots": plots,
+    }
+
+
+def arrivals(path: str, source: str) -> list:
+    # Plot arrivals and sizes from a stage trace: a transfer's queue span
+    # ends when it was dispatched, seconds after the plot arrived
+    spans = load(path)
+    sizes = {
+        span["plot"]: span["bytes"]
+        for span in spans
+        if span["stage"] == "transfer" and "bytes" in span
+    }
+    times = {}
+    for span in spans:
+        if span["stage"] == "queue" and span["plot"] in sizes:
+            times.setdefault(span["plot"], span["time"] - span["seconds"])
+    start = min(times.values(), default=0)
+    return sorted(
+        (
+            {
+                "time": arrived - start,
+                "size": sizes[plot] / (1024**3),
+                "source": source,
+            }
+            for plot, arrived in times.items()
+        ),
+        key=lambda plot: plot["time"],
+    )
+
+
+def parse_policy(text: str) -> dict:
+    # "placement=bestfit,max_transfers=4" with values typed as in POLICY
+    policy = {}
+    for setting in filter(None, text.split(",")):
+        key, _, value = setting.partition("=")
+        if key not in POLICY:
+            raise argparse.ArgumentTypeError(f"Unknown policy setting {key!r}")
+        default = POLICY[key]
+        if isinstance(default, bool):
+            policy[key] = value.lower() in ("1", "true", "yes")
+        elif isinstance(default, int) or key == "host_max_transfers":
+            policy[key] = int(value)
+        else:
+            policy[key] = value
+    return policy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mow'n'Plow trace replay simulator")
+    parser.add_argument("--scenario", help="Scenario JSON file")
+    parser.add_argument("--arrivals", help="Take plot arrivals from a stage trace")
+    parser.add_argument(
+        "--policy",
+        action="append",
+        type=parse_policy,
+        help="Comma separated settings, e.g. placement=bestfit,max_transfers=4 "
+        + "(repeat to compare policies)",
+    )
+    synthetic_options = parser.add_argument_group("synthetic scenario")
+    synthetic_options.add_argument("--hosts", type=int, default=1)
+    synthetic_options.add_argument("--drives", type=int, default=20)
+    synthetic_options.add_argument("--drive-free", type=float, default=0)
+    synthetic_options.add_argument("--drive-replots", type=float, default=16000)
+    synthetic_options.add_argument("--write", type=float, default=250)
+    synthetic_options.add_argument("--link", type=float, default=1100)
+    synthetic_options.add_argument("--sources", type=int, default=2)
+    synthetic_options.add_argument("--source-size", type=float, default=3600)
+    synthetic_options.add_argument("--plots", type=int, default=500)
+    synthetic_options.add_argument("--plot-size", type=float, default=81.3)
+    synthetic_options.add_argument(
+        "--interval", type=float, default=120, help="Seconds between plots per source"
+    )
+    synthetic_options.add_argument("--jitter", action="store_true")
+    synthetic_options.add_argument("--rpc-seconds", type=float, default=0.2)
+    synthetic_options.add_argument("--delete-seconds", type=float, default=2.0)
+    synthetic_options.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results as JSON")
+    opts = parser.parse_args()
+
+    # The scheduler logs every placement, which would swamp the results
+    logging.disable(logging.INFO)
+
+    if opts.scenario:
+        with open(opts.scenario) as file:
+            scenario = json.load(file)
+    else:
+        scenario = synthetic(opts)
+    if opts.arrivals:
+        source = next(iter(scenario.get("sources") or {"source0": 0}))
+        scenario["plots"] = arrivals(opts.arrivals, source)
+
+    results = []
+    for policy in opts.policy or [{}]:
+        result = Simulation(scenario, policy).run()
+        name = ",".join(f"{key}={value}" for key, value in policy.items()) or "default"
+        results.append(dict(policy=name, **result))
+
+    columns = list(results[0])
+    widths = {
+        column: max(len(column), *(len(str(result[column])) for result in results))
+        for column in columns
+    }
+    print("  ".join(f"{column:>{widths[column]}}" for column in columns))
+    for result in results:
+        print("  ".join(f"{result[column]!s:>{widths[column]}}" for column in columns))
+    if opts.output:
+        with open(opts.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
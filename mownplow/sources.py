@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+import aionotify
+
+WATCH_FLAGS = (
+    aionotify.Flags.MOVED_TO | aionotify.Flags.MOVED_FROM | aionotify.Flags.DELETE
+)
+
+
+class SourceIndex:
+    """
+    Index of the plots waiting on the source drives.
+
+    Watches are set up before the initial scan so that no plot moved in
+    while scanning is missed.  Every plot is only enqueued once, keyed by
+    both its path and its (device, inode) so that an event for a plot which
+    has already been scanned (or renamed) doesn't queue it a second time.
+    """
+
+    def __init__(self, paths: list, plot_queue: asyncio.Queue, on_discard=None):
+        self.paths = paths
+        self.plot_queue = plot_queue
+        # Called with the path of each indexed plot which disappears
+        self.on_discard = on_discard
+        # path -> (st_dev, st_ino) and (st_dev, st_ino) -> path
+        self.plots = {}
+        self.inodes = {}
+
+    def __len__(self):
+        return len(self.plots)
+
+    def __contains__(self, path):
+        return str(path) in self.plots
+
+    def add(self, path: str, key: tuple) -> bool:
+        # Index a plot and report whether it needs to be queued
+        if self.plots.get(path) == key:
+            return False
+        previous = self.inodes.get(key)
+        if previous is not None:
+            if os.path.exists(previous):
+                # Another link to a plot which is already queued
+                return False
+            # The plot has been renamed since it was queued
+            self.discard(previous)
+        self.discard(path)
+        self.plots[path] = key
+        self.inodes[key] = path
+        return True
+
+    def discard(self, path: str) -> bool:
+        key = self.plots.pop(path, None)
+        if key is None:
+            return False
+        if self.inodes.get(key) == path:
+            del self.inodes[key]
+        if self.on_discard:
+            self.on_discard(Path(path))
+        return True
+
+    def scan(self) -> list:
+        # Find (path, key) for every plot below the source paths
+        found = []
+        stack = []
+        for path in self.paths:
+            try:
+                stack.append((path, os.stat(path).st_dev))
+            except OSError as e:
+                logging.info(f"! Unable to scan {path}: {e}")
+        while stack:
+            path, device = stack.pop()
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, entry.stat().st_dev))
+                        elif entry.name.endswith(".plot"):
+                            found.append((entry.path, (device, entry.inode())))
+            except OSError as e:
+                logging.info(f"! Unable to scan {path}: {e}")
+        return found
+
+    async def run(self, loop):
+        watcher = aionotify.Watcher()
+        for path in self.paths:
+            if not Path(path).exists():
+                logging.info(f"! Path does not exist: {path}")
+                continue
+            watcher.watch(alias=path, path=path, flags=WATCH_FLAGS)
+            logging.info(f"Watching {path}")
+        await watcher.setup(loop)
+
+        found = await loop.run_in_executor(None, self.scan)
+        for path, key in found:
+            await self._enqueue(path, key)
+        logging.info(f"Found {len(self.plots)} plots in {len(self.paths)} sources")
+
+        while True:
+            event = await watcher.get_event()
+            logging.info(event)
+            if not event.name.endswith(".plot"):
+                continue
+            path = os.path.join(event.alias, event.name)
+            if event.flags & aionotify.Flags.MOVED_TO:
+                try:
+                    plot_stat = os.stat(path)
+                except OSError:
+                    continue
+                await self._enqueue(path, (plot_stat.st_dev, plot_stat.st_ino))
+            else:
+                self.discard(path)
+
+    async def _enqueue(self, path: str, key: tuple):
+        if self.add(path, key):
+            await self.plot_queue.put(Path(path))
+            await asyncio.sleep(0)
@@ -3,30 +3,150 @@ import logging
 
 import asyncssh
 
+# Errors which mean the whole connection has gone, rather than just the
+# channel (e.g. ChannelOpenError when the server's MaxSessions is reached).
+# A connection the server has closed raises ChannelOpenError too, so it is
+# also checked for being closed.
+CONNECTION_ERRORS = (OSError, asyncssh.DisconnectError)
 
-class SSHClient:
-    def __init__(self, hostname: str, username: str, private_key_path: str):
+
+class PooledConnection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.active = 0
+
+
+class SSHPool:
+    # Share a bounded number of SSH connections between all workers.
+    # Commands run as channels multiplexed over the pooled connections.
+
+    def __init__(
+        self,
+        hostname: str,
+        username: str,
+        private_key_path: str,
+        port: int = 22,
+        max_connections: int = 4,
+        max_sessions: int = 8,
+        known_hosts: str = None,
+    ):
         self.hostname = hostname
         self.username = username
         self.private_key_path = private_key_path
-        self.connection = None
+        self.port = port
+        self.max_connections = max_connections
+        self.max_sessions = max_sessions
+        # None keeps the asyncssh default (~/.ssh/known_hosts)
+        self.known_hosts = known_hosts
+
+        self.connections = []
+        self.connect_lock = asyncio.Lock()
+        # Caps the number of sessions (commands and resident processes) in
+        # use across the whole pool
+        self.in_flight = asyncio.Semaphore(max_connections * max_sessions)
 
     async def connect(self):
-        self.connection = await asyncssh.connect(
-            self.hostname, username=self.username, client_keys=[self.private_key_path]
+        async with self.connect_lock:
+            if not self.connections:
+                await self._open_connection()
+
+    async def _open_connection(self) -> PooledConnection:
+        options = {}
+        if self.known_hosts is not None:
+            options["known_hosts"] = self.known_hosts
+        connection = await asyncssh.connect(
+            self.hostname,
+            port=self.port,
+            username=self.username,
+            client_keys=[self.private_key_path],
+            **options,
+        )
+        pooled = PooledConnection(connection)
+        self.connections.append(pooled)
+        logging.debug(
+            f"SSH connected to {self.username}@{self.hostname} "
+            + f"({len(self.connections)}/{self.max_connections})"
         )
-        logging.debug(f"SSH connected to {self.username}@{self.hostname}")
+        return pooled
+
+    async def _acquire(self) -> PooledConnection:
+        # Called holding an in_flight slot, so a session is always free on an
+        # existing connection or another connection may be opened
+        async with self.connect_lock:
+            self._prune()
+            available = [c for c in self.connections if c.active < self.max_sessions]
+            # Only open another connection once the existing ones are busy
+            if len(self.connections) < self.max_connections and not any(
+                c.active == 0 for c in available
+            ):
+                pooled = await self._open_connection()
+            else:
+                pooled = min(available, key=lambda c: c.active)
+            pooled.active += 1
+            return pooled
+
+    def _prune(self):
+        # Forget connections which the server (or the network) has closed
+        for pooled in [c for c in self.connections if c.connection.is_closed()]:
+            self.connections.remove(pooled)
+            logging.warning(f"SSH connection to {self.hostname} closed")
+
+    def _discard(self, pooled: PooledConnection, error: Exception):
+        # Only close a connection which has failed, as closing it ends every
+        # other channel on it (including long running agents)
+        if not isinstance(error, CONNECTION_ERRORS):
+            self._prune()
+            return
+        if pooled in self.connections:
+            self.connections.remove(pooled)
+            pooled.connection.close()
+            logging.warning(f"SSH connection to {self.hostname} dropped")
 
-    async def run_command(self, command: str):
-        if self.connection is None:
-            await self.connect()
+    async def run_command(self, command: str, input: str = None, encoding="utf-8"):
+        async with self.in_flight:
+            logging.debug(f"SSH running: {command}")
+            # Retry once, on a fresh connection if the current one has failed
+            for attempt in range(2):
+                pooled = await self._acquire()
+                try:
+                    return await pooled.connection.run(
+                        command, input=input, encoding=encoding
+                    )
+                except (OSError, asyncssh.Error) as e:
+                    self._discard(pooled, e)
+                    if attempt:
+                        raise
+                    logging.warning(f"⁉️  SSH {command!r} failed: {e}")
+                finally:
+                    pooled.active -= 1
 
-        logging.debug(f"SSH running: {command}")
-        result = await self.connection.run(command)
+    async def start_process(self, command: str):
+        # A long running command which holds one of the pool's sessions until
+        # it exits
+        await self.in_flight.acquire()
+        try:
+            pooled = await self._acquire()
+        except BaseException:
+            self.in_flight.release()
+            raise
+        try:
+            process = await pooled.connection.create_process(command)
+        except (OSError, asyncssh.Error) as e:
+            pooled.active -= 1
+            self.in_flight.release()
+            self._discard(pooled, e)
+            raise
+        asyncio.create_task(self._release_on_exit(pooled, process))
+        return process
 
-        return result
+    async def _release_on_exit(self, pooled: PooledConnection, process):
+        try:
+            await process.wait_closed()
+        finally:
+            pooled.active -= 1
+            self.in_flight.release()
 
     async def close(self):
-        if self.connection is not None:
-            self.connection.close()
-            self.connection = None
+        for pooled in self.connections:
+            pooled.connection.close()
+        self.connections = []
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Mow'n'Plow stage tracing.
+
+Each stage a plot goes through (waiting in the queue, harvester removal,
+replot deletion, the free space check, the transfer and the flush) is
+written as one JSON object per line:
+
+    {"time": ..., "stage": "transfer", "plot": ..., "dest": ..., "seconds": ...}
+
+where time is the wall clock time at which the stage finished.  Run as a
+script to summarise a trace:
+
+    python -m mownplow.trace mownplow-trace.jsonl [--by-dest]
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+import argparse
+import json
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+# Stages in the order a plot goes through them
+STAGES = (
+    "queue",
+    "harvester_remove",
+    "replot_delete",
+    "free_space",
+    "transfer",
+    "prepare",
+    "sync",
+)
+
+
+class Tracer:
+    # Writes stage timings as JSON lines (does nothing until opened)
+
+    def __init__(self):
+        self.file = None
+
+    def open(self, path: str):
+        # Line buffered so that a trace survives the plower being killed
+        self.file = open(path, "a", buffering=1)
+        logging.info(f"⏱️  Tracing stages to {path}")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def record(self, stage: str, plot, dest: str, seconds: float, **fields):
+        if self.file is None:
+            return
+        span = {
+            "time": round(time.time(), 3),
+            "stage": stage,
+            "plot": plot.name if plot is not None else None,
+            "dest": dest,
+            "seconds": round(seconds, 6),
+        }
+        span.update(fields)
+        self.file.write(json.dumps(span) + "\n")
+
+    @contextmanager
+    def span(self, stage: str, plot, dest: str):
+        # Time the enclosed block, which may add fields to the dict it is
+        # given, marking stages which raised
+        fields = {}
+        start = time.monotonic()
+        try:
+            yield fields
+        except BaseException:
+            fields["error"] = True
+            raise
+        finally:
+            self.record(stage, plot, dest, time.monotonic() - start, **fields)
+
+
+tracer = Tracer()
+
+
+def load(path: str) -> list:
+    spans = []
+    with open(path) as file:
+        for line in file:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                # A line cut short by the plower stopping
+                continue
+    return spans
+
+
+def gaps(spans: list) -> list:
+    # Idle time on each destination between one transfer finishing and the
+    # next starting, as extra "between_transfers" spans
+    transfers = {}
+    for span in spans:
+        if span["stage"] == "transfer":
+            start = span["time"] - span["seconds"]
+            transfers.setdefault(span["dest"], []).append((start, span["time"]))
+    between = []
+    for dest, times in transfers.items():
+        times.sort()
+        for (_, previous_end), (start, _) in zip(times, times[1:]):
+            between.append(
+                {
+                    "stage": "between_transfers",
+                    "dest": dest,
+                    "seconds": start - previous_end,
+                }
+            )
+    return between
+
+
+def percentile(values: list, pct: float) -> float:
+    # Nearest rank of sorted values
+    return values[max(math.ceil(pct / 100 * len(values)) - 1, 0)]
+
+
+def summarise(spans: list, by_dest: bool = False) -> list:
+    # (dest, stage, count, p50, p95, p99, total) ordered by dest then stage
+    groups = {}
+    for span in spans + gaps(spans):
+        dest = span["dest"] if by_dest else None
+        groups.setdefault((dest, span["stage"]), []).append(span["seconds"])
+
+    order = {
+        stage: index for index, stage in enumerate(STAGES + ("between_transfers",))
+    }
+    rows = []
+    for (dest, stage), values in sorted(
+        groups.items(),
+        key=lambda item: (
+            item[0][0] or "",
+            order.get(item[0][1], len(order)),
+            item[0][1],
+        ),
+    ):
+        values.sort()
+        rows.append(
+            (
+                dest,
+                stage,
+                len(values),
+                percentile(values, 50),
+                percentile(values, 95),
+                percentile(values, 99),
+                sum(values),
+            )
+        )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise a Mow'n'Plow stage trace")
+    parser.add_argument("trace", help="JSONL trace written by the plower")
+    parser.add_argument(
+        "--by-dest", action="store_true", help="Break the stages down per destination"
+    )
+    args = parser.parse_args()
+
+    rows = summarise(load(args.trace), args.by_dest)
+    header = ("stage", "count", "p50_s", "p95_s", "p99_s", "total_s")
+    if args.by_dest:
+        header = ("dest",) + header
+    print("  ".join(f"{column:>18}" for column in header))
+    for dest, stage, count, p50, p95, p99, total in rows:
+        columns = [stage, str(count)]
+        columns += [f"{value:.3f}" for value in (p50, p95, p99, total)]
+        if args.by_dest:
+            columns.insert(0, dest or "-")
+        print("  ".join(f"{column:>18}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
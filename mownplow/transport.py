@@ -0,0 +1,343 @@
+import asyncio
+import errno
+import json
+import logging
+import os
+import re
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from mownplow.config import Config, DestHost
+from mownplow.destman import DestMan
+
+# Exit codes follow rsync so that plow() can treat every engine alike
+TRANSFER_OK = 0
+TRANSFER_SOCKET_ERROR = 10
+TRANSFER_FILE_ERROR = 11
+
+# Bytes sent so far from an rsync --info=progress2 line
+RSYNC_PROGRESS = re.compile(rb"^\s*([\d,]+)\s+\d+%")
+
+SENDFILE_CHUNK = 64 * 1024 * 1024
+COPY_CHUNK = 64 * 1024 * 1024
+# copy_file_range(2) refuses some pairs of filesystems (and older kernels)
+COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+# Interrupted rsync transfers are kept here (relative to the destination)
+RSYNC_PARTIAL_DIR = ".mownplow-partial"
+# Flags which stop rsync using a partial file as the basis for a resume
+WHOLE_FILE = ("--whole-file", "-W")
+
+
+class TransferResult:
+    def __init__(self, returncode: int, stdout: str = "", stderr: str = ""):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+def current_bwlimit(bwlimit) -> int:
+    # Cap (KB/s) for a paced engine's next chunk
+    return bwlimit() if callable(bwlimit) else bwlimit
+
+
+class Transport(ABC):
+    # Move a plot to a destination
+
+    # Engines which pace their own chunks are handed a callable for bwlimit
+    # and follow the host's cap as it changes, others keep the cap they
+    # start with
+    paced = False
+
+    @abstractmethod
+    def describe(
+        self, plot: Path, destman: DestMan, bwlimit: int = 0, resume: bool = False
+    ) -> str:
+        pass
+
+    @abstractmethod
+    async def transfer(
+        self,
+        plot: Path,
+        destman: DestMan,
+        progress=None,
+        bwlimit: int = 0,
+        resume: bool = False,
+    ) -> TransferResult:
+        # progress (if given) is called with the number of bytes sent so far
+        # (not counting a partial file being resumed from),
+        # bwlimit (if non-zero) caps the transfer rate in KB/s (read for each
+        # chunk if callable) and resume continues from the partial file left
+        # by an interrupted transfer
+        pass
+
+
+class RsyncTransport(Transport):
+    def __init__(self, config: Config):
+        self.rsync_cmd = config.rsync_cmd
+        self.rsync_flags = config.rsync_flags
+        if "--info" not in self.rsync_flags:
+            self.rsync_flags += " --info=progress2"
+        if "--partial" not in self.rsync_flags:
+            self.rsync_flags += f" --partial-dir={RSYNC_PARTIAL_DIR}"
+
+    def describe(
+        self, plot: Path, destman: DestMan, bwlimit: int = 0, resume: bool = False
+    ) -> str:
+        rsync_flags = self.rsync_flags
+        if bwlimit:
+            rsync_flags += f" --bwlimit={bwlimit}"
+        if resume:
+            # The partial file is picked up from the partial dir by itself.
+            # rsync refuses --append with --partial-dir (or --whole-file), so
+            # rather than appending, the delta transfer is left on to use the
+            # partial file as its basis and only send what is missing.
+            rsync_flags = " ".join(
+                flag for flag in rsync_flags.split() if flag not in WHOLE_FILE
+            )
+        return f"{self.rsync_cmd} {rsync_flags} {plot} {destman.dest}"
+
+    async def transfer(
+        self,
+        plot: Path,
+        destman: DestMan,
+        progress=None,
+        bwlimit: int = 0,
+        resume: bool = False,
+    ) -> TransferResult:
+        proc = await asyncio.create_subprocess_shell(
+            self.describe(plot, destman, bwlimit, resume),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await asyncio.gather(
+            self._read_progress(proc.stdout, progress), proc.stderr.read()
+        )
+        await proc.wait()
+        return TransferResult(proc.returncode, stdout, stderr.decode())
+
+    async def _read_progress(self, stream, progress) -> str:
+        # Progress lines are terminated by \r, everything else is kept
+        output = []
+        pending = b""
+        while chunk := await stream.read(64 * 1024):
+            *lines, pending = re.split(rb"[\r\n]", pending + chunk)
+            for line in lines:
+                match = RSYNC_PROGRESS.match(line)
+                if match:
+                    if progress:
+                        progress(int(match.group(1).replace(b",", b"")))
+                elif line.strip():
+                    output.append(line.decode())
+        if pending.strip():
+            output.append(pending.decode())
+        return "\n".join(output)
+
+
+class SendfileTransport(Transport):
+    # Stream the plot with sendfile(2) to a mownplow.receiver on the harvester
+
+    paced = True
+
+    def __init__(self, config: Config):
+        self.port = config.transfer_port
+        self.token = config.transfer_token
+
+    def describe(
+        self, plot: Path, destman: DestMan, bwlimit: int = 0, resume: bool = False
+    ) -> str:
+        return f"sendfile {plot} {destman.dest_host}:{self.port}/{destman.dest_dir}"
+
+    async def transfer(
+        self,
+        plot: Path,
+        destman: DestMan,
+        progress=None,
+        bwlimit: int = 0,
+        resume: bool = False,
+    ) -> TransferResult:
+        loop = asyncio.get_running_loop()
+        try:
+            plot_size = plot.stat().st_size
+            reader, writer = await asyncio.open_connection(
+                destman.dest_host, self.port
+            )
+        except OSError as e:
+            return TransferResult(TRANSFER_SOCKET_ERROR, stderr=str(e))
+
+        try:
+            header = {
+                "token": self.token,
+                "dir": destman.dest_dir,
+                "name": plot.name,
+                "size": plot_size,
+                "resume": resume,
+            }
+            writer.write(json.dumps(header).encode() + b"\n")
+            await writer.drain()
+            reply = json.loads(await reader.readline() or b"{}")
+            if not reply.get("ok"):
+                return TransferResult(TRANSFER_FILE_ERROR, stderr=str(reply))
+            # The receiver says where to carry on from when resuming
+            offset = int(reply.get("offset", 0))
+            if offset:
+                logging.info(f"Resuming {plot.name} at {offset} bytes")
+
+            paced_until = loop.time()
+            with open(plot, "rb") as plot_file:
+                sent = offset
+                while sent < plot_size:
+                    # Rate limited transfers send roughly a quarter second per
+                    # chunk, at the cap as it stands for that chunk
+                    limit = current_bwlimit(bwlimit)
+                    chunk_size = SENDFILE_CHUNK
+                    if limit:
+                        chunk_size = max(limit * 1024 // 4, 64 * 1024)
+                    chunk_start = loop.time()
+                    count = await loop.sendfile(
+                        writer.transport,
+                        plot_file,
+                        sent,
+                        min(chunk_size, plot_size - sent),
+                    )
+                    if not count:
+                        raise ConnectionError(f"Sent {sent} of {plot_size} bytes")
+                    sent += count
+                    if progress:
+                        progress(sent - offset)
+                    if limit:
+                        paced_until = max(paced_until, chunk_start) + count / (
+                            limit * 1024
+                        )
+                        ahead = paced_until - loop.time()
+                        if ahead > 0:
+                            await asyncio.sleep(ahead)
+
+            reply = json.loads(await reader.readline() or b"{}")
+            if not reply.get("ok"):
+                return TransferResult(TRANSFER_FILE_ERROR, stderr=str(reply))
+        except (OSError, ValueError) as e:
+            return TransferResult(TRANSFER_SOCKET_ERROR, stderr=str(e))
+        finally:
+            writer.close()
+
+        # Equivalent of rsync --remove-source-files
+        try:
+            plot.unlink()
+        except OSError as e:
+            logging.warning(f"⁉️ Unable to remove {plot}: {e}")
+        return TransferResult(TRANSFER_OK)
+
+
+class LocalTransport(Transport):
+    # Move the plot with rename(2), or copy_file_range(2) across filesystems
+
+    paced = True
+
+    def describe(
+        self, plot: Path, destman: DestMan, bwlimit: int = 0, resume: bool = False
+    ) -> str:
+        return f"local {plot} {destman.virtual_dest}"
+
+    async def transfer(
+        self,
+        plot: Path,
+        destman: DestMan,
+        progress=None,
+        bwlimit: int = 0,
+        resume: bool = False,
+    ) -> TransferResult:
+        loop = asyncio.get_running_loop()
+        if progress:
+            # Progress is reported from the copying thread
+            report = progress
+
+            def progress(bytes_done):
+                loop.call_soon_threadsafe(report, bytes_done)
+
+        try:
+            await loop.run_in_executor(
+                None, self._move, plot, destman.virtual_dest, progress, bwlimit, resume
+            )
+        except OSError as e:
+            return TransferResult(TRANSFER_FILE_ERROR, stderr=str(e))
+        return TransferResult(TRANSFER_OK)
+
+    def _move(self, plot: Path, dest_dir: str, progress, bwlimit, resume: bool):
+        plot_path = os.path.join(dest_dir, plot.name)
+        plot_stat = plot.stat()
+        plot_size = plot_stat.st_size
+        if plot_stat.st_dev == os.stat(dest_dir).st_dev:
+            os.rename(plot, plot_path)
+            if progress:
+                progress(plot_size)
+            return
+
+        # Copy into a hidden partial file (kept for a later resume if the
+        # copy fails) and only rename it into place once it is complete
+        part_path = os.path.join(dest_dir, f".{plot.name}.part")
+        with open(plot, "rb") as src:
+            dst = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            copied = 0
+            try:
+                offset = os.fstat(dst).st_size
+                if not resume or offset >= plot_size:
+                    offset = 0
+                    os.ftruncate(dst, 0)
+                os.posix_fallocate(dst, offset, plot_size - offset)
+                copied = offset
+                paced_until = time.monotonic()
+                copy_range = True
+                while copied < plot_size:
+                    # The cap is read from this thread, it is only a number
+                    limit = current_bwlimit(bwlimit)
+                    chunk_size = COPY_CHUNK
+                    if limit:
+                        chunk_size = max(limit * 1024 // 4, 64 * 1024)
+                    chunk_start = time.monotonic()
+                    count = min(chunk_size, plot_size - copied)
+                    try:
+                        if copy_range:
+                            count = os.copy_file_range(
+                                src.fileno(), dst, count, copied, copied
+                            )
+                        else:
+                            os.lseek(dst, copied, os.SEEK_SET)
+                            count = os.sendfile(dst, src.fileno(), copied, count)
+                    except OSError as e:
+                        if not copy_range or e.errno not in COPY_UNSUPPORTED:
+                            raise
+                        # Not between these filesystems, use sendfile(2) instead
+                        copy_range = False
+                        continue
+                    if not count:
+                        raise OSError(errno.EIO, f"Copied {copied} of {plot_size} bytes")
+                    copied += count
+                    if progress:
+                        progress(copied - offset)
+                    if limit:
+                        paced_until = max(paced_until, chunk_start) + count / (
+                            limit * 1024
+                        )
+                        ahead = paced_until - time.monotonic()
+                        if ahead > 0:
+                            time.sleep(ahead)
+                os.fsync(dst)
+            except OSError:
+                if copied:
+                    os.ftruncate(dst, copied)
+                raise
+            finally:
+                os.close(dst)
+        os.rename(part_path, plot_path)
+        plot.unlink()
+
+
+
+def create_transport(config: Config, host: DestHost = None) -> Transport:
+    if host is not None and host.dest_local:
+        return LocalTransport()
+    if config.transfer_engine == "sendfile":
+        return SendfileTransport(config)
+    return RsyncTransport(config)
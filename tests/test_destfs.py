@@ -0,0 +1,85 @@
+import asyncio
+import os
+import subprocess
+
+import pytest
+
+from mownplow.destfs import LocalFS, ShellFS
+
+
+class LocalShell:
+    # Stands in for an SSHPool, running the commands on this machine
+
+    async def run_command(self, command: str, input: str = None, encoding="utf-8"):
+        return subprocess.run(
+            command,
+            shell=True,
+            input=input,
+            capture_output=True,
+            text=encoding is not None,
+            env=dict(os.environ, LC_ALL="C"),
+        )
+
+
+@pytest.fixture
+def backends():
+    return ShellFS(LocalShell()), LocalFS()
+
+
+@pytest.mark.parametrize("dest_root", ["/", "/proc", "/sys", "sys", "tmpfs"])
+def test_discover_matches_shell(backends, dest_root):
+    shell, local = backends
+    assert sorted(asyncio.run(shell.discover(dest_root))) == sorted(
+        asyncio.run(local.discover(dest_root))
+    )
+
+
+@pytest.mark.parametrize(
+    "replot_before",
+    [
+        None,
+        "2023-04-01 00:00",
+        "2023-04-01T00:00:00",
+        "April 1 2023",
+        "1 Apr 2023 12:30",
+        "@1680307200",
+    ],
+)
+def test_listing_matches_shell(backends, tmp_path, replot_before):
+    shell, local = backends
+    (tmp_path / "d0").mkdir()
+    (tmp_path / "d0" / "old.plot").write_bytes(b"x" * 10)
+    (tmp_path / "new.plot").write_bytes(b"x" * 20)
+    os.utime(tmp_path / "d0" / "old.plot", (1600000000.5, 1600000000.5))
+
+    shell_files, shell_cutoff = asyncio.run(shell.listing(str(tmp_path), replot_before))
+    local_files, local_cutoff = asyncio.run(local.listing(str(tmp_path), replot_before))
+
+    assert shell_cutoff == local_cutoff
+    assert shell_files.keys() == local_files.keys()
+    for path, (mtime, size) in local_files.items():
+        assert shell_files[path] == (pytest.approx(mtime), size)
+
+
+def test_listing_rejects_bad_dates_alike(backends, tmp_path):
+    shell, local = backends
+    assert asyncio.run(shell.listing(str(tmp_path), "not a date")) is None
+    assert asyncio.run(local.listing(str(tmp_path), "not a date")) is None
+
+
+class CountingShell(LocalShell):
+    def __init__(self):
+        self.commands = []
+
+    async def run_command(self, command: str, input: str = None, encoding="utf-8"):
+        self.commands.append(command.split()[0])
+        return await super().run_command(command, input, encoding)
+
+
+def test_replot_before_is_parsed_once(tmp_path):
+    shell = CountingShell()
+    fs = ShellFS(shell)
+    for _ in range(3):
+        _, cutoff = asyncio.run(fs.listing(str(tmp_path), "@1680307200"))
+        assert cutoff == 1680307200
+    assert shell.commands == ["date", "find", "find", "find"]
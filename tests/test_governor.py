@@ -0,0 +1,79 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiohttp
+
+from mownplow.governor import Governor
+from mownplow.scheduler import PlowScheduler
+
+
+def host(bwlimit: int = 0, max_transfers: int = 3) -> SimpleNamespace:
+    return SimpleNamespace(
+        dest_host="h1",
+        bwlimit=bwlimit,
+        max_transfers=max_transfers,
+        dest_dirs=["d1", "d2", "d3", "d4"],
+    )
+
+
+def governor(dest_host: SimpleNamespace, harvester_req=None) -> Governor:
+    scheduler = PlowScheduler()
+    scheduler.add_host("h1", 1, dest_host.max_transfers, dest_host.bwlimit)
+    return Governor(dest_host, harvester_req, scheduler, 0.5, 10, 10000, 100000)
+
+
+def limits(governor: Governor) -> tuple:
+    scheduler = governor.scheduler
+    return scheduler.host_max_transfers["h1"], scheduler.host_bwlimits["h1"]
+
+
+def test_backs_off_then_recovers():
+    gov = governor(host())
+    gov.apply()
+    # Uncapped at the ceiling
+    assert limits(gov) == (3, 0)
+
+    gov.adjust(2.0)
+    assert limits(gov) == (2, 50000)
+    gov.adjust(float("inf"))
+    assert limits(gov) == (1, 25000)
+    for _ in range(10):
+        gov.adjust(0.8)
+    # Never below the floor or a single transfer
+    assert limits(gov) == (1, 10000)
+
+    # Bandwidth grows back a tenth of the ceiling at a time, then the
+    # transfers one at a time
+    gov.adjust(0.1)
+    assert limits(gov) == (1, 20000)
+    for _ in range(8):
+        gov.adjust(0.1)
+    assert limits(gov) == (1, 0)
+    gov.adjust(0.1)
+    gov.adjust(0.1)
+    gov.adjust(0.1)
+    assert limits(gov) == (3, 0)
+
+
+def test_stays_within_the_hosts_bwlimit():
+    gov = governor(host(bwlimit=40000))
+    gov.apply()
+    # The host's own cap holds even at the ceiling
+    assert limits(gov) == (3, 40000)
+    gov.adjust(2.0)
+    assert limits(gov) == (2, 20000)
+
+    # A reload lowers the ceilings under the current limits
+    gov.set_ceilings(host(bwlimit=15000, max_transfers=1))
+    gov.apply()
+    assert limits(gov) == (1, 15000)
+
+
+class FailingHarvester:
+    async def get_plot_directories(self):
+        raise aiohttp.ClientConnectionError("refused")
+
+
+def test_a_failed_probe_counts_as_slow():
+    gov = governor(host(), FailingHarvester())
+    assert asyncio.run(gov.probe()) == float("inf")
@@ -0,0 +1,196 @@
+import asyncio
+import datetime
+import ipaddress
+import ssl
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+from aiohttp import web
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from mownplow.destfs import LocalFS
+from mownplow.harvester import HarvesterCert, HarvesterRequest
+from mownplow.journal import Journal
+
+
+def make_ca(name: str):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+        .sign(key, hashes.SHA256())
+    )
+    return key, cert
+
+
+def make_cert(ca_key, ca_cert):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    key = ec.generate_private_key(ec.SECP256R1())
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "harvester")])
+        )
+        .issuer_name(ca_cert.subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            False,
+        )
+        .sign(ca_key, hashes.SHA256())
+    )
+    return key, cert
+
+
+def pem(cert) -> bytes:
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+
+def pem_key(key) -> bytes:
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
+    )
+
+
+@pytest.fixture
+def tls(tmp_path):
+    # The harvester's private CA and certificate, fetched by HarvesterCert
+    ca_key, ca_cert = make_ca("Private CA")
+    key, cert = make_cert(ca_key, ca_cert)
+    (tmp_path / "private_ca.crt").write_bytes(pem(ca_cert))
+    (tmp_path / "private_harvester.crt").write_bytes(pem(cert))
+    (tmp_path / "private_harvester.key").write_bytes(pem_key(key))
+    return HarvesterCert(
+        LocalFS(),
+        str(tmp_path / "private_ca.crt"),
+        str(tmp_path / "private_harvester.crt"),
+        str(tmp_path / "private_harvester.key"),
+        "127.0.0.1",
+    )
+
+
+async def start_harvester(tls, calls: list):
+    async def rpc(request):
+        calls.append((request.path, (await request.json()).get("dirname")))
+        return web.json_response({"success": True})
+
+    app = web.Application()
+    for route in (
+        "get_plot_directories",
+        "add_plot_directory",
+        "remove_plot_directory",
+    ):
+        app.router.add_post(f"/{route}", rpc)
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(tls.cert_path, tls.key_path)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=ssl_context)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+def test_batch_add_and_remove(tls):
+    async def run():
+        calls = []
+        runner, port = await start_harvester(tls, calls)
+        await tls.retrieve_cert_and_key()
+        harvester = HarvesterRequest("127.0.0.1", port, tls)
+        try:
+            await harvester.remove_plot_directories(["/plots/d1", "/plots/d2"])
+            assert set(harvester.offline) == {"/plots/d1", "/plots/d2"}
+            await harvester.add_plot_directories(["/plots/d1", "/plots/d2"])
+            assert harvester.offline == {}
+        finally:
+            await harvester.close()
+            await runner.cleanup()
+        return calls
+
+    calls = asyncio.run(run())
+    assert sorted(calls) == [
+        ("/add_plot_directory", "/plots/d1"),
+        ("/add_plot_directory", "/plots/d2"),
+        ("/remove_plot_directory", "/plots/d1"),
+        ("/remove_plot_directory", "/plots/d2"),
+    ]
+
+
+def test_certificates_are_fetched_again_after_an_ssl_error(tls, tmp_path):
+    async def run():
+        calls = []
+        runner, port = await start_harvester(tls, calls)
+        # The harvester's CA no longer matches its certificate
+        right_ca = (tmp_path / "private_ca.crt").read_bytes()
+        (tmp_path / "private_ca.crt").write_bytes(pem(make_ca("Old CA")[1]))
+        await tls.retrieve_cert_and_key()
+        harvester = HarvesterRequest("127.0.0.1", port, tls)
+        try:
+            with pytest.raises(aiohttp.ClientSSLError):
+                await harvester.get_plot_directories()
+            session = harvester.session
+
+            # Once the harvester's CA is right again the next request fetches
+            # it and rebuilds the context on the same session
+            (tmp_path / "private_ca.crt").write_bytes(right_ca)
+            assert await harvester.get_plot_directories() == {"success": True}
+            assert harvester.session is session
+            assert not session.closed
+        finally:
+            await harvester.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+class CountingFS(LocalFS):
+    def __init__(self):
+        self.reads = 0
+
+    async def read_file(self, path: str) -> bytes:
+        self.reads += 1
+        return await super().read_file(path)
+
+
+def test_journalled_certificates_are_reused_while_unchanged(tls, tmp_path):
+    journal = Journal(str(tmp_path / "mownplow.db"))
+    paths = (tls.cacert_path, tls.cert_path, tls.key_path)
+
+    def retrieve():
+        fs = CountingFS()
+        harvester_cert = HarvesterCert(fs, *paths, "127.0.0.1", journal)
+        asyncio.run(harvester_cert.retrieve_cert_and_key())
+        return harvester_cert, fs.reads
+
+    first, reads = retrieve()
+    assert reads == 3
+    # A restart uses the copies made by the first run
+    second, reads = retrieve()
+    assert reads == 0
+    assert second.key_file == first.key_file
+
+    # A damaged copy is fetched again
+    with open(first.cacert_file, "ab") as file:
+        file.write(b"x")
+    third, reads = retrieve()
+    assert reads == 3
+    assert open(third.cacert_file, "rb").read() == open(paths[0], "rb").read()
+    journal.close()
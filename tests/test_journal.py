@@ -0,0 +1,49 @@
+import pytest
+
+from mownplow.journal import Journal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(str(tmp_path / "mownplow.db"))
+    yield journal
+    journal.close()
+
+
+def test_resumes_only_on_the_same_destination(journal):
+    assert not journal.begin_transfer("/nvme0/a.plot", "h1/d1", 1000)
+    # Interrupted, then retried on the same drive
+    assert journal.begin_transfer("/nvme0/a.plot", "h1/d1", 1000)
+    # Sent elsewhere the partial file is no use
+    assert not journal.begin_transfer("/nvme0/a.plot", "h1/d2", 1000)
+    assert journal.transfers() == {"/nvme0/a.plot": "h1/d2"}
+
+
+def test_a_changed_plot_starts_again(journal):
+    journal.begin_transfer("/nvme0/a.plot", "h1/d1", 1000)
+    assert not journal.begin_transfer("/nvme0/a.plot", "h1/d1", 2000)
+
+
+def test_finished_transfers_are_forgotten(journal, tmp_path):
+    journal.begin_transfer("/nvme0/a.plot", "h1/d1", 1000)
+    journal.end_transfer("/nvme0/a.plot")
+    assert journal.transfers() == {}
+    assert not journal.begin_transfer("/nvme0/a.plot", "h1/d1", 1000)
+
+    # Interrupted transfers survive a restart
+    journal.close()
+    reopened = Journal(str(tmp_path / "mownplow.db"))
+    assert reopened.begin_transfer("/nvme0/a.plot", "h1/d1", 1000)
+    reopened.close()
+
+
+def test_discovered_dirs_are_forgotten_with_a_failed_drive(journal):
+    assert journal.dest_dirs("h1", "/mnt/dst") is None
+    journal.save_dest_dirs("h1", "/mnt/dst", ["d2", "d1"])
+    journal.save_dest_dirs("h2", "/mnt/dst", ["d1"])
+    assert journal.dest_dirs("h1", "/mnt/dst") == ["d1", "d2"]
+
+    journal.save_mount_path("h1/d1", "/mnt/dst/d1")
+    journal.forget_dest("h1/d1")
+    assert journal.dest_dirs("h1", "/mnt/dst") is None
+    assert journal.dest_dirs("h2", "/mnt/dst") == ["d1"]
@@ -0,0 +1,53 @@
+from mownplow.ledger import SpaceLedger
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_reserve_commit_and_release():
+    ledger = SpaceLedger(clock=Clock())
+    assert ledger.due()
+    assert not ledger.reserve("a.plot", 10)
+
+    ledger.update(1000)
+    assert ledger.reserve("a.plot", 400)
+    assert ledger.reserve("b.plot", 400)
+    # The space can't be booked twice
+    assert not ledger.reserve("c.plot", 400)
+    assert ledger.available() == 200
+
+    ledger.commit("a.plot")
+    assert ledger.free_KB == 600
+    assert ledger.available() == 200
+    assert ledger.known()
+
+    # A failed transfer leaves the drive's real free space unknown
+    ledger.release("b.plot")
+    assert ledger.available() == 600
+    assert ledger.due()
+    assert not ledger.known()
+
+
+def test_release_without_reservation_keeps_the_ledger():
+    ledger = SpaceLedger(clock=Clock())
+    ledger.update(1000)
+    ledger.release("a.plot")
+    assert not ledger.due()
+
+
+def test_credit_and_periodic_check():
+    clock = Clock()
+    ledger = SpaceLedger(check_interval=600, clock=clock)
+    ledger.update(100)
+    ledger.credit(50)
+    assert ledger.available() == 150
+
+    clock.now = 600
+    assert not ledger.due()
+    clock.now = 601
+    assert ledger.due()
@@ -0,0 +1,119 @@
+import asyncio
+from types import SimpleNamespace
+
+import mownplow.plow
+from mownplow.config import DestHost
+from mownplow.destfs import DestFS
+from mownplow.plow import plow
+from mownplow.scheduler import PlowScheduler
+from mownplow.transport import TRANSFER_OK, Transport, TransferResult
+
+CONFIG = SimpleNamespace(
+    replot=False,
+    replot_before=None,
+    remove_all_replots=False,
+    farm_during_plow=True,
+    readd_after=0,
+    space_check_interval=600,
+)
+HOST = DestHost(
+    {
+        "Host": "h1",
+        "Username": "chia",
+        "Protocol": "rsync",
+        "Port": 12000,
+        "Root": "/plots",
+    },
+    {"Host": "h1", "Port": 8560, "CACertPath": "", "CertPath": "", "KeyPath": ""},
+    0,
+    False,
+)
+
+
+class FakeFS(DestFS):
+    async def discover(self, dest_root: str) -> list:
+        return []
+
+    async def mount_path(self, dest_root: str, dest_dir: str) -> str:
+        return f"/mnt/{dest_dir}"
+
+    async def free_space(self, mount_path: str) -> int:
+        return 1024 * 1024
+
+    async def listing(self, mount_path: str, replot_before: str = None):
+        return {}, None
+
+    async def remove(self, mount_path: str, paths: list) -> dict:
+        return dict.fromkeys(paths, True)
+
+    async def sync(self, mount_path: str) -> bool:
+        return True
+
+    async def read_file(self, path: str) -> bytes:
+        raise OSError(path)
+
+
+class FlakyTransport(Transport):
+    # Raises on the first transfer and succeeds after that
+
+    def __init__(self):
+        self.calls = []
+        self.done = asyncio.Event()
+
+    def describe(self, plot, destman, bwlimit=0, resume=False) -> str:
+        return f"{plot} {destman.dest}"
+
+    async def transfer(self, plot, destman, progress=None, bwlimit=0, resume=False):
+        self.calls.append((plot, destman.dest_id))
+        if len(self.calls) == 1:
+            raise RuntimeError("connection reset")
+        self.done.set()
+        return TransferResult(TRANSFER_OK)
+
+
+def test_failed_destination_goes_back_in_the_schedule(tmp_path, monkeypatch):
+    monkeypatch.setattr(mownplow.plow, "SLEEP_FOR", 0)
+    plot = tmp_path / "a.plot"
+    plot.write_bytes(b"x" * 4096)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        scheduler = PlowScheduler()
+        scheduler.add_host("h1")
+        scheduler.add_dest_priority("h1/d1", 1, "h1")
+        plot_queue = asyncio.Queue()
+        transport = FlakyTransport()
+        tasks = [
+            asyncio.create_task(scheduler.dispatch(plot_queue)),
+            asyncio.create_task(
+                plow(
+                    CONFIG,
+                    HOST,
+                    "d1",
+                    plot_queue,
+                    scheduler,
+                    FakeFS(),
+                    None,
+                    transport,
+                    None,
+                    loop,
+                )
+            ),
+        ]
+        await plot_queue.put(plot)
+        try:
+            await asyncio.wait_for(transport.done.wait(), 5)
+            await asyncio.sleep(0)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return scheduler, transport
+
+    scheduler, transport = asyncio.run(run())
+    # The plot was handed back and retried on the same destination
+    assert transport.calls == [(plot, "h1/d1"), (plot, "h1/d1")]
+    # which is in the schedule again with no transfer slot held
+    assert "h1/d1" in scheduler.host_queues["h1"]
+    assert scheduler.transfers_to_host("h1") == 0
+    assert scheduler.pending_count() == 0
@@ -0,0 +1,193 @@
+import asyncio
+import importlib.util
+from pathlib import Path
+
+import pytest
+import yaml
+
+from mownplow.config import Config
+from mownplow.destfs import DestFS
+from mownplow.scheduler import PlowScheduler
+
+# mownplow.py is shadowed by the mownplow package
+spec = importlib.util.spec_from_file_location(
+    "mownplow_main", Path(__file__).parent.parent / "mownplow.py"
+)
+mownplow_main = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mownplow_main)
+
+
+class FakeFS(DestFS):
+    # Drives mounted at /mnt/dst/<dir>, each with free_KB free
+    def __init__(self, dest_dirs: list, free_KB: int = 0):
+        super().__init__()
+        self.dest_dirs = dest_dirs
+        self.free_KB = free_KB
+
+    async def discover(self, dest_root: str) -> list:
+        return [f"{dest_root}/{dest_dir}" for dest_dir in self.dest_dirs]
+
+    async def mount_path(self, dest_root: str, dest_dir: str) -> str:
+        return f"{dest_root}/{dest_dir}"
+
+    async def free_space(self, mount_path: str) -> int:
+        return self.free_KB
+
+    async def listing(self, mount_path: str, replot_before: str = None):
+        return {}, None
+
+    async def remove(self, mount_path: str, paths: list) -> dict:
+        return dict.fromkeys(paths, True)
+
+    async def sync(self, mount_path: str) -> bool:
+        return True
+
+    async def read_file(self, path: str) -> bytes:
+        raise OSError(path)
+
+
+def write_config(path: Path, hosts: dict, **options):
+    # hosts: name -> extra Dest settings
+    path.write_text(
+        yaml.safe_dump(
+            {
+                "Sources": [str(path.parent)],
+                "PlowOptions": {
+                    "Replot": True,
+                    "ReplotBefore": "2023-01-01",
+                    "FarmDuring": True,
+                    **options,
+                },
+                "Rsync": {},
+                "SSH": {},
+                "Dest": [
+                    {
+                        "Host": name,
+                        "Username": "chia",
+                        "Protocol": "rsync",
+                        "Port": 12000,
+                        "Root": "/mnt/dst",
+                        **extra,
+                    }
+                    for name, extra in hosts.items()
+                ],
+                "Harvester": {
+                    "Host": "harvester",
+                    "Port": 8560,
+                    "CACertPath": "ca.crt",
+                    "CertPath": "harvester.crt",
+                    "KeyPath": "harvester.key",
+                },
+                "Journal": {"Path": ""},
+                "Logging": {"Level": "INFO"},
+            }
+        )
+    )
+
+
+@pytest.fixture
+def plower(tmp_path, monkeypatch):
+    # A Plower for host h1 whose workers run until retired, apart from
+    # those for the drives in full which finish straight away
+    started = []
+    full = set()
+
+    async def plow(config, host, dest_dir, plot_queue, dest_schedule, *args):
+        dest_id = f"{host.dest_host}/{dest_dir}"
+        started.append(dest_id)
+        if dest_id not in full:
+            await dest_schedule.get_plot(dest_id)
+
+    monkeypatch.setattr(mownplow_main, "plow", plow)
+    write_config(tmp_path / "config.yaml", {"h1": {}})
+    config = Config(str(tmp_path / "config.yaml"))
+    plower = mownplow_main.Plower(config, asyncio.Queue(), PlowScheduler(), None, None)
+    host = config.hosts[0]
+    fs = FakeFS(["d1", "d2"])
+    plower.hosts["h1"] = (host, fs, None, None)
+    plower.dest_schedule.add_host("h1", host.priority)
+    plower.started = started
+    plower.full = full
+    return plower
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_refresh_follows_the_mounts(plower):
+    async def run():
+        await plower.refresh_host("h1")
+        assert set(plower.workers) == {"h1/d1", "h1/d2"}
+
+        # d2 has been unmounted and d3 mounted
+        plower.hosts["h1"][1].dest_dirs = ["d1", "d3"]
+        await plower.refresh_host("h1")
+        assert plower.retiring == {"h1/d2"}
+        assert "h1/d2" not in plower.dest_schedule.dest_priorities
+        await settle()
+        assert set(plower.workers) == {"h1/d1", "h1/d3"}
+        assert plower.retiring == set()
+        assert plower.finished == set()
+        # The new drive goes after the existing one
+        priorities = plower.dest_schedule.dest_priorities
+        assert priorities["h1/d3"] > priorities["h1/d1"]
+        await plower.close()
+
+    asyncio.run(run())
+
+
+def test_reload_keeps_full_drives_finished(plower, tmp_path):
+    async def run():
+        plower.full.add("h1/d2")
+        plower.dest_schedule.min_plot_size_KB = 100
+        await plower.refresh_host("h1")
+        await settle()
+        assert plower.finished == {"h1/d2"}
+
+        # New limits for the host, the full drive stays finished
+        write_config(tmp_path / "config.yaml", {"h1": {"MaxTransfers": 2}})
+        await plower.reload()
+        assert plower.dest_schedule.host_max_transfers["h1"] == 2
+        assert plower.finished == {"h1/d2"}
+        assert plower.started.count("h1/d2") == 1
+
+        # Once it has been given room it starts again
+        plower.hosts["h1"][1].free_KB = 1000
+        await plower.reload()
+        await settle()
+        assert plower.started.count("h1/d2") == 2
+
+        # As it does with a new ReplotBefore
+        plower.hosts["h1"][1].free_KB = 0
+        write_config(
+            tmp_path / "config.yaml",
+            {"h1": {"MaxTransfers": 2}},
+            ReplotBefore="2024-01-01",
+        )
+        await plower.reload()
+        await settle()
+        assert plower.started.count("h1/d2") == 3
+        await plower.close()
+
+    asyncio.run(run())
+
+
+def test_reload_retires_a_removed_host(plower, tmp_path):
+    async def run():
+        await plower.refresh_host("h1")
+        (tmp_path / "h2").mkdir()
+        write_config(
+            tmp_path / "config.yaml",
+            {"h2": {"Local": True, "Root": str(tmp_path / "h2")}},
+        )
+        await plower.reload()
+        assert "h1" not in plower.hosts
+        assert "h2" in plower.hosts
+        await settle()
+        assert plower.workers == {}
+        assert plower.finished == set()
+        await plower.close()
+
+    asyncio.run(run())
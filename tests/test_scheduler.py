@@ -0,0 +1,180 @@
+from pathlib import Path
+
+import pytest
+
+from mownplow.scheduler import DestHeap, PlowScheduler
+
+GiB_KB = 1024 * 1024
+
+
+def test_heap_pops_in_priority_order():
+    heap = DestHeap()
+    for dest, priority in [("c", 3), ("a", 1), ("e", 5), ("b", 2), ("d", 4)]:
+        heap.push(dest, priority)
+    assert heap.peek() == "a"
+    assert [heap.pop() for _ in range(len(heap))] == ["a", "b", "c", "d", "e"]
+    assert heap.pop() is None
+
+
+def test_heap_update_and_remove():
+    heap = DestHeap()
+    for priority, dest in enumerate("abcdef"):
+        heap.push(dest, priority)
+    heap.update("f", -1)
+    heap.push("a", 10)
+    assert heap.remove("c")
+    assert not heap.remove("c")
+    assert "c" not in heap
+    assert [heap.pop() for _ in range(len(heap))] == ["f", "b", "d", "e", "a"]
+    assert heap.index == {}
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    scheduler = PlowScheduler()
+    scheduler.source_dirs["nvme0"] = tmp_path
+    scheduler.add_host("h1", priority=1)
+    for priority, dest in enumerate(["h1/d1", "h1/d2", "h1/d3"], 1):
+        scheduler.add_dest_priority(dest, priority, "h1")
+    return scheduler
+
+
+def plots(count: int) -> list:
+    return [Path(f"/nvme0/plot-{number}.plot") for number in range(count)]
+
+
+def test_assigns_oldest_plots_to_best_destinations(scheduler):
+    for arrival, plot in enumerate(plots(4)):
+        scheduler.enqueue(plot, "nvme0", 100 * GiB_KB, arrival)
+    assert scheduler.assign() == [
+        (Path("/nvme0/plot-0.plot"), "h1/d1"),
+        (Path("/nvme0/plot-1.plot"), "h1/d2"),
+        (Path("/nvme0/plot-2.plot"), "h1/d3"),
+    ]
+    # Busy destinations take nothing more until released
+    assert scheduler.assign() == []
+    assert scheduler.pending_count() == 1
+
+    scheduler.release("h1/d2")
+    assert scheduler.assign() == []
+    scheduler.add_dest_to_q("h1/d2")
+    assert scheduler.assign() == [(Path("/nvme0/plot-3.plot"), "h1/d2")]
+    assert scheduler.transfers_to_host("h1") == 3
+
+
+def test_release_frees_the_transfer_budget(scheduler):
+    scheduler.max_transfers = 1
+    for arrival, plot in enumerate(plots(2)):
+        scheduler.enqueue(plot, "nvme0", 100 * GiB_KB, arrival)
+    assert scheduler.assign() == [(Path("/nvme0/plot-0.plot"), "h1/d1")]
+    assert scheduler.assign() == []
+    scheduler.release("h1/d1")
+    # Releasing twice doesn't give back a second slot
+    scheduler.release("h1/d1")
+    assert scheduler.assign() == [(Path("/nvme0/plot-1.plot"), "h1/d2")]
+    assert scheduler.transfers_to_host("h1") == 1
+
+
+def test_skips_destinations_without_room(scheduler):
+    scheduler.update_dest_space("h1/d1", 50 * GiB_KB)
+    scheduler.enqueue(plots(1)[0], "nvme0", 100 * GiB_KB, 0)
+    assert scheduler.assign() == [(Path("/nvme0/plot-0.plot"), "h1/d2")]
+    assert scheduler.dest_is_full("h1/d1")
+    assert not scheduler.dest_is_full("h1/d2")
+
+
+def test_best_fit_picks_the_fullest_drive(scheduler):
+    scheduler.placement = "bestfit"
+    scheduler.update_dest_space("h1/d1", 1000 * GiB_KB)
+    scheduler.update_dest_space("h1/d2", 150 * GiB_KB)
+    scheduler.update_dest_space("h1/d3", 300 * GiB_KB)
+    scheduler.enqueue(plots(1)[0], "nvme0", 100 * GiB_KB, 0)
+    assert scheduler.assign() == [(Path("/nvme0/plot-0.plot"), "h1/d2")]
+
+
+def test_requeue_keeps_the_plots_place_in_line(scheduler):
+    for arrival, plot in enumerate(plots(3)):
+        scheduler.enqueue(plot, "nvme0", 100 * GiB_KB, arrival)
+    scheduler.max_transfers = 1
+    assert scheduler.assign() == [(Path("/nvme0/plot-0.plot"), "h1/d1")]
+    # d1 can't take the plot after all, so it goes back ahead of the others
+    scheduler.requeue("h1/d1")
+    scheduler.release("h1/d1")
+    assert [entry[0] for entry in scheduler.pending["nvme0"]] == plots(3)
+    assert scheduler.assign() == [(Path("/nvme0/plot-0.plot"), "h1/d2")]
+
+
+def test_removed_destinations_are_not_used(scheduler):
+    scheduler.rem_dest_from_priorities("h1/d1")
+    scheduler.enqueue(plots(1)[0], "nvme0", 100 * GiB_KB, 0)
+    assert scheduler.assign() == [(Path("/nvme0/plot-0.plot"), "h1/d2")]
+    scheduler.add_dest_to_q("h1/d1")
+    assert "h1/d1" not in scheduler.host_queues["h1"]
+
+
+def test_spreads_transfers_across_hosts(scheduler):
+    scheduler.add_host("h2", priority=2, max_transfers=1)
+    scheduler.add_dest_priority("h2/d1", 1, "h2")
+    scheduler.add_dest_priority("h2/d2", 2, "h2")
+    for arrival, plot in enumerate(plots(4)):
+        scheduler.enqueue(plot, "nvme0", 100 * GiB_KB, arrival)
+    assert [dest for _, dest in scheduler.assign()] == [
+        "h1/d1",
+        "h2/d1",
+        "h1/d2",
+        "h1/d3",
+    ]
+
+
+def test_bandwidth_shares_stay_within_the_cap(scheduler):
+    scheduler.set_host_limits("h1", bwlimit=1000)
+    for arrival, plot in enumerate(plots(3)):
+        scheduler.enqueue(plot, "nvme0", 100 * GiB_KB, arrival)
+    dests = [dest for _, dest in scheduler.assign()]
+    shares = [scheduler.transfer_bwlimit("h1", dest) for dest in dests]
+    assert shares == [333, 333, 333]
+
+    # A transfer starting alone takes the whole cap, and no other is
+    # dispatched to the host until it ends
+    for dest in dests:
+        scheduler.release(dest)
+        scheduler.add_dest_to_q(dest)
+    scheduler.enqueue(Path("/nvme0/plot-3.plot"), "nvme0", 100 * GiB_KB, 3)
+    [(_, dest)] = scheduler.assign()
+    assert scheduler.transfer_bwlimit("h1", dest) == 1000
+    scheduler.enqueue(Path("/nvme0/plot-4.plot"), "nvme0", 100 * GiB_KB, 4)
+    assert scheduler.assign() == []
+    scheduler.release(dest)
+    assert len(scheduler.assign()) == 1
+
+
+def test_a_lowered_cap_is_shared_out_as_transfers_end(scheduler):
+    scheduler.set_host_limits("h1", bwlimit=900)
+    for arrival, plot in enumerate(plots(3)):
+        scheduler.enqueue(plot, "nvme0", 100 * GiB_KB, arrival)
+    dests = [dest for _, dest in scheduler.assign()]
+    for dest in dests:
+        scheduler.transfer_bwlimit("h1", dest)
+    scheduler.set_host_limits("h1", bwlimit=400)
+    scheduler.release(dests[0])
+    scheduler.add_dest_to_q(dests[0])
+    # 600 KB/s is still held by the other two
+    scheduler.enqueue(Path("/nvme0/plot-3.plot"), "nvme0", 100 * GiB_KB, 3)
+    assert scheduler.assign() == []
+    scheduler.release(dests[1])
+    [(_, dest)] = scheduler.assign()
+    assert scheduler.transfer_bwlimit("h1", dest) == 100
+
+
+def test_paced_share_follows_the_transfers_in_flight(scheduler):
+    assert scheduler.bwlimit_share("h1") == 0
+    scheduler.set_host_limits("h1", bwlimit=900)
+    for arrival, plot in enumerate(plots(3)):
+        scheduler.enqueue(plot, "nvme0", 100 * GiB_KB, arrival)
+    dests = [dest for _, dest in scheduler.assign()]
+    assert scheduler.bwlimit_share("h1") == 300
+    scheduler.release(dests[0])
+    assert scheduler.bwlimit_share("h1") == 450
+    # The governor backs off
+    scheduler.set_host_limits("h1", bwlimit=200)
+    assert scheduler.bwlimit_share("h1") == 100
@@ -0,0 +1,66 @@
+import asyncio
+import os
+from pathlib import Path
+
+from mownplow.sources import SourceIndex
+
+
+def key(path: Path) -> tuple:
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+def test_each_plot_is_queued_once(tmp_path):
+    discarded = []
+    index = SourceIndex([str(tmp_path)], asyncio.Queue(), discarded.append)
+    plot = tmp_path / "a.plot"
+    plot.write_bytes(b"x")
+    assert index.add(str(plot), key(plot))
+    assert not index.add(str(plot), key(plot))
+
+    # Another link to a queued plot
+    os.link(plot, tmp_path / "b.plot")
+    assert not index.add(str(tmp_path / "b.plot"), key(plot))
+
+    # Renamed since it was queued
+    os.remove(tmp_path / "b.plot")
+    plot.rename(tmp_path / "c.plot")
+    assert index.add(str(tmp_path / "c.plot"), key(tmp_path / "c.plot"))
+    assert discarded == [plot]
+    assert str(tmp_path / "c.plot") in index
+    assert len(index) == 1
+
+
+def test_scans_then_follows_moves(tmp_path):
+    source = tmp_path / "nvme0"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "old.plot").write_bytes(b"x")
+    (source / "old.plot.tmp").write_bytes(b"x")
+    staging = tmp_path / "staging"
+    staging.mkdir()
+
+    async def run():
+        plot_queue = asyncio.Queue()
+        discarded = []
+        index = SourceIndex([str(source)], plot_queue, discarded.append)
+        task = asyncio.create_task(index.run(asyncio.get_running_loop()))
+        try:
+            assert await asyncio.wait_for(plot_queue.get(), 5) == (
+                source / "sub" / "old.plot"
+            )
+            # A finished plot is moved in
+            (staging / "new.plot").write_bytes(b"x")
+            (staging / "new.plot").rename(source / "new.plot")
+            assert await asyncio.wait_for(plot_queue.get(), 5) == source / "new.plot"
+
+            (source / "new.plot").unlink()
+            for _ in range(500):
+                if discarded:
+                    break
+                await asyncio.sleep(0.01)
+            assert discarded == [source / "new.plot"]
+            assert plot_queue.empty()
+        finally:
+            task.cancel()
+
+    asyncio.run(run())
@@ -0,0 +1,107 @@
+import asyncio
+
+import asyncssh
+import pytest
+
+from mownplow.ssh import SSHPool
+
+
+class Server(asyncssh.SSHServer):
+    # Keeps track of its connections so that they can be dropped
+    connections = []
+
+    def connection_made(self, connection):
+        self.connections.append(connection)
+
+
+async def handle_process(process):
+    # "cat" echoes its input until EOF, "sleep N" holds the session for N
+    # seconds and anything else is echoed back
+    command = process.command
+    if command == "cat":
+        while data := await process.stdin.read(1024):
+            process.stdout.write(data)
+    elif command.startswith("sleep "):
+        await asyncio.sleep(float(command.split()[1]))
+    else:
+        process.stdout.write(command + "\n")
+    process.exit(0)
+
+
+@pytest.fixture
+def ssh_keys(tmp_path):
+    client_key = asyncssh.generate_private_key("ssh-ed25519")
+    client_key.write_private_key(str(tmp_path / "id"))
+    client_key.write_public_key(str(tmp_path / "id.pub"))
+    return tmp_path, asyncssh.generate_private_key("ssh-ed25519")
+
+
+async def start_pool(ssh_keys, **kwargs):
+    path, host_key = ssh_keys
+    Server.connections = []
+    server = await asyncssh.create_server(
+        Server,
+        "127.0.0.1",
+        0,
+        server_host_keys=[host_key],
+        authorized_client_keys=str(path / "id.pub"),
+        process_factory=handle_process,
+    )
+    port = server.sockets[0].getsockname()[1]
+    (path / "known_hosts").write_text(
+        f"[127.0.0.1]:{port} " + host_key.export_public_key().decode()
+    )
+    pool = SSHPool(
+        "127.0.0.1",
+        "chia",
+        str(path / "id"),
+        port,
+        known_hosts=str(path / "known_hosts"),
+        **kwargs,
+    )
+    return server, pool
+
+
+def test_recovers_from_a_dropped_connection(ssh_keys):
+    async def run():
+        server, pool = await start_pool(ssh_keys)
+        try:
+            await pool.connect()
+            assert (await pool.run_command("echo one")).stdout == "echo one\n"
+            # The harvester closes the idle connection
+            for connection in Server.connections:
+                connection.close()
+            await asyncio.sleep(0.1)
+            assert (await pool.run_command("echo two")).stdout == "echo two\n"
+            assert len(pool.connections) == 1
+            assert not pool.connections[0].connection.is_closed()
+        finally:
+            await pool.close()
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_resident_process_holds_a_session(ssh_keys):
+    async def run():
+        server, pool = await start_pool(ssh_keys, max_connections=1, max_sessions=2)
+        try:
+            process = await pool.start_process("cat")
+            # Only one session is left for commands, which take turns
+            results = await asyncio.gather(
+                pool.run_command("sleep 0.1"), pool.run_command("sleep 0.1")
+            )
+            assert [result.returncode for result in results] == [0, 0]
+            assert [c.active for c in pool.connections] == [1]
+
+            process.stdin.write("ping\n")
+            assert await process.stdout.readline() == "ping\n"
+            process.stdin.write_eof()
+            await process.wait_closed()
+            await asyncio.sleep(0.1)
+            assert [c.active for c in pool.connections] == [0]
+        finally:
+            await pool.close()
+            server.close()
+
+    asyncio.run(run())
@@ -0,0 +1,234 @@
+import asyncio
+import os
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from mownplow.receiver import ReceiverServer
+from mownplow.transport import (
+    RSYNC_PARTIAL_DIR,
+    TRANSFER_FILE_ERROR,
+    TRANSFER_OK,
+    LocalTransport,
+    RsyncTransport,
+    SendfileTransport,
+)
+
+PLOT = Path("/nvme0/a.plot")
+DESTMAN = SimpleNamespace(dest="rsync://h1:12000/plots/d1")
+
+
+def rsync(flags: str) -> RsyncTransport:
+    return RsyncTransport(SimpleNamespace(rsync_cmd="rsync", rsync_flags=flags))
+
+
+def args(transport: RsyncTransport, **kwargs) -> list:
+    return transport.describe(PLOT, DESTMAN, **kwargs).split()
+
+
+def test_adds_progress_and_partial_dir():
+    assert args(rsync("--remove-source-files --whole-file")) == [
+        "rsync",
+        "--remove-source-files",
+        "--whole-file",
+        "--info=progress2",
+        f"--partial-dir={RSYNC_PARTIAL_DIR}",
+        str(PLOT),
+        DESTMAN.dest,
+    ]
+
+
+def test_keeps_configured_info_and_partial():
+    assert args(rsync("--info=stats1 --partial")) == [
+        "rsync",
+        "--info=stats1",
+        "--partial",
+        str(PLOT),
+        DESTMAN.dest,
+    ]
+
+
+def test_bwlimit():
+    assert "--bwlimit=5000" in args(rsync("--sync"), bwlimit=5000)
+    assert not any(arg.startswith("--bwlimit") for arg in args(rsync("--sync")))
+
+
+def test_resume_uses_the_partial_file_as_a_basis():
+    transport = rsync("--remove-source-files --whole-file -W --preallocate")
+    resumed = args(transport, resume=True)
+    # rsync refuses --append(-verify) with --partial-dir or --whole-file
+    assert not any(arg.startswith("--append") for arg in resumed)
+    assert "--whole-file" not in resumed
+    assert "-W" not in resumed
+    assert f"--partial-dir={RSYNC_PARTIAL_DIR}" in resumed
+    assert "--remove-source-files" in resumed
+    # A fresh transfer keeps the configured flags
+    assert "--whole-file" in args(transport)
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    root = tmp_path / "plots"
+    (root / "d1").mkdir(parents=True)
+    server = ReceiverServer(("127.0.0.1", 0), str(root), "secret")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, root
+    server.shutdown()
+    server.server_close()
+
+
+def sendfile(server, token: str = "secret") -> SendfileTransport:
+    return SendfileTransport(
+        SimpleNamespace(
+            transfer_port=server.server_address[1], transfer_token=token
+        )
+    )
+
+
+def make_plot(path: Path, size: int) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(bytes(range(256)) * (size // 256))
+    return path
+
+
+RECEIVER_DEST = SimpleNamespace(dest_host="127.0.0.1", dest_dir="d1")
+
+
+def test_sendfile_follows_a_changing_cap(receiver, tmp_path):
+    server, root = receiver
+    plot = make_plot(tmp_path / "nvme0" / "a.plot", 1024 * 1024)
+    # 256 KB/s for the first chunk (a quarter of a second), then lifted
+    caps = iter([256])
+
+    def bwlimit():
+        return next(caps, 0)
+
+    start = time.monotonic()
+    result = asyncio.run(sendfile(server).transfer(plot, RECEIVER_DEST, None, bwlimit))
+    elapsed = time.monotonic() - start
+    assert result.returncode == TRANSFER_OK
+    assert (root / "d1" / "a.plot").stat().st_size == 1024 * 1024
+    # At 256 KB/s throughout it would have taken four seconds
+    assert 0.2 < elapsed < 2
+
+
+def test_sendfile_delivers_the_plot(receiver, tmp_path):
+    server, root = receiver
+    plot = make_plot(tmp_path / "nvme0" / "a.plot", 1024 * 1024)
+    data = plot.read_bytes()
+    reported = []
+
+    transfer = sendfile(server).transfer(plot, RECEIVER_DEST, reported.append)
+    result = asyncio.run(transfer)
+    assert result.returncode == TRANSFER_OK
+    assert (root / "d1" / "a.plot").read_bytes() == data
+    assert not (root / "d1" / ".a.plot.part").exists()
+    assert not plot.exists()
+    assert reported[-1] == len(data)
+
+
+def test_receiver_refuses_a_wrong_token(receiver, tmp_path):
+    server, root = receiver
+    plot = make_plot(tmp_path / "nvme0" / "a.plot", 64 * 1024)
+
+    result = asyncio.run(sendfile(server, "guess").transfer(plot, RECEIVER_DEST))
+    assert result.returncode == TRANSFER_FILE_ERROR
+    assert "Unauthorised" in result.stderr
+    assert list((root / "d1").iterdir()) == []
+    assert plot.exists()
+
+
+def test_receiver_stays_below_its_root(receiver, tmp_path):
+    server, root = receiver
+    plot = make_plot(tmp_path / "nvme0" / "a.plot", 64 * 1024)
+    dest = SimpleNamespace(dest_host="127.0.0.1", dest_dir="..")
+
+    result = asyncio.run(sendfile(server).transfer(plot, dest))
+    assert result.returncode == TRANSFER_FILE_ERROR
+    assert not (root / "a.plot").exists()
+    assert plot.exists()
+
+
+def test_local_renames_on_the_same_filesystem(tmp_path):
+    plot = make_plot(tmp_path / "nvme0" / "a.plot", 64 * 1024)
+    (tmp_path / "d1").mkdir()
+    reported = []
+
+    dest = SimpleNamespace(virtual_dest=str(tmp_path / "d1"))
+    result = asyncio.run(LocalTransport().transfer(plot, dest, reported.append))
+    assert result.returncode == TRANSFER_OK
+    assert (tmp_path / "d1" / "a.plot").stat().st_size == 64 * 1024
+    assert not plot.exists()
+    assert reported == [64 * 1024]
+
+
+@pytest.fixture
+def other_device(monkeypatch):
+    # Make the given directory look like another filesystem, so that
+    # LocalTransport copies rather than renames
+    real_stat = os.stat
+
+    def stat(path, *args, **kwargs):
+        result = real_stat(path, *args, **kwargs)
+        if str(path) in devices:
+            fields = list(result)
+            fields[2] += 1
+            return os.stat_result(fields)
+        return result
+
+    devices = set()
+    monkeypatch.setattr(os, "stat", stat)
+    return devices
+
+
+def test_local_copies_across_filesystems(tmp_path, other_device):
+    plot = make_plot(tmp_path / "nvme0" / "a.plot", 1024 * 1024)
+    data = plot.read_bytes()
+    inode = plot.stat().st_ino
+    (tmp_path / "d1").mkdir()
+    other_device.add(str(tmp_path / "d1"))
+    reported = []
+
+    dest = SimpleNamespace(virtual_dest=str(tmp_path / "d1"))
+    result = asyncio.run(LocalTransport().transfer(plot, dest, reported.append))
+    assert result.returncode == TRANSFER_OK
+    assert (tmp_path / "d1" / "a.plot").read_bytes() == data
+    assert (tmp_path / "d1" / "a.plot").stat().st_ino != inode
+    assert not (tmp_path / "d1" / ".a.plot.part").exists()
+    assert not plot.exists()
+    assert reported[-1] == len(data)
+
+
+def test_sendfile_resumes_a_partial_file(receiver, tmp_path):
+    server, root = receiver
+    plot = make_plot(tmp_path / "nvme0" / "a.plot", 1024 * 1024)
+    data = plot.read_bytes()
+    (root / "d1" / ".a.plot.part").write_bytes(data[: 256 * 1024])
+    reported = []
+
+    transfer = sendfile(server).transfer(
+        plot, RECEIVER_DEST, reported.append, resume=True
+    )
+    assert asyncio.run(transfer).returncode == TRANSFER_OK
+    assert (root / "d1" / "a.plot").read_bytes() == data
+    # Only the rest of the plot was sent
+    assert reported[-1] == 768 * 1024
+
+
+def test_local_copy_resumes_a_partial_file(tmp_path, other_device):
+    plot = make_plot(tmp_path / "nvme0" / "a.plot", 1024 * 1024)
+    data = plot.read_bytes()
+    (tmp_path / "d1").mkdir()
+    (tmp_path / "d1" / ".a.plot.part").write_bytes(data[: 256 * 1024])
+    other_device.add(str(tmp_path / "d1"))
+    reported = []
+
+    dest = SimpleNamespace(virtual_dest=str(tmp_path / "d1"))
+    transfer = LocalTransport().transfer(plot, dest, reported.append, resume=True)
+    assert asyncio.run(transfer).returncode == TRANSFER_OK
+    assert (tmp_path / "d1" / "a.plot").read_bytes() == data
+    assert reported[-1] == 768 * 1024